@@ -10,9 +10,25 @@ import uuid
 import json
 import threading
 import os  # osモジュールを追加
+import random
+import re
+import atexit
+import functools
+import glob
+import hashlib
+import shutil
+import signal
+import socket
+import sqlite3
+import tempfile
+import zlib
+from collections import OrderedDict, deque
 from datetime import datetime
-from queue import Queue, Empty
+from queue import Queue, Empty, Full
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 import logging
+import multiprocessing
+from multiprocessing.connection import wait as wait_connections
 
 # ロギング設定
 logging.basicConfig(level=logging.INFO)
@@ -26,99 +42,858 @@ CORS(app, resources={
     }
 })
 
-# セッション管理用の辞書
-active_sessions = {}
-session_queues = {}
-stop_events = {}
+# メッセージ要素を特定するセレクター（抽出処理とページ内スクリプトで共有）
+MESSAGE_SELECTOR = '.messages .message, .chat-messages .message, .stream-messages .message, .chat-list .message-item, .tip-comment, [class*="message-item"]'
 
-def extract_messages_from_html(html):
-    """HTMLからメッセージを抽出する関数"""
-    soup = BeautifulSoup(html, 'html.parser')
-    messages = []
+# メッセージ取得方式
+# dom: page_sourceを毎回取得して全体を解析
+# observer: ページ内のMutationObserverが追加されたメッセージだけをバッファし、差分のみを取得
+# push: オブザーバーが追加を検知した時点でCDPバインディング経由でPythonへ送信
+# network: selenium-wireでチャットのWebSocket/XHR通信を傍受し、JSONから直接メッセージを生成
+CAPTURE_MODES = ('dom', 'observer', 'push', 'network')
+DEFAULT_CAPTURE_MODE = 'dom'
+
+# pushモードでページから呼び出すCDPバインディング名
+PUSH_BINDING_NAME = '__chatHarvesterPush'
+# pushモードでプッシュが届かない場合に差分バッファを直接確認する間隔（秒）
+PUSH_FALLBACK_DRAIN_INTERVAL = 5
+
+# 差分HTMLを抽出処理に渡す際のラッパー（コンテナ前提のセレクターに一致させるため）
+FRAGMENT_WRAPPER_OPEN = '<div class="messages chat-messages stream-messages chat-list">'
+FRAGMENT_WRAPPER_CLOSE = '</div>'
+
+# 同じ内容のメッセージを区別する出現序数をページ内で採番する関数（ハーベスターとdomモードで共有）
+# 内容ごとのカウンターをページに保持し、要素には初めて見たときに一度だけ付与するため、
+# 古いメッセージが画面から消えても後から来た同じ内容のメッセージが同じ序数になることはない
+ORDINAL_STAMPER_SOURCE = """
+    const ordinalState = window.__chatOrdinals || (window.__chatOrdinals = {counts: new Map()});
+    if (!ordinalState.nonce) {
+        // ページを読み込み直すたびに変わる接頭辞（要素キーが読み込み前のものと重ならないように）
+        ordinalState.nonce = Math.random().toString(36).slice(2, 10);
+        ordinalState.serial = 0;
+    }
+    // 一致する要素のうち最も外側の要素を返す
+    const topMatch = (node, selector) => {
+        let top = null;
+        for (let el = node; el && el !== document.body; el = el.parentElement) {
+            if (el.matches && el.matches(selector)) {
+                top = el;
+            }
+        }
+        return top;
+    };
+    const stampOrdinal = (el, ordinalAttribute) => {
+        if (el.hasAttribute(ordinalAttribute)) {
+            return;
+        }
+        const text = el.textContent;
+        const n = ordinalState.counts.get(text) || 0;
+        ordinalState.counts.set(text, n + 1);
+        el.setAttribute(ordinalAttribute, String(n));
+    };
+    // 要素ごとにページ内で一意なキーを付与する（抽出側が解析済みの要素を見分けるため）
+    const stampKey = (el, keyAttribute) => {
+        if (!el.hasAttribute(keyAttribute)) {
+            ordinalState.serial++;
+            el.setAttribute(keyAttribute, ordinalState.nonce + '-' + ordinalState.serial);
+        }
+    };
+"""
+
+# ページ内に差分収集用のMutationObserverを設置するスクリプト
+HARVESTER_INSTALL_SCRIPT = ORDINAL_STAMPER_SOURCE + """
+    if (window.__chatHarvester) {
+        // 既に設置済みの場合はプッシュ先のみ更新
+        window.__chatHarvester.pushBinding = arguments[2];
+        return true;
+    }
+    const selector = arguments[0];
+    const maxBuffer = arguments[1];
+    const ordinalAttribute = arguments[3];
+    const harvester = {buffer: [], dropped: 0, observer: null, pushBinding: arguments[2]};
+
+    let pending = new Set();
+    const push = (el) => {
+        pending.add(el);
+    };
+
+    // 追加されたノードから、メッセージ要素（一致する要素のうち最も外側）を文書順に集める
+    const collect = (node) => {
+        if (node.nodeType !== 1) {
+            return;
+        }
+        const top = topMatch(node, selector);
+        if (top) {
+            push(top);
+            return;
+        }
+        node.querySelectorAll(selector).forEach((el) => {
+            if (topMatch(el, selector) === el) {
+                push(el);
+            }
+        });
+    };
+
+    // 収集した要素に序数を付けてからHTMLとしてバッファに積む
+    const materialize = () => {
+        if (pending.size === 0) {
+            return;
+        }
+        const elements = Array.from(pending);
+        pending = new Set();
+        for (const el of elements) {
+            stampOrdinal(el, ordinalAttribute);
+            harvester.buffer.push(el.outerHTML);
+        }
+        while (harvester.buffer.length > maxBuffer) {
+            harvester.buffer.shift();
+            harvester.dropped++;
+        }
+    };
+
+    harvester.drain = () => {
+        const out = harvester.buffer;
+        harvester.buffer = [];
+        return out;
+    };
+
+    // pushモードではバインディング経由で即座に送信（失敗時はバッファに残す）
+    const flush = () => {
+        const binding = harvester.pushBinding;
+        if (!binding || typeof window[binding] !== 'function' || harvester.buffer.length === 0) {
+            return;
+        }
+        try {
+            window[binding](JSON.stringify(harvester.buffer));
+            harvester.drain();
+        } catch (e) {
+            // 次回のフラッシュまたはドレインで再送される
+        }
+    };
+
+    harvester.observer = new MutationObserver((records) => {
+        for (const record of records) {
+            record.addedNodes.forEach(collect);
+        }
+        materialize();
+        flush();
+    });
+    harvester.observer.observe(document.body, {childList: true, subtree: true});
+
+    // 既に表示されているメッセージも初回分として取り込む
+    collect(document.body);
+    materialize();
+    window.__chatHarvester = harvester;
+    flush();
+    return true;
+"""
+
+# domモードでページのHTMLを取得する前に、まだ序数のないメッセージ要素に序数を、全てのメッセージ要素に要素キーを付与するスクリプト
+DOM_ORDINAL_SCRIPT = ORDINAL_STAMPER_SOURCE + """
+    const selector = arguments[0];
+    const ordinalAttribute = arguments[1];
+    const keyAttribute = arguments[2];
+    let stamped = 0;
+    document.querySelectorAll(selector).forEach((el) => {
+        // 入れ子のメッセージ要素もそれぞれ抽出されるため、キーは一致する全要素に付ける
+        stampKey(el, keyAttribute);
+        if (!el.hasAttribute(ordinalAttribute) && topMatch(el, selector) === el) {
+            stampOrdinal(el, ordinalAttribute);
+            stamped++;
+        }
+    });
+    return stamped;
+"""
+
+# バッファされた差分を取り出すスクリプト（オブザーバーが失われていればnullを返す）
+HARVESTER_DRAIN_SCRIPT = """
+    const harvester = window.__chatHarvester;
+    if (!harvester) {
+        return null;
+    }
+    return harvester.drain();
+"""
+HARVESTER_MAX_BUFFER = 2000
+
+# ページの生存確認スクリプト（チャット欄の有無・メッセージ数・最後のメッセージ・オブザーバーの有無を返す）
+PAGE_HEARTBEAT_SCRIPT = """
+    const container = document.querySelector('.messages, .chat-messages, .stream-messages, .chat-list');
+    const elements = document.querySelectorAll(arguments[0]);
+    const last = elements.length ? elements[elements.length - 1].textContent : '';
+    return {
+        ready: document.readyState,
+        container: !!container,
+        messages: elements.length,
+        last: last.slice(-200),
+        harvester: !!window.__chatHarvester
+    };
+"""
+
+# 生存確認の間隔（秒）、この時間チャットに動きがなければ停滞とみなしてリロードする時間（秒）と、
+# リロードしても動きがなかった場合に延ばす上限（秒）、リロードに至る生存確認の連続失敗回数
+LIVENESS_CHECK_INTERVAL = int(os.environ.get('LIVENESS_CHECK_INTERVAL', '15'))
+LIVENESS_STALE_AFTER = int(os.environ.get('LIVENESS_STALE_AFTER', '180'))
+LIVENESS_MAX_STALE_AFTER = int(os.environ.get('LIVENESS_MAX_STALE_AFTER', '1800'))
+LIVENESS_MAX_FAILURES = int(os.environ.get('LIVENESS_MAX_FAILURES', '2'))
+
+# 重複排除インデックスの上限（件数）と時間窓（秒、最後に見てからこの時間を過ぎたIDは破棄。0で無効）
+DEDUP_CAPACITY = int(os.environ.get('DEDUP_CAPACITY', '20000'))
+DEDUP_TTL = int(os.environ.get('DEDUP_TTL', str(2 * 60 * 60)))
+
+CHROMEDRIVER_PATH = "/usr/local/bin/chromedriver"
+
+# networkモードで記録する通信（チャットのWebSocketと履歴取得APIのみに絞り、記録量を抑える）
+NETWORK_CAPTURE_SCOPES = [
+    scope for scope in os.environ.get('NETWORK_CAPTURE_SCOPES', r'.*websocket.*,.*/messages.*,.*/chat.*').split(',') if scope
+]
+NETWORK_CAPTURE_OPTIONS = {
+    'request_storage': 'memory',
+    'request_storage_max_size': 200,
+    'disable_encoding': True  # レスポンスを非圧縮で受け取り、デコード処理を省く
+}
+# networkモードでの記録確認間隔（秒）
+NETWORK_POLL_INTERVAL = 1
+
+# チェック間隔の調整範囲（秒）。新着が続けば短く、静かなチャンネルでは長くする
+POLL_MIN_INTERVAL = float(os.environ.get('POLL_MIN_INTERVAL', '1'))
+POLL_MAX_INTERVAL = float(os.environ.get('POLL_MAX_INTERVAL', '15'))
+# 1回のチェックで拾いたい新着件数の目安（これを超える頻度なら間隔を詰める）
+POLL_TARGET_BATCH = float(os.environ.get('POLL_TARGET_BATCH', '3'))
+# 抽出処理に使ってよい時間の割合の上限（重いページほど間隔の下限が上がる）
+POLL_MAX_DUTY_CYCLE = float(os.environ.get('POLL_MAX_DUTY_CYCLE', '0.25'))
+# 新着がなかったときに間隔を延ばす倍率と、新着の頻度の平滑化係数
+POLL_IDLE_BACKOFF = 1.5
+POLL_RATE_SMOOTHING = 0.3
+
+# /metricsで出力するヒストグラムのバケット（処理時間の秒数と、1回のチェックあたりの件数）
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+METRICS_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+class MetricsRegistry:
+    """Prometheusのテキスト形式で出力するカウンター・ヒストグラム・ゲージの置き場
+    
+    カウンターとヒストグラムは監視処理の中で更新し、ゲージは出力時にコレクター関数で集める。
+    ワーカープロセスの値はdump()で受け取り、出力時に合算する
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        # メトリクス名 -> (種類, 説明, ヒストグラムのバケット)
+        self.definitions = {}
+        # (メトリクス名, ラベルのタプル) -> カウンターの値 / ヒストグラムの[バケットごとの件数..., 合計, 件数]
+        self.values = {}
+        self.collectors = []
+    
+    def counter(self, name, description):
+        self.definitions[name] = ('counter', description, None)
+    
+    def histogram(self, name, description, buckets=METRICS_LATENCY_BUCKETS):
+        self.definitions[name] = ('histogram', description, tuple(buckets))
+    
+    def gauge(self, name, description):
+        self.definitions[name] = ('gauge', description, None)
+    
+    def collector(self, function):
+        """出力時に(メトリクス名, ラベルの辞書, 値)を返すゲージのコレクターを登録する"""
+        self.collectors.append(function)
+        return function
+    
+    def inc(self, name, value=1, **labels):
+        if not value:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+    
+    def observe(self, name, value, **labels):
+        buckets = self.definitions[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [0] * (len(buckets) + 2)
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    state[index] += 1
+                    break
+            state[-2] += value
+            state[-1] += 1
+    
+    def _collect(self):
+        gauges = []
+        for function in self.collectors:
+            try:
+                gauges.extend((name, tuple(sorted(labels.items())), value) for name, labels, value in function())
+            except Exception as collect_err:
+                logger.error(f"Metrics collector {function.__name__} failed: {str(collect_err)}")
+        return gauges
+    
+    def dump(self):
+        """プロセス間で受け渡せる形の現在値（ワーカーからコーディネーターへ送る）"""
+        with self.lock:
+            values = {key: list(value) if isinstance(value, list) else value for key, value in self.values.items()}
+        return {'values': values, 'gauges': self._collect()}
+    
+    def absorb(self, dump):
+        """終了したワーカーのカウンターとヒストグラムを取り込む（起動し直しても値が減らないようにする）"""
+        with self.lock:
+            self._merge(self.values, dump['values'])
+    
+    @staticmethod
+    def _merge(target, values):
+        for key, value in values.items():
+            if isinstance(value, list):
+                state = target.setdefault(key, [0] * len(value))
+                for index, count in enumerate(value):
+                    state[index] += count
+            else:
+                target[key] = target.get(key, 0) + value
+    
+    def render(self, remote_dumps=None):
+        """Prometheusのテキスト形式で出力する（remote_dumpsはワーカーID -> dump()の結果）"""
+        local = self.dump()
+        values = {}
+        self._merge(values, local['values'])
+        gauges = list(local['gauges'])
+        for worker_id, dump in sorted((remote_dumps or {}).items()):
+            self._merge(values, dump['values'])
+            # ブラウザIDなどはワーカーごとに振られるため、ワーカーのラベルで区別する
+            gauges.extend((name, labels + (('worker', str(worker_id)),), value) for name, labels, value in dump['gauges'])
+        
+        samples = {}
+        for (name, labels), value in values.items():
+            samples.setdefault(name, []).append((labels, value))
+        for name, labels, value in gauges:
+            samples.setdefault(name, []).append((labels, value))
+        
+        lines = []
+        for name, (kind, description, buckets) in self.definitions.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(samples.get(name, []), key=lambda sample: sample[0]):
+                if kind != 'histogram':
+                    lines.append(f"{name}{self._labels(labels)} {self._number(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets, value):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._labels(labels + (('le', self._number(bound)),))} {cumulative}")
+                lines.append(f"{name}_bucket{self._labels(labels + (('le', '+Inf'),))} {value[-1]}")
+                lines.append(f"{name}_sum{self._labels(labels)} {self._number(value[-2])}")
+                lines.append(f"{name}_count{self._labels(labels)} {value[-1]}")
+        return '\n'.join(lines) + '\n'
+    
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+        return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+    
+    @staticmethod
+    def _number(value):
+        if isinstance(value, float) and value.is_integer():
+            return str(int(value))
+        return str(value)
+
+metrics = MetricsRegistry()
+metrics.histogram('chat_page_fetch_seconds', 'Time to fetch page HTML, harvested fragments or network payloads per check')
+metrics.histogram('chat_parse_seconds', 'Time to parse HTML into a document')
+metrics.histogram('chat_extract_seconds', 'Time to extract messages from a parsed document or network payloads')
+metrics.histogram('chat_check_seconds', 'Total time of one check of the monitoring loop')
+metrics.histogram('chat_messages_per_check', 'New messages found per check', METRICS_COUNT_BUCKETS)
+metrics.histogram('chat_emit_latency_seconds', 'Time from message extraction (not appearance on the page) to the first SSE emit of its batch, observed once per batch')
+metrics.counter('chat_messages_total', 'Messages that passed deduplication')
+metrics.counter('chat_dedup_hits_total', 'Extracted messages dropped as already seen')
+metrics.counter('chat_element_cache_hits_total', 'Message elements reused from an earlier check without re-extraction')
+metrics.counter('chat_keyword_dropped_total', 'New messages dropped by session keyword filters')
+metrics.counter('chat_page_reloads_total', 'Page reloads by reason')
+metrics.counter('chat_monitor_errors_total', 'Errors in the monitoring loop')
+metrics.counter('chat_sse_events_total', 'SSE events sent by type')
+metrics.counter('chat_sse_payload_bytes_total', 'SSE bytes before compression by content encoding')
+metrics.counter('chat_sse_sent_bytes_total', 'SSE bytes written to clients by content encoding')
+
+# ページ内のスクリプト（ハーベスター・domモード）がメッセージ要素に付与する、同じ内容のメッセージ内での出現序数の属性名
+ORDINAL_ATTRIBUTE = 'data-ckx-ordinal'
+MESSAGE_ID_CACHE_SIZE = int(os.environ.get('MESSAGE_ID_CACHE_SIZE', '50000'))
+# domモードでページ内のスクリプトがメッセージ要素に付与する、ページ内で一意な要素キーの属性名
+ELEMENT_KEY_ATTRIBUTE = 'data-ckx-key'
+ELEMENT_CACHE_SIZE = int(os.environ.get('ELEMENT_CACHE_SIZE', '20000'))
+
+def normalize_field(value):
+    """ID計算用に空白を正規化する"""
+    return ' '.join(str(value).split())
+
+@functools.lru_cache(maxsize=MESSAGE_ID_CACHE_SIZE)
+def compute_message_id(message_type, username, amount, text, stamp, ordinal):
+    """正規化した項目と序数からメッセージIDを計算する（同じ内容なら再起動後も同じIDになる）"""
+    material = '\x1f'.join((message_type, username, amount, text, stamp or '', str(ordinal)))
+    return str(uuid.UUID(bytes=hashlib.blake2b(material.encode('utf-8'), digest_size=16).digest()))
+
+# チップ表記（例: "1,000 tk"）から枚数を取り出す
+COIN_AMOUNT_PATTERN = re.compile(r'\d[\d,]*')
+
+def parse_coin_amount(value):
+    """チップの枚数を整数で返す（数値が含まれなければNone）"""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    match = COIN_AMOUNT_PATTERN.search(str(value))
+    return int(match.group().replace(',', '')) if match else None
+
+def build_chat_message(message_id, message_type, username, timestamp, coin_text=None, comment=None, prize=None):
+    """抽出した項目から配信用のメッセージを作る（表示用のtextと、種類に応じた項目だけを持つ）
+    
+    チップ系: username・amount（整数）・comment / ルーレット: username・prize
+    """
+    if prize is not None:
+        text = f'[{message_type}] ：{prize} 【{username}】'
+    else:
+        text = f'[{message_type}] {coin_text}：{comment} 【{username}】'
+    message = {
+        'id': message_id,
+        'text': text,
+        'type': message_type,
+        'username': username,
+        'checked': False,
+        'timestamp': timestamp
+    }
+    if prize is not None:
+        message['prize'] = prize
+    else:
+        message['amount'] = parse_coin_amount(coin_text)
+        message['comment'] = comment
+    return message
+
+class ElementMessageCache:
+    """要素キーごとに、その要素から作ったメッセージを保持するLRU（スレッド間で共有する）
+    
+    domモードでは毎回ページ全体を解析するため、既に見た要素は項目の走査とIDの計算を省く
+    """
+    
+    def __init__(self, capacity=None):
+        self.capacity = max(1, int(capacity or ELEMENT_CACHE_SIZE))
+        self.lock = threading.Lock()
+        # 要素キー -> [(識別に使った内容, メッセージ)]
+        self.entries = OrderedDict()
+    
+    def get(self, element_key):
+        with self.lock:
+            entry = self.entries.get(element_key)
+            if entry is not None:
+                self.entries.move_to_end(element_key)
+            return entry
+    
+    def put(self, element_key, entry):
+        with self.lock:
+            self.entries[element_key] = entry
+            self.entries.move_to_end(element_key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+element_message_cache = ElementMessageCache()
+
+class MessageIdentifier:
+    """1回の抽出処理の中でメッセージIDを割り当てる
+    
+    同じ内容のメッセージは、ページ内のスクリプトが付与した序数で区別する。
+    序数のないHTML（保存したスナップショットなど）では文書内の出現順で区別する。
+    要素キーのある要素は、前回までに作ったメッセージを要素キャッシュから再利用する
+    """
+    
+    def __init__(self, element_cache=None):
+        self.occurrences = {}
+        self.element_cache = element_cache
+        # 処理中の要素で割り当てた識別内容（ページ側のIDを使った場合はNone）
+        self.assigned = []
     
-    # ページタイトルとボディクラスをログに出力（デバッグ用）
-    title = soup.title.text if soup.title else "No title"
-    body_classes = soup.body.get('class', []) if soup.body else []
-    logger.info(f"Page title: {title}")
-    logger.info(f"Body classes: {body_classes}")
-    
-    # より広範なセレクターでメッセージ要素を検索
-    message_elements = soup.select('.messages .message, .chat-messages .message, .stream-messages .message, .chat-list .message-item, .tip-comment, [class*="message-item"]')
-    logger.info(f"Found {len(message_elements)} message elements with expanded selector")
-    
-    # HTMLセレクターのデバッグ情報
-    all_messages_container = soup.select('.messages, .chat-messages, .stream-messages, .chat-list')
-    logger.info(f"Any message container found: {len(all_messages_container) > 0}")
-    
-    # 最初のいくつかの要素の詳細をログに表示
-    if message_elements:
-        for i, elem in enumerate(message_elements[:3]):  # 最初の3つの要素
-            logger.info(f"Message element {i} classes: {elem.get('class', [])}")
-            logger.info(f"Message element {i} snippet: {str(elem)[:150]}...")
-    
-    # メッセージ要素から情報を抽出
-    for element in message_elements:
-        # 要素に一意の属性があればそれを使用し、なければUUIDを生成
-        element_id = element.get('data-message-id')
-        # IDがなかったり空だったりする場合は新しいIDを生成
-        if not element_id:
-            # 要素のハッシュ値を計算するか、一意の属性の組み合わせを使用
-            element_text = str(element)[:100]  # 要素の一部をIDの生成に使用
-            element_id = str(uuid.uuid5(uuid.NAMESPACE_DNS, element_text))
-        
-        # チップ（投げ銭）メッセージの処理
-        tip_comment_body = element.select_one('.tip-comment-body')
-        coin_amount = element.select_one('.tip-amount-highlight')
-        username = element.select_one('.user-levels-username-text')
-        
-        if tip_comment_body and coin_amount and username:
-            comment_text = tip_comment_body.text.strip()
-            coin_text = coin_amount.text.strip()
-            username_text = username.text.strip()
+    def identify(self, element_id, stamp, message_type, username, amount, text):
+        # ページ側がIDを持っていればそれを優先
+        if element_id:
+            self.assigned.append(None)
+            return element_id
+        key = (message_type, normalize_field(username), normalize_field(amount), normalize_field(text), stamp)
+        ordinal = self.occurrences.get(key, 0)
+        self.occurrences[key] = ordinal + 1
+        self.assigned.append(key)
+        return compute_message_id(*key, ordinal)
+    
+    def cached(self, element_key, timestamp):
+        """解析済みの要素なら前回のメッセージを今回のタイムスタンプで返す（未解析ならNone）"""
+        if element_key is None or self.element_cache is None:
+            return None
+        entry = self.element_cache.get(element_key)
+        if entry is None:
+            return None
+        messages = []
+        for key, message in entry:
+            # 後続の同じ内容のメッセージが同じ序数になるよう、出現数は数える
+            if key is not None:
+                self.occurrences[key] = self.occurrences.get(key, 0) + 1
+            messages.append(dict(message, timestamp=timestamp))
+        metrics.inc('chat_element_cache_hits_total')
+        return messages
+    
+    def remember(self, element_key, messages):
+        """要素から作ったメッセージを、識別に使った内容と一緒に要素キャッシュに記録する"""
+        assigned, self.assigned = self.assigned, []
+        if element_key is not None and self.element_cache is not None:
+            self.element_cache.put(element_key, [(key, dict(message)) for key, message in zip(assigned, messages)])
+
+class BeautifulSoupExtractor:
+    """BeautifulSoup（html.parser）による抽出エンジン（従来の実装で、出力比較の基準）"""
+    name = 'bs4'
+    
+    def parse(self, html):
+        return BeautifulSoup(html, 'html.parser')
+    
+    def extract_from_document(self, soup):
+        messages = []
+        
+        # ページタイトルとボディクラスをログに出力（デバッグ用）
+        title = soup.title.text if soup.title else "No title"
+        body_classes = soup.body.get('class', []) if soup.body else []
+        logger.info(f"Page title: {title}")
+        logger.info(f"Body classes: {body_classes}")
+        
+        # より広範なセレクターでメッセージ要素を検索
+        message_elements = soup.select(MESSAGE_SELECTOR)
+        logger.info(f"Found {len(message_elements)} message elements with expanded selector")
+        
+        # HTMLセレクターのデバッグ情報
+        all_messages_container = soup.select('.messages, .chat-messages, .stream-messages, .chat-list')
+        logger.info(f"Any message container found: {len(all_messages_container) > 0}")
+        
+        # 最初のいくつかの要素の詳細をログに表示
+        if message_elements:
+            for i, elem in enumerate(message_elements[:3]):  # 最初の3つの要素
+                logger.info(f"Message element {i} classes: {elem.get('class', [])}")
+                logger.info(f"Message element {i} snippet: {str(elem)[:150]}...")
+        
+        # メッセージ要素から情報を抽出
+        identifier = MessageIdentifier(element_message_cache)
+        for element in message_elements:
+            element_key = element.get(ELEMENT_KEY_ATTRIBUTE)
+            cached = identifier.cached(element_key, datetime.now().isoformat())
+            if cached is not None:
+                messages.extend(cached)
+                continue
+            first = len(messages)
+            
+            # 要素に一意の属性があればそれを使用し、なければ抽出した内容からIDを生成
+            element_id = element.get('data-message-id')
+            stamp_elem = element if element.has_attr(ORDINAL_ATTRIBUTE) else element.find_parent(attrs={ORDINAL_ATTRIBUTE: True})
+            stamp = stamp_elem.get(ORDINAL_ATTRIBUTE) if stamp_elem else None
+        
+            # チップ（投げ銭）メッセージの処理
+            tip_comment_body = element.select_one('.tip-comment-body')
+            coin_amount = element.select_one('.tip-amount-highlight')
+            username = element.select_one('.user-levels-username-text')
+        
+            if tip_comment_body and coin_amount and username:
+                comment_text = tip_comment_body.text.strip()
+                coin_text = coin_amount.text.strip()
+                username_text = username.text.strip()
             
-            # メッセージタイプを判定
-            message_type = 'メッセージ'
-            if element.select_one('.tip-comment.tip-comment-with-highlight.tip-menu'):
-                message_type = 'プレゼントメニュー'
-            elif element.select_one('.tip-comment-epic-goal'):
-                message_type = 'エピックゴール'
+                # メッセージタイプを判定
+                message_type = 'メッセージ'
+                if element.select_one('.tip-comment.tip-comment-with-highlight.tip-menu'):
+                    message_type = 'プレゼントメニュー'
+                elif element.select_one('.tip-comment-epic-goal'):
+                    message_type = 'エピックゴール'
             
-            formatted_text = f'[{message_type}] {coin_text}：{comment_text} 【{username_text}】'
+                messages.append(build_chat_message(
+                    identifier.identify(element_id, stamp, message_type, username_text, coin_text, comment_text),
+                    message_type, username_text, datetime.now().isoformat(),
+                    coin_text=coin_text, comment=comment_text
+                ))
+        
+            # ルーレット（Wheel of Fortune）メッセージの処理
+            if ('plugin-message' in element.get('class', []) or 
+                element.select_one('[class*="plugin-message"]')) and \
+               (element.select_one('.plugin-message-plugin-name') or 
+                element.select_one('[class*="plugin-name"]')):
             
-            messages.append({
-                'id': element_id,
-                'text': formatted_text,
-                'type': message_type,
-                'checked': False,
-                'timestamp': datetime.now().isoformat()
-            })
+                plugin_name_elem = element.select_one('.plugin-message-plugin-name') or element.select_one('[class*="plugin-name"]')
+                if plugin_name_elem and 'Wheel of Fortune' in plugin_name_elem.text:
+                    prize_elem = element.select_one('.plugin-message-accent') or element.select_one('[class*="accent"]')
+                    prize_text = prize_elem.text.strip() if prize_elem else ''
+                
+                    username_element = element.select_one('.user-levels-username-text') or element.select_one('[class*="username"]')
+                    username_text = username_element.text.strip() if username_element else ''
+                
+                    if prize_text and username_text:
+                        messages.append(build_chat_message(
+                            identifier.identify(element_id, stamp, 'ルーレット', username_text, '', prize_text),
+                            'ルーレット', username_text, datetime.now().isoformat(), prize=prize_text
+                        ))
+            
+            identifier.remember(element_key, messages[first:])
+        
+        logger.info(f"Extracted {len(messages)} messages")
+        
+        return messages
+
+class LxmlExtractor:
+    """lxmlで解析し、候補要素を絞り込んでから1回の走査で項目を取り出す抽出エンジン"""
+    name = 'lxml'
+    
+    def __init__(self):
+        from lxml import etree
+        from lxml import html as lxml_html
+        
+        self._etree = etree
+        self._document_fromstring = lxml_html.document_fromstring
+        # class属性の部分一致で候補を1回のXPath走査に絞り込む
+        self._candidates = etree.XPath('//*[contains(@class, "message") or contains(@class, "tip-comment")]')
+    
+    def parse(self, html):
+        return self._document_fromstring(html)
+    
+    def _select_message_elements(self, document):
+        """MESSAGE_SELECTORと同じ条件の要素を文書順に返す"""
+        elements = []
+        for element in self._candidates(document):
+            class_attr = element.get('class')
+            classes = class_attr.split()
+            # .tip-comment, [class*="message-item"]（.chat-list .message-itemも含む）
+            if 'tip-comment' in classes or 'message-item' in class_attr:
+                elements.append(element)
+                continue
+            # .messages .message, .chat-messages .message, .stream-messages .message
+            if 'message' in classes:
+                for ancestor in element.iterancestors():
+                    ancestor_class = ancestor.get('class')
+                    if ancestor_class and not MESSAGE_CONTAINER_CLASSES.isdisjoint(ancestor_class.split()):
+                        elements.append(element)
+                        break
+        return elements
+    
+    def _ordinal_stamp(self, element):
+        """ページ内のスクリプトが付与した序数を自身または祖先から取得する"""
+        stamp = element.get(ORDINAL_ATTRIBUTE)
+        if stamp is not None:
+            return stamp
+        for ancestor in element.iterancestors():
+            stamp = ancestor.get(ORDINAL_ATTRIBUTE)
+            if stamp is not None:
+                return stamp
+        return None
+    
+    def _scan_fields(self, element):
+        """子孫要素を1回だけ走査し、各項目に最初に一致した要素を記録する（select_oneと同じ文書順）"""
+        found = {}
+        for node in element.iterdescendants(self._etree.Element):
+            class_attr = node.get('class')
+            if not class_attr:
+                continue
+            classes = class_attr.split()
+            for key, matches in EXTRACTION_FIELD_MATCHERS:
+                if key not in found and matches(class_attr, classes):
+                    found[key] = node
+        return found
+    
+    def extract_from_document(self, document):
+        messages = []
+        timestamp = datetime.now().isoformat()
+        identifier = MessageIdentifier(element_message_cache)
         
-        # ルーレット（Wheel of Fortune）メッセージの処理
-        if ('plugin-message' in element.get('class', []) or 
-            element.select_one('[class*="plugin-message"]')) and \
-           (element.select_one('.plugin-message-plugin-name') or 
-            element.select_one('[class*="plugin-name"]')):
+        for element in self._select_message_elements(document):
+            element_key = element.get(ELEMENT_KEY_ATTRIBUTE)
+            cached = identifier.cached(element_key, timestamp)
+            if cached is not None:
+                messages.extend(cached)
+                continue
+            first = len(messages)
+            found = self._scan_fields(element)
+            
+            element_id = element.get('data-message-id')
+            stamp = self._ordinal_stamp(element)
+            
+            # チップ（投げ銭）メッセージの処理
+            if 'tip_body' in found and 'tip_amount' in found and 'username' in found:
+                comment_text = found['tip_body'].text_content().strip()
+                coin_text = found['tip_amount'].text_content().strip()
+                username_text = found['username'].text_content().strip()
+                
+                message_type = 'メッセージ'
+                if 'tip_menu' in found:
+                    message_type = 'プレゼントメニュー'
+                elif 'epic_goal' in found:
+                    message_type = 'エピックゴール'
+                
+                messages.append(build_chat_message(
+                    identifier.identify(element_id, stamp, message_type, username_text, coin_text, comment_text),
+                    message_type, username_text, timestamp, coin_text=coin_text, comment=comment_text
+                ))
             
-            plugin_name_elem = element.select_one('.plugin-message-plugin-name') or element.select_one('[class*="plugin-name"]')
-            if plugin_name_elem and 'Wheel of Fortune' in plugin_name_elem.text:
-                prize_elem = element.select_one('.plugin-message-accent') or element.select_one('[class*="accent"]')
-                prize_text = prize_elem.text.strip() if prize_elem else ''
+            # ルーレット（Wheel of Fortune）メッセージの処理
+            plugin_name_elem = first_found(found, 'plugin_name', 'plugin_name_partial')
+            is_plugin = 'plugin-message' in (element.get('class') or '').split() or 'plugin_message' in found
+            if is_plugin and plugin_name_elem is not None and 'Wheel of Fortune' in plugin_name_elem.text_content():
+                prize_elem = first_found(found, 'plugin_accent', 'accent_partial')
+                prize_text = prize_elem.text_content().strip() if prize_elem is not None else ''
                 
-                username_element = element.select_one('.user-levels-username-text') or element.select_one('[class*="username"]')
-                username_text = username_element.text.strip() if username_element else ''
+                username_element = first_found(found, 'username', 'username_partial')
+                username_text = username_element.text_content().strip() if username_element is not None else ''
                 
                 if prize_text and username_text:
-                    formatted_text = f'[ルーレット] ：{prize_text} 【{username_text}】'
-                    messages.append({
-                        'id': element_id,
-                        'text': formatted_text,
-                        'type': 'ルーレット',
-                        'checked': False,
-                        'timestamp': datetime.now().isoformat()
-                    })
+                    messages.append(build_chat_message(
+                        identifier.identify(element_id, stamp, 'ルーレット', username_text, '', prize_text),
+                        'ルーレット', username_text, timestamp, prize=prize_text
+                    ))
+            
+            identifier.remember(element_key, messages[first:])
+        
+        return messages
+
+# .messageを含むコンテナのクラス（MESSAGE_SELECTORの子孫セレクター部分）
+MESSAGE_CONTAINER_CLASSES = frozenset(['messages', 'chat-messages', 'stream-messages'])
+
+# lxmlエンジンが1回の走査で探す項目（キー, 判定関数(class属性の文字列, クラスのリスト)）
+EXTRACTION_FIELD_MATCHERS = (
+    ('tip_body', lambda attr, classes: 'tip-comment-body' in classes),
+    ('tip_amount', lambda attr, classes: 'tip-amount-highlight' in classes),
+    ('username', lambda attr, classes: 'user-levels-username-text' in classes),
+    ('tip_menu', lambda attr, classes: 'tip-comment' in classes and 'tip-comment-with-highlight' in classes and 'tip-menu' in classes),
+    ('epic_goal', lambda attr, classes: 'tip-comment-epic-goal' in classes),
+    ('plugin_message', lambda attr, classes: 'plugin-message' in attr),
+    ('plugin_name', lambda attr, classes: 'plugin-message-plugin-name' in classes),
+    ('plugin_name_partial', lambda attr, classes: 'plugin-name' in attr),
+    ('plugin_accent', lambda attr, classes: 'plugin-message-accent' in classes),
+    ('accent_partial', lambda attr, classes: 'accent' in attr),
+    ('username_partial', lambda attr, classes: 'username' in attr),
+)
+
+def first_found(found, *keys):
+    """候補キーのうち最初に見つかった要素を返す（lxmlの要素は子がないと偽になるためorは使わない）"""
+    for key in keys:
+        if key in found:
+            return found[key]
+    return None
+
+# 抽出エンジンの登録（名前 -> クラス）
+EXTRACTION_ENGINES = {
+    'bs4': BeautifulSoupExtractor,
+    'lxml': LxmlExtractor
+}
+DEFAULT_EXTRACTION_ENGINE = os.environ.get('EXTRACTION_ENGINE', 'lxml')
+
+# lxmlのコンパイル済みセレクターはスレッド間で共有できないため、スレッドごとに生成する
+_extraction_engines = threading.local()
+
+def get_extraction_engine(name=None):
+    """名前から抽出エンジンを取得する（依存パッケージがなければbs4にフォールバック）"""
+    name = name or DEFAULT_EXTRACTION_ENGINE
+    engines = _extraction_engines.__dict__
+    if name not in engines:
+        if name not in EXTRACTION_ENGINES:
+            raise ValueError(f"Unknown extraction engine: {name}")
+        try:
+            engines[name] = EXTRACTION_ENGINES[name]()
+        except ImportError as import_err:
+            logger.warning(f"Extraction engine '{name}' unavailable ({str(import_err)}), falling back to bs4")
+            engines[name] = get_extraction_engine('bs4')
+    return engines[name]
+
+def extract_messages_from_html(html, engine=None):
+    """HTMLからメッセージを抽出する関数（解析と抽出の時間をメトリクスに記録する）"""
+    extractor = get_extraction_engine(engine)
+    started = time.perf_counter()
+    document = extractor.parse(html)
+    parsed = time.perf_counter()
+    messages = extractor.extract_from_document(document)
+    metrics.observe('chat_parse_seconds', parsed - started, engine=extractor.name)
+    metrics.observe('chat_extract_seconds', time.perf_counter() - parsed, engine=extractor.name)
+    return messages
+
+def iter_json_documents(content):
+    """WebSocketフレームやレスポンス本文からJSONドキュメントを取り出す（改行区切りの複数JSONにも対応）"""
+    if isinstance(content, bytes):
+        try:
+            content = content.decode('utf-8')
+        except UnicodeDecodeError:
+            return
+    if not content:
+        return
+    
+    for line in content.splitlines():
+        line = line.strip()
+        if not line or line[0] not in '{[':
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            continue
+
+def find_chat_events(node):
+    """JSONを再帰的に探索し、チャットイベントらしきオブジェクト（typeとdetailsを持つ）を列挙する"""
+    if isinstance(node, dict):
+        if isinstance(node.get('type'), str) and isinstance(node.get('details'), dict):
+            yield node
+            return
+        for value in node.values():
+            yield from find_chat_events(value)
+    elif isinstance(node, list):
+        for value in node:
+            yield from find_chat_events(value)
+
+def network_event_to_message(event):
+    """チャットイベントのJSONをextract_messages_from_htmlと同じ形式のメッセージに変換する"""
+    event_type = event['type']
+    event_type_lower = event_type.lower()
+    details = event['details']
+    user_data = event.get('userData') or event.get('user') or {}
+    if not isinstance(user_data, dict):
+        # オブジェクト以外（IDだけなど）はユーザー名の取得に使わない
+        user_data = {}
+    username_text = str(user_data.get('username') or details.get('username') or '').strip()
+    
+    # 元イベントのIDがあればそれを使い、なければ内容から決定的なIDを生成
+    event_id = event.get('id')
+    if event_id is None:
+        event_id = json.dumps(event, sort_keys=True, ensure_ascii=False)
+    element_id = str(uuid.uuid5(uuid.NAMESPACE_DNS, f'network:{event_id}'))
+    
+    # ルーレット（Wheel of Fortune）
+    plugin_name = str(details.get('pluginName') or details.get('plugin') or '')
+    if 'wheel' in event_type_lower or 'Wheel of Fortune' in plugin_name:
+        prize_text = str(details.get('prize') or details.get('winningItem') or details.get('result') or details.get('body') or '').strip()
+        if not (prize_text and username_text):
+            return None
+        return build_chat_message(element_id, 'ルーレット', username_text, datetime.now().isoformat(), prize=prize_text)
     
-    logger.info(f"Extracted {len(messages)} messages")
+    # チップ（投げ銭）・エピックゴール・プレゼントメニュー
+    amount = details.get('amount')
+    if amount is None or not username_text:
+        return None
     
+    source = str(details.get('source') or '').lower()
+    if 'epicgoal' in event_type_lower or 'epicgoal' in source or details.get('isEpicGoal'):
+        message_type = 'エピックゴール'
+    elif 'tipmenu' in source or details.get('tipMenuItem') or (isinstance(details.get('tipData'), dict) and details['tipData'].get('tipMenu')):
+        message_type = 'プレゼントメニュー'
+    elif event_type_lower == 'tip':
+        message_type = 'メッセージ'
+    else:
+        return None
+    
+    comment_text = str(details.get('body') or details.get('text') or '').strip()
+    return build_chat_message(element_id, message_type, username_text, datetime.now().isoformat(),
+                              coin_text=str(amount), comment=comment_text)
+
+def extract_messages_from_payloads(payloads):
+    """傍受した通信データ（WebSocketフレーム・XHRレスポンス）からメッセージを抽出する"""
+    started = time.perf_counter()
+    messages = []
+    for payload in payloads:
+        for document in iter_json_documents(payload):
+            for event in find_chat_events(document):
+                message = network_event_to_message(event)
+                if message:
+                    messages.append(message)
+    metrics.observe('chat_extract_seconds', time.perf_counter() - started, engine='network')
     return messages
 
 def analyze_dom_structure(html):
@@ -254,401 +1029,4053 @@ def analyze_dom_structure_enhanced(html):
     # debug_analysis = analyze_dom_structure_enhanced(html)
     # logger.info(f"Enhanced DOM analysis: {json.dumps(debug_analysis)}")
 
-def monitor_chat(url, session_id, message_queue, stop_event):
-    """チャットを監視し、新しいメッセージをキューに追加するバックグラウンド処理"""
-    logger.info(f"Starting monitoring for session {session_id} at {url}")
+def install_harvester(driver, push_binding=None):
+    """ページ内に差分収集用のMutationObserverを設置する"""
+    return driver.execute_script(HARVESTER_INSTALL_SCRIPT, MESSAGE_SELECTOR, HARVESTER_MAX_BUFFER, push_binding, ORDINAL_ATTRIBUTE)
+
+def stamp_message_ordinals(driver):
+    """domモードでページのHTMLを取得する前に、新しく表示されたメッセージ要素に出現序数と要素キーを付与する"""
+    return driver.execute_script(DOM_ORDINAL_SCRIPT, MESSAGE_SELECTOR, ORDINAL_ATTRIBUTE, ELEMENT_KEY_ATTRIBUTE)
+
+def drain_harvested_html(driver):
+    """オブザーバーがバッファした差分HTMLを取り出す（差分がなければNone）"""
+    fragments = driver.execute_script(HARVESTER_DRAIN_SCRIPT)
+    if fragments is None:
+        # リフレッシュ等でオブザーバーが失われた場合は再設置（表示中のメッセージが初回分として入る）
+        logger.info("Harvester not found in page, reinstalling")
+        install_harvester(driver)
+        fragments = driver.execute_script(HARVESTER_DRAIN_SCRIPT)
     
-    # 過去に処理したメッセージIDを記録
-    processed_ids = set()
+    if not fragments:
+        return None
     
-    # ブラウザインスタンスとドライバーの参照
-    driver = None
-    last_refresh_time = time.time()
-    refresh_interval = 30  # 30秒ごとに再接続（負荷軽減のため延長）
-    periodic_check_interval = 5  # 5秒ごとに更新チェック（負荷軽減のため延長）
-
-    try:
-        # ブラウザの設定
-        chrome_options = Options()
-        chrome_options.add_argument("--headless=new")  # 新しいヘッドレスモード
-        chrome_options.add_argument("--no-sandbox")
-        chrome_options.add_argument("--disable-dev-shm-usage")
-        chrome_options.add_argument("--disable-gpu")
-        chrome_options.add_argument("--window-size=1920,1080")
+    logger.info(f"Drained {len(fragments)} harvested fragments ({sum(len(f) for f in fragments)} chars)")
+    return wrap_fragments(fragments)
 
-        # 重要: レンダラーの問題を回避するための設定
-        chrome_options.add_argument("--disable-extensions")
-        chrome_options.add_argument("--disable-infobars")
-        chrome_options.add_argument("--mute-audio")
-        chrome_options.add_argument("--disable-browser-side-navigation")
-        chrome_options.add_argument("--disable-features=VizDisplayCompositor")
-        chrome_options.add_argument("--disable-web-security")
-        chrome_options.add_argument("--disable-features=IsolateOrigins,site-per-process")
-
-        # メモリ使用量を最適化
-        chrome_options.add_argument("--js-flags=--max-old-space-size=512")
-        chrome_options.add_argument("--memory-pressure-off")
-
-        # 安定性のための設定
-        chrome_options.add_argument("--disable-setuid-sandbox")
-        chrome_options.add_argument("--ignore-certificate-errors")
-        chrome_options.add_argument("--disable-accelerated-2d-canvas")
-        chrome_options.add_argument("--disable-accelerated-jpeg-decoding")
-        chrome_options.add_argument("--disable-accelerated-mjpeg-decode")
-        chrome_options.add_argument("--disable-accelerated-video-decode")
-        chrome_options.add_argument("--disable-gpu-compositing")
-        chrome_options.add_argument("--remote-debugging-port=9222")
-
-        # UAを設定
-        chrome_options.add_argument("user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36")
-
-        # ページロード戦略を設定
-        chrome_options.page_load_strategy = 'eager'  # DOMContentLoadedイベント時に読み込み完了とみなす
-
-        # 環境変数をチェック
-        chrome_binary = os.environ.get('CHROME_BIN', '/usr/bin/google-chrome')
-        logger.info(f"Using Chrome binary at: {chrome_binary}")
-
-        # バイナリの場所を明示的に設定
-        chrome_options.binary_location = chrome_binary
-
-        # デバッグ情報をログに出力
-        logger.info(f"Chrome options: {', '.join(chrome_options.arguments)}")
+def wrap_fragments(fragments):
+    """差分HTMLの断片を抽出処理に渡せる形にまとめる"""
+    return FRAGMENT_WRAPPER_OPEN + ''.join(fragments) + FRAGMENT_WRAPPER_CLOSE
 
-        # WebDriverの設定
-        service = Service("/usr/local/bin/chromedriver")
-        
-        # ブラウザ起動前にデバッグログ
-        logger.info(f"Starting Chrome with binary: {chrome_binary}")
-        logger.info("Using ChromeDriver from: /usr/local/bin/chromedriver")
-        
-        # タイムアウトを長めに設定して起動
-        driver = webdriver.Chrome(service=service, options=chrome_options)
-        logger.info("ChromeDriver started successfully")
-        
-        # ブラウザバージョン情報を取得
-        version = driver.capabilities.get('browserVersion', 'unknown')
-        driver_version = driver.capabilities.get('chrome', {}).get('chromedriverVersion', 'unknown')
-        logger.info(f"Chrome version: {version}, ChromeDriver version: {driver_version}")
+def filter_new_messages(all_messages, dedup_index):
+    """処理済みIDに含まれないメッセージのみを返す（返したメッセージは処理済みとして記録）"""
+    new_messages = [msg for msg in all_messages if dedup_index.check_and_add(msg['id'])]
+    metrics.inc('chat_messages_total', len(new_messages))
+    metrics.inc('chat_dedup_hits_total', len(all_messages) - len(new_messages))
+    return new_messages
 
-        # URLにアクセス
-        driver.get(url)
-        logger.info(f"Browser accessed {url}")
-        
-        # 初期データを送信（接続確認用）
-        initial_messages = [{
-            'id': str(uuid.uuid4()),
-            'text': f'[接続確認] モニタリングを開始しました 【System】',
-            'type': 'システム',
-            'checked': False,
-            'timestamp': datetime.now().isoformat()
-        }]
-        message_queue.put(initial_messages)
-        
-        # 最初のロード待機
-        time.sleep(10)  # 初期ロードも高速化
-        
-        # 前回の最終チェック時間
-        last_check_time = time.time()
+class BoundedDedupIndex:
+    """処理済みメッセージIDを64bitダイジェストで保持する、件数と時間窓で上限を持つ重複排除インデックス"""
+    
+    def __init__(self, capacity=None, ttl=None):
+        self.capacity = max(1, int(capacity or DEDUP_CAPACITY))
+        self.ttl = DEDUP_TTL if ttl is None else int(ttl)
+        self.lock = threading.Lock()
+        # ダイジェスト -> 最後に見た時刻（最後に見た順に並ぶLRU）
+        self.entries = OrderedDict()
+        # 追い出したダイジェスト（再び現れた場合に誤って再送出したことを検知するため、同じ件数だけ保持）
+        self.evicted = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.false_reemits = 0
+    
+    @staticmethod
+    def digest(message_id):
+        return int.from_bytes(hashlib.blake2b(message_id.encode('utf-8'), digest_size=8).digest(), 'little')
+    
+    def check_and_add(self, message_id, now=None):
+        """未処理のIDなら記録してTrue、処理済みならFalseを返す"""
+        now = now if now is not None else time.time()
+        key = self.digest(message_id)
+        with self.lock:
+            if key in self.entries:
+                # 再スキャンで見えているメッセージは時間窓を延長して残す
+                self.entries.move_to_end(key)
+                self.entries[key] = now
+                self.hits += 1
+                return False
+            
+            self.misses += 1
+            if self.evicted.pop(key, None) is not None:
+                self.false_reemits += 1
+            self.entries[key] = now
+            self._evict(now)
+            return True
+    
+    def _evict(self, now):
+        while len(self.entries) > self.capacity:
+            key, _ = self.entries.popitem(last=False)
+            self.evictions += 1
+            self._remember_evicted(key)
         
-        # 監視ループ
-        while not stop_event.is_set():
-            try:
-                current_time = time.time()
-                
-                # 定期的なチェックの時間になったか
-                is_check_time = (current_time - last_check_time) >= periodic_check_interval
-                
-                # ブラウザのリフレッシュが必要か
-                is_refresh_time = (current_time - last_refresh_time) >= refresh_interval
-                
-                # 定期的にブラウザセッションをリフレッシュ
-                if is_refresh_time:
-                    logger.info("Refreshing browser session")
-                    driver.refresh()
-                    
-                    # ページロード後にJavaScriptを実行してコンテンツを表示
-                    try:
-                        driver.execute_script("""
-                            // メッセージコンテナをスクロール
-                            const messagesContainer = document.querySelector('.messages');
-                            if (messagesContainer) {
-                                messagesContainer.scrollTop = messagesContainer.scrollHeight;
-                            }
-                        """)
-                    except Exception as js_err:
-                        logger.error(f"Error executing scroll script: {str(js_err)}")
-                        
-                    time.sleep(2)  # ページロード待機時間
-                    last_refresh_time = current_time
-                    last_check_time = current_time  # チェックタイマーもリセット
-                    is_check_time = True  # 強制的にチェック
-                
-                # 定期的なチェック時間かリフレッシュ時にメッセージを取得
-                if is_check_time:
-                    # ページのHTMLを取得
-                    html = driver.page_source
+        if self.ttl:
+            while self.entries:
+                key, last_seen = next(iter(self.entries.items()))
+                if now - last_seen <= self.ttl:
+                    break
+                self.entries.popitem(last=False)
+                self.expirations += 1
+                self._remember_evicted(key)
+    
+    def _remember_evicted(self, key):
+        self.evicted[key] = True
+        if len(self.evicted) > self.capacity:
+            self.evicted.popitem(last=False)
+    
+    def checkpoint(self, limit=None):
+        """チェックポイントに書き出す設定と、最後に見た順で新しい方からlimit件の(ダイジェスト, 最後に見た時刻)"""
+        with self.lock:
+            entries = list(self.entries.items())
+        if limit is not None:
+            entries = entries[-limit:]
+        return {
+            'capacity': self.capacity,
+            'ttl': self.ttl,
+            'entries': [[key, round(last_seen, 3)] for key, last_seen in entries]
+        }
+    
+    @classmethod
+    def from_checkpoint(cls, state):
+        """チェックポイントから復元する（時間窓を過ぎたIDはここで追い出す）"""
+        index = cls(state['capacity'], state['ttl'])
+        for key, last_seen in state['entries']:
+            index.entries[int(key)] = float(last_seen)
+        index._evict(time.time())
+        return index
+    
+    def __contains__(self, message_id):
+        with self.lock:
+            return self.digest(message_id) in self.entries
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'capacity': self.capacity,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'false_reemits': self.false_reemits
+            }
 
-                    # デバッグ用に一部のHTMLを保存
-                    try:
-                        debug_path = '/tmp/debug.html'
-                        with open(debug_path, 'w', encoding='utf-8') as f:
-                            f.write(html[:200000])  # 最初の20万文字を保存（十分な量）
-                        logger.info(f"Saved debug HTML to {debug_path}")
-
-                        # 重要なセレクターの出現回数をカウント
-                        count_messages = html.count('class="messages"')
-                        count_message = html.count('class="message"')
-                        count_chat_messages = html.count('class="chat-messages"')
-                        count_tip_comment = html.count('class="tip-comment"')
-                        
-                        logger.info(f"HTML stats - messages: {count_messages}, message: {count_message}, chat-messages: {count_chat_messages}, tip-comment: {count_tip_comment}")
-                    except Exception as write_err:
-                        logger.error(f"Failed to save debug HTML: {str(write_err)}")
+# キーワードフィルターで扱うメッセージの種類（システムメッセージは常に通す）
+KEYWORD_MESSAGE_TYPES = ('メッセージ', 'エピックゴール', 'プレゼントメニュー', 'ルーレット')
+# 1つのフィルターに指定できる語句・正規表現の数と、正規表現1つあたりの長さの上限
+KEYWORD_MAX_TERMS = int(os.environ.get('KEYWORD_MAX_TERMS', '200'))
+KEYWORD_MAX_PATTERN_LENGTH = 200
+# 正規表現（patterns・exclude_patterns）を受け付けるか（0にすると語句の部分一致のみ）
+# 正規表現はクライアントが指定したものを監視スレッドで全メッセージに対して実行するため、
+# 後方参照・名前付きグループ・量指定子の入れ子を拒否し、量指定子の数と照合する文字数に上限を設ける
+KEYWORD_REGEX_ENABLED = os.environ.get('KEYWORD_REGEX_ENABLED', '1') == '1'
+KEYWORD_MAX_UNBOUNDED_REPEATS = 2
+KEYWORD_MAX_REGEX_TEXT_LENGTH = int(os.environ.get('KEYWORD_MAX_REGEX_TEXT_LENGTH', '300'))
 
-                    # ページ全体の構造情報を取得
-                    try:
-                        structure_info = driver.execute_script("""
-                            const allNodes = document.querySelectorAll('div, section, aside');
-                            const classes = {};
-                            for (let i = 0; i < allNodes.length; i++) {
-                                if (allNodes[i].className) {
-                                    const cls = allNodes[i].className.toString();
-                                    classes[cls] = (classes[cls] || 0) + 1;
-                                }
-                            }
-                            
-                            // メッセージ関連の要素を特に探す
-                            const messageContainers = document.querySelectorAll(
-                                '.messages, .chat-messages, .stream-messages, .chat-list, .message-list, ' + 
-                                '.comment-list, [class*="message"], [class*="chat"], [class*="comment"]'
-                            );
-                            
-                            const potentialContainers = [];
-                            for (let i = 0; i < messageContainers.length; i++) {
-                                potentialContainers.push({
-                                    className: messageContainers[i].className,
-                                    childCount: messageContainers[i].children.length,
-                                    html: messageContainers[i].children.length > 0 ? 
-                                        messageContainers[i].children[0].outerHTML.substring(0, 150) : 'No children'
-                                });
-                            }
-                            
-                            return {
-                                title: document.title,
-                                url: window.location.href,
-                                bodyClass: document.body.className,
-                                topClasses: Object.entries(classes)
-                                    .sort((a, b) => b[1] - a[1])
-                                    .slice(0, 20),  // 出現頻度の高い上位20クラス
-                                potentialMessageContainers: potentialContainers
-                            }
-                        """)
-                        logger.info(f"Page structure: {json.dumps(structure_info)}")
-                    except Exception as js_err:
-                        logger.error(f"Failed to analyze page structure: {str(js_err)}")
+try:
+    from re import _parser as regex_parser
+except ImportError:  # Python 3.10以前
+    import sre_parse as regex_parser
 
-                    # スクリーンショットを撮影（HTMLだけでは分からない要素の位置関係を確認）
-                    try:
-                        screenshot_path = '/tmp/debug_screenshot.png'
-                        driver.save_screenshot(screenshot_path)
-                        logger.info(f"Saved screenshot to {screenshot_path}")
-                    except Exception as ss_err:
-                        logger.error(f"Failed to take screenshot: {str(ss_err)}")
+def check_keyword_pattern(pattern, flags):
+    """照合にかかる時間が入力長に対して急増する構文を拒否し、コンパイル済みの正規表現を返す（拒否する場合はre.error）"""
+    if not KEYWORD_REGEX_ENABLED:
+        raise re.error('regular expressions are disabled on this server (KEYWORD_REGEX_ENABLED=0)')
+    compiled = re.compile(pattern, flags)
+    if compiled.groupindex:
+        raise re.error('named groups are not allowed')
+    unbounded = 0
+    
+    def walk(items, in_repeat):
+        nonlocal unbounded
+        for op, av in items:
+            name = str(op)
+            if name in ('GROUPREF', 'GROUPREF_EXISTS'):
+                raise re.error('backreferences are not allowed')
+            if name in ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT'):
+                _, high, body = av
+                is_unbounded = high == regex_parser.MAXREPEAT
+                if in_repeat and (is_unbounded or high > 1):
+                    raise re.error('nested quantifiers are not allowed')
+                unbounded += is_unbounded
+                walk(body, in_repeat or is_unbounded)
+            elif name == 'BRANCH':
+                if in_repeat:
+                    # (a|a)* のように、繰り返しの中の選択は組み合わせの数だけ照合し直すことがある
+                    raise re.error('alternation inside a repeated group is not allowed')
+                for branch in av[1]:
+                    walk(branch, in_repeat)
+            elif name == 'SUBPATTERN':
+                walk(av[-1], in_repeat)
+            elif name in ('ASSERT', 'ASSERT_NOT'):
+                walk(av[1], in_repeat)
+            elif name == 'ATOMIC_GROUP':
+                walk(av, in_repeat)
+    
+    walk(regex_parser.parse(pattern, flags), False)
+    if unbounded > KEYWORD_MAX_UNBOUNDED_REPEATS:
+        raise re.error(f'at most {KEYWORD_MAX_UNBOUNDED_REPEATS} unbounded quantifiers (*, +, {{n,}}) are allowed')
+    return compiled
 
-                    # 拡張DOM分析を実行
-                    try:
-                        debug_analysis = analyze_dom_structure_enhanced(html)
-                        logger.info(f"Enhanced DOM analysis: {json.dumps(debug_analysis)}")
-                    except Exception as analysis_err:
-                        logger.error(f"Failed to perform enhanced DOM analysis: {str(analysis_err)}")
-                        
-                    # メッセージを抽出
-                    all_messages = extract_messages_from_html(html)
-                    
-                    # 新しいメッセージのみをフィルタリング
-                    new_messages = []
-                    for msg in all_messages:
-                        msg_id = msg['id']
-                        if msg_id not in processed_ids:
-                            new_messages.append(msg)
-                            processed_ids.add(msg_id)
-                    
-                    if new_messages:
-                        logger.info(f"Found {len(new_messages)} new messages")
-                        # 新しいメッセージをキューに追加
-                        message_queue.put(new_messages)
-                    else:
-                        # メッセージがなければログ
-                        logger.info("No new messages found")
-                        
-                        # Seleniumを使用して直接DOMをチェック
-                        try:
-                            # JavaScriptを実行してメッセージ要素を検出
-                            message_count = driver.execute_script("""
-                                const messages = document.querySelectorAll('.messages .message, .chat-messages .message, .stream-messages .message, [class*="message-item"]');
-                                return messages.length;
-                            """)
-                            logger.info(f"JavaScript detected {message_count} message elements")
-                            
-                        except Exception as js_err:
-                            logger.error(f"JavaScript execution error: {str(js_err)}")
-                    
-                    # チェック時間を更新
-                    last_check_time = current_time
-                
-                # 短い待機で監視ループを継続
-                time.sleep(0.5)
-                
-            except Exception as loop_err:
-                logger.error(f"Error in monitoring loop: {str(loop_err)}")
-                # エラーが発生しても継続
-                time.sleep(1)
+class KeywordFilter:
+    """含める語句・除外する語句・種類・正規表現で新着メッセージを絞り込むキーワードフィルター
+    
+    語句はエスケープして1つの正規表現にまとめ、名前付きグループで区別する。
+    正規表現は利用者のグループ番号が変わらないよう1つずつコンパイルし、メッセージの先頭KEYWORD_MAX_REGEX_TEXT_LENGTH文字に対して照合する。
+    一致した語句・正規表現は各メッセージの複製のkeywordsに記録する（元のメッセージは変更しない）
+    """
+    
+    SPEC_KEYS = ('include', 'exclude', 'patterns', 'exclude_patterns', 'types', 'case_sensitive')
+    
+    def __init__(self, spec=None):
+        spec = spec or {}
+        unknown = set(spec) - set(self.SPEC_KEYS)
+        if unknown:
+            raise ValueError(f"unknown keyword options: {', '.join(sorted(unknown))}")
+        self.include = self._terms(spec.get('include'))
+        self.exclude = self._terms(spec.get('exclude'))
+        self.patterns = self._terms(spec.get('patterns'))
+        self.exclude_patterns = self._terms(spec.get('exclude_patterns'))
+        self.types = self._terms(spec.get('types'))
+        self.case_sensitive = bool(spec.get('case_sensitive', False))
+        if any(t not in KEYWORD_MESSAGE_TYPES for t in self.types):
+            raise ValueError('unknown message type')
+        if len(self.include) + len(self.exclude) + len(self.patterns) + len(self.exclude_patterns) > KEYWORD_MAX_TERMS:
+            raise ValueError('too many keywords')
+        if any(len(p) > KEYWORD_MAX_PATTERN_LENGTH for p in self.patterns + self.exclude_patterns):
+            raise ValueError('pattern too long')
         
-        # 監視終了時にブラウザを閉じる
-        driver.quit()
-        logger.info(f"Monitoring stopped for session {session_id}")
+        flags = 0 if self.case_sensitive else re.IGNORECASE
+        # 同じ位置では長い語句を優先する。グループ名から元の語句を引けるようにしておく
+        self.labels = {}
+        alternatives = []
+        for index, word in enumerate(sorted(self.include, key=len, reverse=True)):
+            self.labels[f'k{index}'] = word
+            alternatives.append(f'(?P<k{index}>{re.escape(word)})')
+        self.include_regex = re.compile('|'.join(alternatives), flags) if alternatives else None
+        self.exclude_regex = re.compile('|'.join(re.escape(word) for word in self.exclude), flags) if self.exclude else None
+        self.include_patterns = [(pattern, check_keyword_pattern(pattern, flags)) for pattern in self.patterns]
+        self.exclude_patterns_compiled = [check_keyword_pattern(pattern, flags) for pattern in self.exclude_patterns]
+        self.allowed_types = frozenset(self.types) if self.types else None
         
-    except Exception as e:
-        logger.error(f"Error in monitoring thread: {str(e)}")
-        import traceback
-        logger.error(traceback.format_exc())
-        # エラー情報をキューに送信
-        message_queue.put({"error": str(e)})
-        # エラーが発生したらブラウザを閉じる
-        try:
-            if driver:
-                driver.quit()
-        except:
-            pass
-
-@app.route('/api/start-monitoring', methods=['POST'])
-def start_monitoring():
-    """モニタリングセッションを開始するエンドポイント"""
-    data = request.json
-    url = data.get('url')
+        self.lock = threading.Lock()
+        self.evaluated = 0
+        self.passed = 0
+        self.dropped_type = 0
+        self.dropped_excluded = 0
+        self.dropped_unmatched = 0
     
-    if not url:
-        return jsonify({"error": "URLが必要です"}), 400
+    @staticmethod
+    def _terms(values):
+        if values is None:
+            return []
+        if isinstance(values, str) or not isinstance(values, (list, tuple)):
+            raise TypeError('keyword lists must be arrays of strings')
+        if not all(isinstance(v, str) for v in values):
+            raise TypeError('keyword lists must be arrays of strings')
+        # 空欄（画面の未入力の欄）と重複は取り除く
+        return list(dict.fromkeys(v.strip() for v in values if v.strip()))
     
-    # 新しいセッションIDを生成
-    session_id = str(uuid.uuid4())
+    @property
+    def enabled(self):
+        return bool(self.include_regex or self.exclude_regex or self.include_patterns or self.exclude_patterns_compiled
+                    or self.allowed_types)
     
-    # セッション用のメッセージキューとストップイベントを作成
-    message_queue = Queue()
-    stop_event = threading.Event()
+    @property
+    def spec(self):
+        """ワーカープロセスへ渡す・共有キーに使う正規化済みの設定"""
+        return {
+            'include': sorted(self.include),
+            'exclude': sorted(self.exclude),
+            'patterns': sorted(self.patterns),
+            'exclude_patterns': sorted(self.exclude_patterns),
+            'types': sorted(self.types),
+            'case_sensitive': self.case_sensitive
+        }
     
-    # セッション情報を保存
-    session_queues[session_id] = message_queue
-    stop_events[session_id] = stop_event
+    @property
+    def fingerprint(self):
+        """設定が同じフィルターで同じ値になる短い識別子（絞り込みがなければNone）"""
+        if not self.enabled:
+            return None
+        canonical = json.dumps(self.spec, ensure_ascii=False, sort_keys=True)
+        return hashlib.blake2b(canonical.encode('utf-8'), digest_size=8).hexdigest()
     
-    # モニタリングスレッドを開始
-    monitoring_thread = threading.Thread(
-        target=monitor_chat,
-        args=(url, session_id, message_queue, stop_event)
-    )
-    monitoring_thread.daemon = True
-    monitoring_thread.start()
+    def apply(self, messages):
+        """条件に合うメッセージだけを返す（含める語句がある場合は、一致した語句をkeywordsに記録した複製を返す）"""
+        if not self.enabled:
+            return messages
+        
+        matched = []
+        passed = dropped_type = dropped_excluded = dropped_unmatched = 0
+        for message in messages:
+            message_type = message.get('type')
+            if message_type not in KEYWORD_MESSAGE_TYPES:
+                # 接続確認などのシステムメッセージは絞り込まない
+                matched.append(message)
+                continue
+            if self.allowed_types is not None and message_type not in self.allowed_types:
+                dropped_type += 1
+                continue
+            text = message.get('text', '')
+            regex_text = text[:KEYWORD_MAX_REGEX_TEXT_LENGTH]
+            if ((self.exclude_regex is not None and self.exclude_regex.search(text))
+                    or any(pattern.search(regex_text) for pattern in self.exclude_patterns_compiled)):
+                dropped_excluded += 1
+                continue
+            if self.include_regex is not None or self.include_patterns:
+                keywords = []
+                if self.include_regex is not None:
+                    keywords.extend(self.labels[m.lastgroup] for m in self.include_regex.finditer(text))
+                keywords.extend(label for label, pattern in self.include_patterns if pattern.search(regex_text))
+                keywords = list(dict.fromkeys(keywords))
+                if not keywords:
+                    dropped_unmatched += 1
+                    continue
+                # 渡されたメッセージは他の共有者や履歴と共有されていることがあるため、複製に記録する
+                message = {**message, 'keywords': keywords}
+            matched.append(message)
+            passed += 1
+        
+        metrics.inc('chat_keyword_dropped_total', dropped_type + dropped_excluded + dropped_unmatched)
+        with self.lock:
+            self.evaluated += passed + dropped_type + dropped_excluded + dropped_unmatched
+            self.passed += passed
+            self.dropped_type += dropped_type
+            self.dropped_excluded += dropped_excluded
+            self.dropped_unmatched += dropped_unmatched
+        return matched
     
-    active_sessions[session_id] = {
-        'thread': monitoring_thread,
-        'url': url,
-        'started_at': datetime.now().isoformat()
-    }
+    def stats(self):
+        with self.lock:
+            return {
+                'enabled': self.enabled,
+                'fingerprint': self.fingerprint,
+                'terms': len(self.include) + len(self.patterns),
+                'exclusions': len(self.exclude) + len(self.exclude_patterns),
+                'types': self.types,
+                'evaluated': self.evaluated,
+                'passed': self.passed,
+                'dropped_type': self.dropped_type,
+                'dropped_excluded': self.dropped_excluded,
+                'dropped_unmatched': self.dropped_unmatched
+            }
+
+# 集計で上位として扱うチップ送信者の人数
+STATS_TOP_TIPPERS = int(os.environ.get('STATS_TOP_TIPPERS', '10'))
+
+class SessionAggregator:
+    """配信したメッセージからユーザーごとのチップ・種類ごとの件数・ルーレットの景品を逐次集計する
     
-    return jsonify({
+    1件あたりの処理は上位リストの大きさにのみ依存する。差分は変更された項目の現在値で表すため、再送されても結果は変わらない
+    """
+    
+    def __init__(self, top_n=None):
+        self.top_n = max(1, int(top_n or STATS_TOP_TIPPERS))
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.coins = 0
+        self.types = {}
+        self.type_coins = {}
+        self.users = {}
+        self.prizes = {}
+        # チップの合計が多い順の(ユーザー名, 枚数)。合計は増える一方なので、上位から外れたユーザーが戻るのは加算時だけ
+        self.top_tippers = []
+    
+    def add(self, messages):
+        """バッチを集計に加え、変更された項目の現在値を返す（集計対象がなければNone）"""
+        changed_types = set()
+        changed_users = set()
+        changed_prizes = set()
+        top_changed = False
+        with self.lock:
+            for message in messages:
+                message_type = message.get('type')
+                username = message.get('username')
+                if message_type not in KEYWORD_MESSAGE_TYPES or not username:
+                    continue
+                amount = message.get('amount') or 0
+                self.messages += 1
+                self.coins += amount
+                self.types[message_type] = self.types.get(message_type, 0) + 1
+                self.type_coins[message_type] = self.type_coins.get(message_type, 0) + amount
+                changed_types.add(message_type)
+                
+                user = self.users.get(username)
+                if user is None:
+                    user = self.users[username] = {'coins': 0, 'count': 0}
+                user['coins'] += amount
+                user['count'] += 1
+                changed_users.add(username)
+                if amount:
+                    top_changed = self._update_top(username, user['coins']) or top_changed
+                
+                prize = message.get('prize')
+                if prize:
+                    self.prizes[prize] = self.prizes.get(prize, 0) + 1
+                    changed_prizes.add(prize)
+            
+            if not changed_users:
+                return None
+            delta = {
+                'messages': self.messages,
+                'coins': self.coins,
+                'user_count': len(self.users),
+                'types': {t: {'count': self.types[t], 'coins': self.type_coins[t]} for t in changed_types},
+                'users': {u: dict(self.users[u]) for u in changed_users}
+            }
+            if changed_prizes:
+                delta['prizes'] = {p: self.prizes[p] for p in changed_prizes}
+            if top_changed:
+                delta['top_tippers'] = self._top_list()
+            return delta
+    
+    @classmethod
+    def from_checkpoint(cls, snapshot):
+        """snapshot()の値から集計を復元する"""
+        aggregator = cls()
+        aggregator.messages = snapshot['messages']
+        aggregator.coins = snapshot['coins']
+        for message_type, stats in snapshot['types'].items():
+            aggregator.types[message_type] = stats['count']
+            aggregator.type_coins[message_type] = stats['coins']
+        aggregator.users = {username: dict(stats) for username, stats in snapshot['users'].items()}
+        aggregator.prizes = dict(snapshot['prizes'])
+        aggregator.top_tippers = [(entry['username'], entry['coins']) for entry in snapshot['top_tippers']]
+        return aggregator
+    
+    def _update_top(self, username, coins):
+        """上位リストを更新し、変わったかを返す（ロックを保持した状態で呼ばれる）"""
+        for index, (name, _) in enumerate(self.top_tippers):
+            if name == username:
+                self.top_tippers[index] = (username, coins)
+                break
+        else:
+            if len(self.top_tippers) >= self.top_n and coins <= self.top_tippers[-1][1]:
+                return False
+            self.top_tippers.append((username, coins))
+        self.top_tippers.sort(key=lambda entry: -entry[1])
+        del self.top_tippers[self.top_n:]
+        return True
+    
+    def _top_list(self):
+        return [{'username': name, 'coins': coins} for name, coins in self.top_tippers]
+    
+    def snapshot(self):
+        """集計全体（差分を適用する前の初期状態として使える）"""
+        with self.lock:
+            return {
+                'messages': self.messages,
+                'coins': self.coins,
+                'user_count': len(self.users),
+                'types': {t: {'count': self.types[t], 'coins': self.type_coins[t]} for t in self.types},
+                'users': {u: dict(stats) for u, stats in self.users.items()},
+                'prizes': dict(self.prizes),
+                'top_tippers': self._top_list()
+            }
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'messages': self.messages,
+                'coins': self.coins,
+                'users': len(self.users),
+                'prizes': len(self.prizes)
+            }
+
+# 購読者ごとのリングバッファの大きさ（バッチ数）と、溢れたときの扱い
+# drop_oldest: 古いバッチを捨てて配信を続ける / disconnect: 購読を切断する
+SUBSCRIBER_BUFFER_SIZE = int(os.environ.get('SUBSCRIBER_BUFFER_SIZE', '256'))
+SLOW_CONSUMER_POLICIES = ('drop_oldest', 'disconnect')
+SLOW_CONSUMER_POLICY = os.environ.get('SLOW_CONSUMER_POLICY', 'drop_oldest')
+# 再接続時の再送用に保持するバッチ数
+REPLAY_BUFFER_SIZE = int(os.environ.get('REPLAY_BUFFER_SIZE', '1024'))
+# 配信に追いついている購読者が、続けて届くバッチを1つのフレームにまとめるために待つ秒数（0ならまとめない）
+SSE_COALESCE_WINDOW = float(os.environ.get('SSE_COALESCE_WINDOW', '0.1'))
+# SSEの圧縮（Accept-Encodingでgzip/deflateを受け付けるクライアントのみ）
+SSE_COMPRESSION = os.environ.get('SSE_COMPRESSION', '1') == '1'
+SSE_COMPRESSION_LEVEL = int(os.environ.get('SSE_COMPRESSION_LEVEL', '6'))
+# 圧縮方式ごとのzlibのwbits（優先順。HTTPのdeflateはzlib形式）
+SSE_ENCODINGS = {'gzip': 31, 'deflate': 15}
+
+class Subscription:
+    """ブロードキャストハブの購読者1人分の受信バッファ"""
+    
+    def __init__(self, hub, subscriber_id, capacity):
+        self.hub = hub
+        self.subscriber_id = subscriber_id
+        self.capacity = capacity
+        self.buffer = deque()
+        self.condition = threading.Condition(hub.lock)
+        self.waiters = set()
+        self.closed = False
+        self.close_reason = None
+        # 再送しきれなかった場合の、再送できた最初のイベントID
+        self.replay_gap = None
+        # 購読開始時に再送ログから積んだ最後のイベントID
+        self.replayed_until = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.connected_at = datetime.now().isoformat()
+    
+    def _offer(self, entry):
+        """(イベントID, バッチ)をバッファに積む（ハブのロックを保持した状態で呼ばれる）。切断すべきならFalseを返す"""
+        if len(self.buffer) >= self.capacity:
+            if self.hub.policy == 'disconnect':
+                self._close('slow_consumer')
+                return False
+            self.buffer.popleft()
+            self.dropped += 1
+        self.buffer.append(entry)
+        self._wake()
+        return True
+    
+    def _close(self, reason):
+        self.closed = True
+        self.close_reason = reason
+        self._wake()
+    
+    def _wake(self):
+        self.condition.notify_all()
+        for loop, event in list(self.waiters):
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # ループが既に閉じられている
+                self.waiters.discard((loop, event))
+    
+    def get_nowait(self):
+        """バッファから(イベントID, バッチ)を1件取り出す（空ならEmpty）"""
+        with self.hub.lock:
+            if not self.buffer:
+                raise Empty
+            self.delivered += 1
+            return self.buffer.popleft()
+    
+    def get(self, timeout=None):
+        """バッファから(イベントID, バッチ)を1件取り出す（届くか閉じられるまで待つ。タイムアウトしたらEmpty）"""
+        with self.hub.lock:
+            if not self.buffer and not self.closed:
+                self.condition.wait(timeout)
+            if not self.buffer:
+                raise Empty
+            self.delivered += 1
+            return self.buffer.popleft()
+    
+    def drain_nowait(self):
+        """バッファにある(イベントID, バッチ)をすべて取り出す（空なら空のリスト）"""
+        with self.hub.lock:
+            entries = list(self.buffer)
+            self.buffer.clear()
+            self.delivered += len(entries)
+            return entries
+    
+    def drain(self, timeout=None, linger=0):
+        """バッファにある(イベントID, バッチ)をすべて取り出す
+    
+        空なら届くか閉じられるまで待ち（タイムアウトしたら空のリスト）、待った場合はさらにlinger秒だけ後続のバッチを待つ
+        """
+        with self.hub.lock:
+            if not self.buffer and not self.closed:
+                self.condition.wait(timeout)
+                if self.buffer and linger > 0:
+                    deadline = time.monotonic() + linger
+                    while not self.closed:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self.condition.wait(remaining)
+            entries = list(self.buffer)
+            self.buffer.clear()
+            self.delivered += len(entries)
+            return entries
+    
+    def add_waiter(self, loop, event):
+        """イベントループとasyncio.Eventを登録する（到着時にループのスレッドでsetされる）"""
+        with self.hub.lock:
+            self.waiters.add((loop, event))
+    
+    def remove_waiter(self, loop, event):
+        with self.hub.lock:
+            self.waiters.discard((loop, event))
+    
+    def stats(self):
+        return {
+            'subscriber_id': self.subscriber_id,
+            'connected_at': self.connected_at,
+            'buffered': len(self.buffer),
+            'delivered': self.delivered,
+            'dropped': self.dropped
+        }
+
+class BroadcastHub:
+    """セッションのメッセージを全購読者へ配信するハブ（抽出は1回、購読者ごとに有界バッファを持つ）
+    
+    バッチには単調増加のイベントIDを振り、直近のバッチを再送用に保持する
+    """
+    
+    def __init__(self, capacity=None, policy=None, replay_size=None, archive=None, aggregator=None):
+        self.capacity = int(capacity or SUBSCRIBER_BUFFER_SIZE)
+        self.policy = policy or SLOW_CONSUMER_POLICY
+        if self.capacity <= 0 or self.policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError('invalid broadcast hub settings')
+        self.lock = threading.Lock()
+        self.subscribers = {}
+        # 再接続した購読者に取りこぼした分を送るための再送ログ
+        self.replay = deque(maxlen=int(replay_size or REPLAY_BUFFER_SIZE))
+        self.last_event_id = 0
+        self.next_subscriber_id = 1
+        self.closed = False
+        # 購読者がいなくなった時刻（放置セッションの回収に使う。作成直後も購読者がいない状態として扱う）
+        self.idle_since = time.time()
+        self.published = 0
+        self.peak_subscribers = 0
+        self.total_subscriptions = 0
+        self.slow_disconnects = 0
+        # 配信までの時間を記録済みのイベントID（バッチごとに最初に送った購読者の分だけ記録する）
+        self.emit_observed_until = 0
+        # 配信したバッチを履歴として保存する関数と、集計器（指定がなければ保存・集計しない）
+        self.archive = archive
+        self.aggregator = aggregator
+    
+    def put(self, item):
+        """イベントIDを振って全購読者のバッファにバッチを配信する（監視スレッドから呼ばれる）
+        
+        集計器があれば、メッセージのバッチに続けて集計の差分を {'stats': 差分} として配信する
+        """
+        if self.archive is not None:
+            self.archive(item)
+        delta = self.aggregator.add(item) if self.aggregator is not None and isinstance(item, list) else None
+        with self.lock:
+            self._publish(item)
+            if delta:
+                self._publish({'stats': delta})
+            if not self.subscribers and self.idle_since is None:
+                self.idle_since = time.time()
+    
+    def _publish(self, item):
+        self.published += 1
+        self.last_event_id += 1
+        entry = (self.last_event_id, item)
+        self.replay.append(entry)
+        for subscription in list(self.subscribers.values()):
+            if not subscription._offer(entry):
+                logger.warning(f"Disconnecting slow subscriber {subscription.subscriber_id} ({len(subscription.buffer)} batches buffered)")
+                self.slow_disconnects += 1
+                del self.subscribers[subscription.subscriber_id]
+    
+    def subscribe(self, last_event_id=None):
+        """新しい購読者を登録する（last_event_idより後のバッチを再送ログから先に積む。指定がなければ再送ログ全体）"""
+        with self.lock:
+            subscription = Subscription(self, self.next_subscriber_id, self.capacity)
+            self.next_subscriber_id += 1
+            self.total_subscriptions += 1
+            if self.closed:
+                subscription._close('session_stopped')
+                return subscription
+            # クライアントのIDがこのハブより先に進んでいる場合は別のハブのIDなので、全体を再送する
+            if last_event_id is None or last_event_id > self.last_event_id:
+                last_event_id = 0
+            missed = [entry for entry in self.replay if entry[0] > last_event_id]
+            if missed and missed[0][0] > last_event_id + 1 and last_event_id > 0:
+                subscription.replay_gap = missed[0][0]
+            subscription.buffer.extend(missed)
+            subscription.replayed_until = missed[-1][0] if missed else 0
+            self.subscribers[subscription.subscriber_id] = subscription
+            self.idle_since = None
+            self.peak_subscribers = max(self.peak_subscribers, len(self.subscribers))
+            return subscription
+    
+    def unsubscribe(self, subscription):
+        """購読を解除し、残りの購読者数を返す"""
+        with self.lock:
+            self.subscribers.pop(subscription.subscriber_id, None)
+            if not subscription.closed:
+                subscription._close('unsubscribed')
+            if not self.subscribers and self.idle_since is None:
+                self.idle_since = time.time()
+            return len(self.subscribers)
+    
+    def subscriber_count(self):
+        return len(self.subscribers)
+    
+    def idle_seconds(self, now=None):
+        """購読者がいない状態が続いている秒数（購読者がいれば0）"""
+        idle_since = self.idle_since
+        if idle_since is None:
+            return 0
+        return (now if now is not None else time.time()) - idle_since
+    
+    def close(self):
+        """セッション停止時に全購読者を閉じる"""
+        with self.lock:
+            self.closed = True
+            for subscription in self.subscribers.values():
+                subscription._close('session_stopped')
+            self.subscribers.clear()
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'subscribers': len(self.subscribers),
+                'peak_subscribers': self.peak_subscribers,
+                'total_subscriptions': self.total_subscriptions,
+                'published': self.published,
+                'last_event_id': self.last_event_id,
+                'replay_size': len(self.replay),
+                'replay_capacity': self.replay.maxlen,
+                'buffer_size': self.capacity,
+                'slow_consumer_policy': self.policy,
+                'slow_disconnects': self.slow_disconnects,
+                'dropped': sum(s.dropped for s in self.subscribers.values()),
+                'details': [s.stats() for s in self.subscribers.values()]
+            }
+
+def sse_event(payload, event_id=None, compact=False):
+    """SSEのイベント1件分の文字列を作る（イベントIDがあればid行を付ける。簡易形式では空白とエスケープを省く）"""
+    metrics.inc('chat_sse_events_total', type=payload.get('type'))
+    data = json.dumps(payload, ensure_ascii=False, separators=(',', ':')) if compact else json.dumps(payload)
+    if event_id is not None:
+        return f"id: {event_id}\ndata: {data}\n\n"
+    return f"data: {data}\n\n"
+
+def observe_emit_latency(subscription, event_id, messages):
+    """メッセージの抽出から最初の購読者への配信までの時間を、バッチごとに1回記録する（再接続時に再送したバッチは除く）
+    
+    購読者ごとに記録すると、購読者の多いセッションほど件数が膨らみ分布が偏るため
+    """
+    if event_id <= subscription.replayed_until or not messages:
+        return
+    try:
+        extracted_at = datetime.fromisoformat(messages[0]['timestamp']).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return
+    hub = subscription.hub
+    with hub.lock:
+        if event_id <= hub.emit_observed_until:
+            return
+        hub.emit_observed_until = event_id
+    metrics.observe('chat_emit_latency_seconds', max(0.0, time.time() - extracted_at))
+
+def parse_last_event_id(value):
+    """Last-Event-IDヘッダーまたはクエリの値を整数に変換する（不正な値は無視）"""
+    try:
+        return int(value) if value not in (None, '') else None
+    except (TypeError, ValueError):
+        return None
+
+def negotiate_sse_encoding(accept_encoding):
+    """Accept-EncodingからSSEの圧縮方式を選ぶ（gzipを優先し、q=0は受け付けないものとして扱う。圧縮しないならNone）"""
+    if not SSE_COMPRESSION or not accept_encoding:
+        return None
+    accepted = {}
+    for part in accept_encoding.split(','):
+        name, _, params = part.partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name.strip().lower()] = quality
+    for encoding in SSE_ENCODINGS:
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+def merge_stats_delta(merged, delta):
+    """集計の差分を重ねる（後の差分の現在値で上書きし、項目ごとの辞書は結合する。再送ログの差分は変更しない）"""
+    if merged is None:
+        return {key: dict(value) if isinstance(value, dict) else value for key, value in delta.items()}
+    for key, value in delta.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key].update(value)
+        else:
+            merged[key] = value
+    return merged
+
+# 簡易形式の1行に並べる項目の順（種類は表の番号、時刻は基準時刻からのミリ秒。末尾のNoneは省く）
+SSE_COMPACT_FIELDS = ('id', 'type', 'timestamp', 'text', 'username', 'amount', 'comment', 'prize', 'keywords')
+
+def compact_messages(messages):
+    """メッセージを簡易形式にする（{'t': 基準時刻のミリ秒, 'y': 種類の表, 'r': 行}。checkedは配信時点で常にFalseなので省く）"""
+    types = []
+    type_indexes = {}
+    rows = []
+    base = None
+    for message in messages:
+        try:
+            at = int(datetime.fromisoformat(message['timestamp']).timestamp() * 1000)
+        except (KeyError, TypeError, ValueError):
+            at = None
+        if base is None:
+            base = at
+        message_type = message.get('type')
+        type_index = type_indexes.get(message_type)
+        if type_index is None:
+            type_index = type_indexes[message_type] = len(types)
+            types.append(message_type)
+        row = [message.get('id'), type_index, at - base if at is not None and base is not None else None,
+               message.get('text'), message.get('username'), message.get('amount'), message.get('comment'),
+               message.get('prize'), message.get('keywords')]
+        while row[-1] is None:
+            row.pop()
+        rows.append(row)
+    return {'t': base, 'y': types, 'r': rows}
+
+class SseEncoder:
+    """購読バッファから取り出したバッチをSSEのバイト列にするエンコーダー（接続ごとに1つ）
+    
+    一度に取り出した複数のバッチは、メッセージ・集計の差分ごとに1つのイベントへまとめる。
+    まとめたイベントには含めた最後のイベントIDを付けるため、再接続時の再送位置は変わらない
+    """
+    
+    def __init__(self, compact=False, encoding=None):
+        self.compact = compact
+        self.encoding = encoding
+        self.compressor = (zlib.compressobj(SSE_COMPRESSION_LEVEL, zlib.DEFLATED, SSE_ENCODINGS[encoding])
+                           if encoding else None)
+    
+    @property
+    def headers(self):
+        """レスポンスに加えるヘッダー（圧縮する場合のみ）"""
+        if self.encoding is None:
+            return {}
+        return {'Content-Encoding': self.encoding, 'Vary': 'Accept-Encoding'}
+    
+    def event(self, payload, event_id=None):
+        """制御用のイベント（connected・keepaliveなど）1件"""
+        return self._encode(sse_event(payload, event_id, self.compact))
+    
+    def batch(self, entries, subscription):
+        """(イベントID, バッチ)の列をまとめたイベントにし、(バイト列, エラーで終了したか)を返す"""
+        messages = []
+        messages_id = None
+        stats = None
+        stats_id = None
+        error = None
+        for event_id, item in entries:
+            if isinstance(item, dict) and 'error' in item:
+                error = (event_id, item['error'])
+                break
+            if isinstance(item, dict) and 'stats' in item:
+                stats = merge_stats_delta(stats, item['stats'])
+                stats_id = event_id
+                continue
+            observe_emit_latency(subscription, event_id, item)
+            messages.extend(item)
+            messages_id = event_id
+        
+        events = []
+        if messages_id is not None:
+            payload = ({'type': 'messages', **compact_messages(messages)} if self.compact
+                       else {'type': 'messages', 'messages': messages})
+            events.append((messages_id, payload))
+        if stats_id is not None:
+            events.append((stats_id, {'type': 'stats', 'stats': stats}))
+        # 最後のイベントのIDが最大になるよう、ID順に並べる
+        events.sort(key=lambda event: event[0])
+        if error is not None:
+            events.append((error[0], {'type': 'error', 'error': error[1]}))
+        return self._encode(''.join(sse_event(payload, event_id, self.compact) for event_id, payload in events)), error is not None
+    
+    def finish(self):
+        """圧縮ストリームの終端（圧縮しない場合は空）"""
+        if self.compressor is None:
+            return b''
+        data = self.compressor.flush()
+        metrics.inc('chat_sse_sent_bytes_total', len(data), encoding=self.encoding)
+        return data
+    
+    def _encode(self, text):
+        data = text.encode('utf-8')
+        encoding = self.encoding or 'identity'
+        metrics.inc('chat_sse_payload_bytes_total', len(data), encoding=encoding)
+        if self.compressor is not None:
+            # クライアントがすぐに展開できるよう、フレームごとに圧縮ブロックを区切る
+            data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        metrics.inc('chat_sse_sent_bytes_total', len(data), encoding=encoding)
+        return data
+
+class CdpBindingListener:
+    """CDPのRuntime.bindingCalledイベントを購読し、ページからプッシュされたデータを受け取るリスナー"""
+    
+    def __init__(self, driver, binding_name, on_payload, stop_event):
+        self.binding_name = binding_name
+        self.on_payload = on_payload
+        self.stop_event = stop_event
+        self.ready = threading.Event()
+        self.error = None
+        self._next_id = 0
+        
+        # WebDriverが操作しているタブのCDPターゲットに直接接続する
+        debugger_address = driver.capabilities.get('goog:chromeOptions', {}).get('debuggerAddress')
+        if not debugger_address:
+            raise RuntimeError("Chrome debugger address is not available")
+        target_id = driver.execute_cdp_cmd('Target.getTargetInfo', {})['targetInfo']['targetId']
+        self.ws_url = f"ws://{debugger_address}/devtools/page/{target_id}"
+        self.thread = threading.Thread(target=self._run, daemon=True)
+    
+    def start(self, timeout=10):
+        """リスナースレッドを開始し、バインディングが登録されるまで待機する"""
+        self.thread.start()
+        self.ready.wait(timeout)
+        if self.error:
+            raise self.error
+        return self.ready.is_set()
+    
+    def _run(self):
+        import trio
+        try:
+            trio.run(self._listen)
+        except Exception as e:
+            self.error = e
+            logger.error(f"CDP binding listener stopped: {str(e)}")
+        finally:
+            self.ready.set()
+            # 待機中の監視ループを起こす
+            self.on_payload(None)
+    
+    async def _call(self, ws, method, params):
+        """CDPコマンドを送信し、応答が返るまでの間に届いたイベントも処理する"""
+        self._next_id += 1
+        command_id = self._next_id
+        await ws.send_message(json.dumps({'id': command_id, 'method': method, 'params': params}))
+        while True:
+            message = json.loads(await ws.get_message())
+            if message.get('id') == command_id:
+                if 'error' in message:
+                    raise RuntimeError(f"CDP {method} failed: {message['error']}")
+                return message.get('result', {})
+            self._handle_event(message)
+    
+    def _handle_event(self, message):
+        if message.get('method') != 'Runtime.bindingCalled':
+            return
+        params = message.get('params', {})
+        if params.get('name') == self.binding_name:
+            self.on_payload(params.get('payload'))
+    
+    async def _listen(self):
+        import trio
+        from trio_websocket import open_websocket_url
+        
+        async with open_websocket_url(self.ws_url, max_message_size=2 ** 24) as ws:
+            await self._call(ws, 'Runtime.enable', {})
+            await self._call(ws, 'Runtime.addBinding', {'name': self.binding_name})
+            logger.info(f"CDP binding '{self.binding_name}' registered at {self.ws_url}")
+            self.ready.set()
+            
+            async with trio.open_nursery() as nursery:
+                # 停止イベントを別スレッドで待ち、セットされたら受信ループをキャンセル
+                async def wait_for_stop():
+                    await trio.to_thread.run_sync(self.stop_event.wait, cancellable=True)
+                    nursery.cancel_scope.cancel()
+                
+                nursery.start_soon(wait_for_stop)
+                while True:
+                    self._handle_event(json.loads(await ws.get_message()))
+
+def find_free_port():
+    """空いているローカルポートを取得する（リモートデバッグポートの動的割り当て用）"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+# ブラウザのプロファイル
+# standard: ページをそのまま読み込む / lean: 画像・動画・音声・フォント・トラッカーを読み込まず、小さな画面で動画を再生しない
+# （チャットのDOMだけを読むため、監視タブで最もCPUを使う動画のデコードを止める）
+BROWSER_PROFILES = ('standard', 'lean')
+DEFAULT_BROWSER_PROFILE = os.environ.get('BROWSER_PROFILE', 'standard')
+LEAN_WINDOW_SIZE = os.environ.get('LEAN_WINDOW_SIZE', '800,600')
+# leanプロファイルのタブで読み込みを止めるURLのパターン（CDPのNetwork.setBlockedURLs形式。LEAN_EXTRA_BLOCKED_URLSで追加できる）
+LEAN_BLOCKED_URLS = [
+    # 画像
+    '*.jpg', '*.jpeg', '*.png', '*.gif', '*.webp', '*.avif', '*.bmp', '*.ico', '*.svg',
+    # 動画・音声（HLS/DASHのプレイリストとセグメントを含む）
+    '*.mp4', '*.webm', '*.m4s', '*.m4v', '*.m3u8', '*.mpd', '*.ts', '*.aac', '*.mp3', '*.ogg',
+    # フォント
+    '*.woff', '*.woff2', '*.ttf', '*.otf', '*.eot',
+    # 計測・広告
+    '*google-analytics.com*', '*googletagmanager.com*', '*doubleclick.net*', '*googlesyndication.com*',
+    '*facebook.net*', '*hotjar.com*', '*scorecardresearch.com*', '*clarity.ms*',
+] + [pattern for pattern in os.environ.get('LEAN_EXTRA_BLOCKED_URLS', '').split(',') if pattern]
+# leanプロファイルのタブで、ページのスクリプトより先に実行して動画・音声を再生させないスクリプト
+LEAN_MEDIA_SCRIPT = """
+    HTMLMediaElement.prototype.play = function () {
+        this.pause();
+        return Promise.resolve();
+    };
+    Object.defineProperty(HTMLMediaElement.prototype, 'autoplay', { get: () => false, set: () => {} });
+"""
+
+def build_chrome_options(debug_port, user_data_dir, profile='standard'):
+    """プールで起動するChromeの起動オプションを構築する"""
+    # ブラウザの設定
+    chrome_options = Options()
+    chrome_options.add_argument("--headless=new")  # 新しいヘッドレスモード
+    chrome_options.add_argument("--no-sandbox")
+    chrome_options.add_argument("--disable-dev-shm-usage")
+    chrome_options.add_argument("--disable-gpu")
+    if profile == 'lean':
+        # 小さな画面で描画量を減らし、画像・Webフォントを読み込まず、動画・音声を自動再生しない
+        chrome_options.add_argument(f"--window-size={LEAN_WINDOW_SIZE}")
+        chrome_options.add_argument("--blink-settings=imagesEnabled=false")
+        chrome_options.add_argument("--disable-remote-fonts")
+        chrome_options.add_argument("--autoplay-policy=user-gesture-required")
+        chrome_options.add_experimental_option('prefs', {'profile.managed_default_content_settings.images': 2})
+        # タブごとの受信バイト数を数えるため、ネットワークのイベントだけをパフォーマンスログに記録する
+        chrome_options.set_capability('goog:loggingPrefs', {'performance': 'ALL'})
+        chrome_options.add_experimental_option('perfLoggingPrefs', {'enableNetwork': True, 'enablePage': False})
+    else:
+        chrome_options.add_argument("--window-size=1920,1080")
+
+    # 重要: レンダラーの問題を回避するための設定
+    chrome_options.add_argument("--disable-extensions")
+    chrome_options.add_argument("--disable-infobars")
+    chrome_options.add_argument("--mute-audio")
+    chrome_options.add_argument("--disable-browser-side-navigation")
+    chrome_options.add_argument("--disable-features=VizDisplayCompositor")
+    chrome_options.add_argument("--disable-web-security")
+    chrome_options.add_argument("--disable-features=IsolateOrigins,site-per-process")
+
+    # 1つのブラウザで複数タブを監視するため、非アクティブタブのスロットリングを無効化
+    chrome_options.add_argument("--disable-background-timer-throttling")
+    chrome_options.add_argument("--disable-backgrounding-occluded-windows")
+    chrome_options.add_argument("--disable-renderer-backgrounding")
+
+    # メモリ使用量を最適化
+    chrome_options.add_argument("--js-flags=--max-old-space-size=512")
+    chrome_options.add_argument("--memory-pressure-off")
+
+    # 安定性のための設定
+    chrome_options.add_argument("--disable-setuid-sandbox")
+    chrome_options.add_argument("--ignore-certificate-errors")
+    chrome_options.add_argument("--disable-accelerated-2d-canvas")
+    chrome_options.add_argument("--disable-accelerated-jpeg-decoding")
+    chrome_options.add_argument("--disable-accelerated-mjpeg-decode")
+    chrome_options.add_argument("--disable-accelerated-video-decode")
+    chrome_options.add_argument("--disable-gpu-compositing")
+
+    # インスタンスごとにデバッグポートとプロファイルを分ける（同時起動時の衝突を防止）
+    chrome_options.add_argument(f"--remote-debugging-port={debug_port}")
+    chrome_options.add_argument(f"--user-data-dir={user_data_dir}")
+
+    # UAを設定
+    chrome_options.add_argument("user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36")
+
+    # ページロード戦略を設定
+    chrome_options.page_load_strategy = 'eager'  # DOMContentLoadedイベント時に読み込み完了とみなす
+
+    # 環境変数をチェック
+    chrome_binary = os.environ.get('CHROME_BIN', '/usr/bin/google-chrome')
+
+    # バイナリの場所を明示的に設定
+    chrome_options.binary_location = chrome_binary
+
+    return chrome_options
+
+def process_children():
+    """/procから親プロセスID -> 子プロセスIDのリストを作る（/procが読めない環境ではNone）"""
+    children = {}
+    try:
+        pids = [int(name) for name in os.listdir('/proc') if name.isdigit()]
+    except OSError:
+        return None
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/stat', 'rb') as f:
+                # コマンド名に空白や括弧が含まれることがあるため、最後の')'の後から読む
+                fields = f.read().rsplit(b')', 1)[1].split()
+            children.setdefault(int(fields[1]), []).append(pid)
+        except (OSError, IndexError, ValueError):
+            continue
+    return children
+
+def process_tree_rss(root_pid, children=None):
+    """プロセスとその子孫の常駐メモリ（バイト）の合計を返す（/procが読めない環境ではNone）"""
+    children = children if children is not None else process_children()
+    if children is None:
+        return None
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    total = 0
+    pending = [root_pid]
+    while pending:
+        pid = pending.pop()
+        try:
+            with open(f'/proc/{pid}/statm', 'rb') as f:
+                total += int(f.read().split()[1]) * page_size
+        except (OSError, IndexError, ValueError):
+            continue
+        pending.extend(children.get(pid, []))
+    return total
+
+class PooledBrowser:
+    """プールが管理するChromeインスタンス（1つのWebDriverを複数セッションのタブで共有する）"""
+    
+    def __init__(self, browser_id, network_capture=False, profile='standard'):
+        self.browser_id = browser_id
+        self.network_capture = network_capture
+        self.profile = profile
+        self.debug_port = find_free_port()
+        self.user_data_dir = tempfile.mkdtemp(prefix='chat-monitor-chrome-')
+        self.lock = threading.RLock()
+        self.tabs = {}
+        # 割り当てが決まり、まだタブを開いていない件数（プールのロック取得中に増減する）
+        self.pending_tabs = 0
+        self.sessions_served = 0
+        self.started_at = time.time()
+        self.healthy = True
+        self.draining = False
+        self.current_handle = None
+        
+        chrome_options = build_chrome_options(self.debug_port, self.user_data_dir, profile)
+        logger.info(f"Starting Chrome {browser_id} ({profile} profile) on debugging port {self.debug_port}")
+        logger.info(f"Chrome options: {', '.join(chrome_options.arguments)}")
+        
+        # WebDriverの設定
+        service = Service(CHROMEDRIVER_PATH)
+        if network_capture:
+            # 通信傍受用にselenium-wireのプロキシ経由で起動する
+            from seleniumwire import webdriver as wire_webdriver
+            self.driver = wire_webdriver.Chrome(service=service, options=chrome_options,
+                                                seleniumwire_options=NETWORK_CAPTURE_OPTIONS)
+            self.driver.scopes = NETWORK_CAPTURE_SCOPES
+        else:
+            self.driver = webdriver.Chrome(service=service, options=chrome_options)
+        
+        # 最初のタブはホームとして残す（最後のタブを閉じるとセッションが終了するため）
+        self.home_handle = self.driver.current_window_handle
+        self.current_handle = self.home_handle
+        
+        # ブラウザバージョン情報を取得
+        version = self.driver.capabilities.get('browserVersion', 'unknown')
+        driver_version = self.driver.capabilities.get('chrome', {}).get('chromedriverVersion', 'unknown')
+        logger.info(f"Chrome {browser_id} started (Chrome version: {version}, ChromeDriver version: {driver_version})")
+    
+    def switch_to(self, handle):
+        """操作対象のタブに切り替える（ロック取得中に呼び出すこと）"""
+        if self.current_handle != handle:
+            self.driver.switch_to.window(handle)
+            self.current_handle = handle
+    
+    def open_tab(self, session_id):
+        """セッション用の新しいタブを開く"""
+        with self.lock:
+            self.driver.switch_to.new_window('tab')
+            handle = self.driver.current_window_handle
+            self.current_handle = handle
+            tab = BrowserTab(self, handle, session_id)
+            try:
+                # パフォーマンスログのイベントをタブごとに振り分けるため、タブのターゲットIDを控える
+                tab.target_id = self.driver.execute_cdp_cmd('Target.getTargetInfo', {})['targetInfo']['targetId']
+                if self.profile == 'lean':
+                    # 画像・動画・フォント・トラッカーの読み込みを止め、ページのスクリプトより先に再生を無効にする
+                    self.driver.execute_cdp_cmd('Network.enable', {})
+                    self.driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': LEAN_BLOCKED_URLS})
+                    self.driver.execute_cdp_cmd('Page.addScriptToEvaluateOnNewDocument', {'source': LEAN_MEDIA_SCRIPT})
+            except Exception as e:
+                logger.warning(f"Failed to prepare {self.profile} tab for session {session_id}: {str(e)}")
+            self.tabs[handle] = tab
+            self.sessions_served += 1
+            return tab
+    
+    def close_tab(self, handle):
+        """タブを閉じてホームタブに戻る"""
+        with self.lock:
+            self.tabs.pop(handle, None)
+            try:
+                self.switch_to(handle)
+                self.driver.close()
+            finally:
+                self.current_handle = None
+                self.switch_to(self.home_handle)
+    
+    def check_health(self):
+        """WebDriverへの往復で応答を確認する"""
+        try:
+            with self.lock:
+                self.driver.window_handles
+            self.healthy = True
+        except Exception as e:
+            logger.warning(f"Health check failed for Chrome {self.browser_id}: {str(e)}")
+            self.healthy = False
+        return self.healthy
+    
+    def rss_bytes(self, children=None):
+        """ChromeDriverと、そこから起動したChromeのプロセス全体の常駐メモリ（バイト）"""
+        process = getattr(self.driver.service, 'process', None)
+        return process_tree_rss(process.pid, children) if process is not None else None
+    
+    def collect_network_usage(self):
+        """溜まったパフォーマンスログを読み、受信バイト数と読み込みを止めたリクエスト数をタブごとに加算する（leanプロファイルのみ）"""
+        if self.profile != 'lean':
+            return
+        with self.lock:
+            entries = self.driver.get_log('performance')
+            tabs = {tab.target_id: tab for tab in self.tabs.values() if tab.target_id}
+        
+        received = blocked = 0
+        for entry in entries:
+            try:
+                record = json.loads(entry['message'])
+            except (KeyError, ValueError):
+                continue
+            tab = tabs.get(record.get('webview'))
+            event = record.get('message') or {}
+            params = event.get('params') or {}
+            method = event.get('method')
+            if method == 'Network.loadingFinished':
+                # 圧縮された状態で受信したサイズ（ヘッダーを含む）
+                size = int(params.get('encodedDataLength') or 0)
+            elif method == 'Network.webSocketFrameReceived':
+                size = len((params.get('response') or {}).get('payloadData', ''))
+            elif method == 'Network.loadingFailed' and params.get('blockedReason'):
+                blocked += 1
+                if tab is not None:
+                    tab.requests_blocked += 1
+                continue
+            else:
+                continue
+            received += size
+            if tab is not None:
+                tab.bytes_downloaded += size
+        
+        metrics.inc('chat_chrome_downloaded_bytes_total', received, profile=self.profile)
+        metrics.inc('chat_chrome_blocked_requests_total', blocked, profile=self.profile)
+    
+    def quit(self):
+        """Chromeを終了し、プロファイルディレクトリを削除する"""
+        try:
+            self.driver.quit()
+        except Exception as e:
+            logger.error(f"Error quitting Chrome {self.browser_id}: {str(e)}")
+        shutil.rmtree(self.user_data_dir, ignore_errors=True)
+        logger.info(f"Chrome {self.browser_id} stopped")
+
+class BrowserTab:
+    """セッションに割り当てられたタブ（monitor_chatからはWebDriverと同じように扱う）"""
+    
+    # ページを開いた後、チャットが表示されるまで待つ時間（秒）
+    load_wait = 10
+    
+    def __init__(self, browser, handle, session_id):
+        self.browser = browser
+        self.handle = handle
+        self.session_id = session_id
+        self.closed = False
+        self.target_id = None
+        # パフォーマンスログから集計したタブの受信バイト数と、読み込みを止めたリクエスト数（leanプロファイルのみ）
+        self.bytes_downloaded = 0
+        self.requests_blocked = 0
+        # プールのメンテナンスで最後に読んだJavaScriptヒープの使用量（DOMや画像などレンダラーの他のメモリは含まない）
+        self.js_heap_used = None
+    
+    @property
+    def capabilities(self):
+        return self.browser.driver.capabilities
+    
+    @property
+    def page_source(self):
+        with self.browser.lock:
+            self.browser.switch_to(self.handle)
+            return self.browser.driver.page_source
+    
+    def get(self, url):
+        with self.browser.lock:
+            self.browser.switch_to(self.handle)
+            return self.browser.driver.get(url)
+    
+    def refresh(self):
+        with self.browser.lock:
+            self.browser.switch_to(self.handle)
+            return self.browser.driver.refresh()
+    
+    def execute_script(self, script, *args):
+        with self.browser.lock:
+            self.browser.switch_to(self.handle)
+            return self.browser.driver.execute_script(script, *args)
+    
+    def execute_cdp_cmd(self, cmd, cmd_args):
+        with self.browser.lock:
+            self.browser.switch_to(self.handle)
+            return self.browser.driver.execute_cdp_cmd(cmd, cmd_args)
+    
+    def save_screenshot(self, filename):
+        with self.browser.lock:
+            self.browser.switch_to(self.handle)
+            return self.browser.driver.save_screenshot(filename)
+    
+    def call_if_idle(self, action):
+        """ブラウザを他のタブが使っていなければドライバーを渡してactionを呼び、(呼んだか, 戻り値)を返す（使われていれば待たない）"""
+        if not self.browser.lock.acquire(blocking=False):
+            return False, None
+        try:
+            self.browser.switch_to(self.handle)
+            return True, action(self.browser.driver)
+        finally:
+            self.browser.lock.release()
+    
+    def js_heap_used_bytes(self):
+        """タブのJavaScriptヒープの使用量（バイト）"""
+        return int(self.execute_cdp_cmd('Runtime.getHeapUsage', {})['usedSize'])
+    
+    def is_alive(self):
+        """タブが属するブラウザが利用可能か"""
+        return not self.closed and self.browser.healthy
+    
+    def quit(self):
+        """タブをプールに返却する（ブラウザ自体は終了しない）"""
+        if self.closed:
+            return
+        self.closed = True
+        browser_pool.release(self)
+
+class BrowserPool:
+    """起動済みChromeを保持し、セッションごとにタブを割り当てるプール"""
+    
+    def __init__(self, warm_size, max_browsers, max_tabs, health_check_interval, max_age, max_sessions_served):
+        self.warm_size = warm_size
+        self.max_browsers = max_browsers
+        self.max_tabs = max_tabs
+        self.health_check_interval = health_check_interval
+        self.max_age = max_age
+        self.max_sessions_served = max_sessions_served
+        self.browsers = []
+        self.lock = threading.Lock()
+        self.maintenance_thread = None
+        self._next_browser_id = 0
+        # 起動枠を確保済みで、まだプールに加わっていないブラウザの数（ロック取得中に増減する）
+        self.pending_launches = 0
+    
+    def start(self):
+        """ウォームアップとヘルスチェックを行うメンテナンススレッドを開始する"""
+        with self.lock:
+            if self.maintenance_thread:
+                return
+            self.maintenance_thread = threading.Thread(target=self._maintenance_loop, daemon=True)
+            self.maintenance_thread.start()
+    
+    def _launch(self, network_capture=False, profile=DEFAULT_BROWSER_PROFILE, reserved_tabs=0):
+        """ブラウザを起動してプールに加える（呼び出し前にpending_launchesで起動枠を確保しておくこと）"""
+        with self.lock:
+            self._next_browser_id += 1
+            browser_id = self._next_browser_id
+        try:
+            browser = PooledBrowser(browser_id, network_capture, profile)
+        except Exception:
+            with self.lock:
+                self.pending_launches -= 1
+            raise
+        # 起動を待っていたセッションの分のタブ枠は、他の割り当てに取られないよう確保したまま加える
+        browser.pending_tabs = reserved_tabs
+        # 傍受した通信をセッションごとに区別できないため、networkモードのブラウザは共有しない
+        browser.draining = network_capture
+        with self.lock:
+            self.pending_launches -= 1
+            self.browsers.append(browser)
+        return browser
+    
+    def _is_available(self, browser):
+        return browser.healthy and not browser.draining and len(browser.tabs) + browser.pending_tabs < self.max_tabs
+    
+    def acquire(self, session_id, network_capture=False, profile=DEFAULT_BROWSER_PROFILE):
+        """空きのあるブラウザからタブを割り当てる（空きがなければ新しく起動）"""
+        self.start()
+        browser = None
+        # 同時に来た割り当てで上限を超えないよう、ロックを持ったままタブ枠か起動枠を確保する
+        with self.lock:
+            # プロファイルは起動オプションで決まるため、同じプロファイルのブラウザだけを共有する
+            candidates = [b for b in self.browsers if self._is_available(b) and b.profile == profile]
+            can_launch = len(self.browsers) + self.pending_launches < self.max_browsers
+            
+            if network_capture:
+                # 傍受した通信をセッションごとに区別できないため、専用ブラウザを起動して共有しない
+                if not can_launch:
+                    raise RuntimeError(f"ブラウザプールが上限に達しています（{self.max_browsers}ブラウザ）")
+                self.pending_launches += 1
+            elif candidates:
+                # タブ数が最も少ないブラウザに割り当てて負荷を分散
+                browser = min(candidates, key=lambda b: len(b.tabs) + b.pending_tabs)
+                browser.pending_tabs += 1
+            elif can_launch:
+                self.pending_launches += 1
+            else:
+                raise RuntimeError(f"ブラウザプールが上限に達しています（{self.max_browsers}ブラウザ × {self.max_tabs}タブ）")
+        
+        if browser is None:
+            browser = self._launch(network_capture=network_capture, profile=profile, reserved_tabs=1)
+        try:
+            return browser.open_tab(session_id)
+        finally:
+            with self.lock:
+                browser.pending_tabs -= 1
+    
+    def release(self, tab):
+        """タブを閉じ、必要であればブラウザを入れ替える"""
+        browser = tab.browser
+        try:
+            browser.close_tab(tab.handle)
+        except Exception as e:
+            logger.error(f"Failed to close tab for session {tab.session_id}: {str(e)}")
+            browser.healthy = False
+        self._recycle_if_needed(browser)
+    
+    def _recycle_if_needed(self, browser):
+        # 寿命や処理セッション数の上限に達したブラウザは新規割り当てを止め、タブがなくなれば終了する
+        if (time.time() - browser.started_at) > self.max_age or browser.sessions_served >= self.max_sessions_served:
+            browser.draining = True
+        
+        if (browser.draining or not browser.healthy) and not browser.tabs:
+            with self.lock:
+                # 割り当てが決まってタブを開く途中のブラウザは終了しない
+                if browser not in self.browsers or browser.pending_tabs or browser.tabs:
+                    return
+                self.browsers.remove(browser)
+            logger.info(f"Recycling Chrome {browser.browser_id} (healthy: {browser.healthy}, sessions served: {browser.sessions_served})")
+            browser.quit()
+    
+    def _maintenance_loop(self):
+        while True:
+            try:
+                with self.lock:
+                    browsers = list(self.browsers)
+                
+                for browser in browsers:
+                    browser.check_health()
+                    if browser.healthy:
+                        self._sample_usage(browser)
+                    self._recycle_if_needed(browser)
+                
+                # 既定のプロファイルで割り当て可能なブラウザを指定数だけ起動しておく
+                with self.lock:
+                    available = len([b for b in self.browsers
+                                     if b.healthy and not b.draining and b.profile == DEFAULT_BROWSER_PROFILE])
+                    capacity = self.max_browsers - len(self.browsers) - self.pending_launches
+                    launches = max(0, min(self.warm_size - available, capacity))
+                    self.pending_launches += launches
+                for index in range(launches):
+                    try:
+                        self._launch()
+                    except Exception:
+                        # 起動しなかった残りの枠を返す
+                        with self.lock:
+                            self.pending_launches -= launches - index - 1
+                        raise
+            except Exception as e:
+                logger.error(f"Error in browser pool maintenance: {str(e)}")
+            
+            time.sleep(self.health_check_interval)
+    
+    def _sample_usage(self, browser):
+        # タブの切り替えでブラウザのロックを取るため、/metricsや一覧からは呼ばず、ここで集めた値を読ませる
+        try:
+            # パフォーマンスログはChromeDriver側に溜まり続けるため、定期的に読み出して集計する
+            browser.collect_network_usage()
+        except Exception as e:
+            logger.warning(f"Failed to read network usage of Chrome {browser.browser_id}: {str(e)}")
+        for tab in list(browser.tabs.values()):
+            try:
+                tab.js_heap_used = tab.js_heap_used_bytes()
+            except Exception as heap_err:
+                logger.debug(f"Failed to read JS heap of session {tab.session_id}: {str(heap_err)}")
+    
+    def session_tab(self, session_id):
+        """セッションのタブを返す（なければNone）"""
+        with self.lock:
+            for browser in self.browsers:
+                for tab in list(browser.tabs.values()):
+                    if tab.session_id == session_id:
+                        return tab
+        return None
+    
+    def session_usage(self, session_id):
+        """セッションのタブのプロファイルと受信バイト数（メンテナンス時に集めた値。タブがなければNone）"""
+        tab = self.session_tab(session_id)
+        if tab is None:
+            return None
+        return {
+            'profile': tab.browser.profile,
+            'bytes_downloaded': tab.bytes_downloaded if tab.browser.profile == 'lean' else None,
+            'requests_blocked': tab.requests_blocked,
+            'js_heap_used_bytes': tab.js_heap_used
+        }
+    
+    def session_browser(self, session_id):
+        """セッションのタブを開いているブラウザのIDを返す（なければNone）"""
+        with self.lock:
+            for browser in self.browsers:
+                if any(tab.session_id == session_id for tab in list(browser.tabs.values())):
+                    return browser.browser_id
+        return None
+    
+    def stats(self):
+        """プールの状態を返す"""
+        with self.lock:
+            return [{
+                'browser_id': b.browser_id,
+                'debug_port': b.debug_port,
+                'tabs': len(b.tabs),
+                'sessions_served': b.sessions_served,
+                'healthy': b.healthy,
+                'draining': b.draining,
+                'network_capture': b.network_capture,
+                'profile': b.profile,
+                'bytes_downloaded': sum(tab.bytes_downloaded for tab in list(b.tabs.values())) if b.profile == 'lean' else None,
+                'uptime': round(time.time() - b.started_at, 1)
+            } for b in self.browsers]
+
+class NetworkFeedReader:
+    """selenium-wireが記録した通信から、前回以降に届いたチャットのデータだけを取り出す"""
+    
+    def __init__(self, tab):
+        self.tab = tab
+        self.ws_offsets = {}
+        self.seen_responses = set()
+    
+    def read_payloads(self):
+        """新しいWebSocket受信フレームと未処理のXHRレスポンス本文を返す"""
+        from seleniumwire.utils import decode
+        
+        with self.tab.browser.lock:
+            captured = self.tab.browser.driver.requests
+        
+        payloads = []
+        live_ids = set()
+        for captured_request in captured:
+            live_ids.add(captured_request.id)
+            ws_messages = getattr(captured_request, 'ws_messages', None) or []
+            if ws_messages:
+                # 前回読み取った位置以降のサーバーからのフレームのみ
+                offset = self.ws_offsets.get(captured_request.id, 0)
+                payloads.extend(m.content for m in ws_messages[offset:] if not m.from_client)
+                self.ws_offsets[captured_request.id] = len(ws_messages)
+                continue
+            
+            response = captured_request.response
+            if response is None or captured_request.id in self.seen_responses:
+                continue
+            self.seen_responses.add(captured_request.id)
+            if 'json' not in response.headers.get('Content-Type', ''):
+                continue
+            try:
+                payloads.append(decode(response.body, response.headers.get('Content-Encoding', 'identity')))
+            except ValueError as decode_err:
+                logger.error(f"Failed to decode captured response: {str(decode_err)}")
+        
+        # ストレージから消えたリクエストの記録は破棄
+        self.seen_responses &= live_ids
+        self.ws_offsets = {k: v for k, v in self.ws_offsets.items() if k in live_ids}
+        return payloads
+
+# ブラウザプール（環境変数で調整可能）
+browser_pool = BrowserPool(
+    warm_size=int(os.environ.get('BROWSER_POOL_SIZE', '1')),
+    max_browsers=int(os.environ.get('BROWSER_POOL_MAX_BROWSERS', '4')),
+    max_tabs=int(os.environ.get('BROWSER_MAX_TABS', '8')),
+    health_check_interval=int(os.environ.get('BROWSER_HEALTH_CHECK_INTERVAL', '30')),
+    max_age=int(os.environ.get('BROWSER_MAX_AGE', str(6 * 60 * 60))),
+    max_sessions_served=int(os.environ.get('BROWSER_MAX_SESSIONS_SERVED', '50'))
+)
+
+# replay:// のURLで、Chromeの代わりに記録済みのスナップショットや合成チャットを再生するドライバーを使えるようにする
+# （負荷試験・回帰確認用。ローカルのファイルを読むため既定では無効）
+REPLAY_ENABLED = os.environ.get('REPLAY_ENABLED', '0') == '1'
+REPLAY_SCHEME = 'replay:'
+# 合成チャットで1秒あたりに増える行数・ページに残す行数・チャット欄以外の埋め草の要素数の既定値
+REPLAY_DEFAULT_RATE = 5.0
+REPLAY_DEFAULT_WINDOW = 300
+REPLAY_DEFAULT_PADDING = 2000
+# スナップショットを切り替える間隔（秒）の既定値
+REPLAY_DEFAULT_INTERVAL = 5.0
+
+def build_synthetic_row(index, rng):
+    """合成チャット1行分のHTMLを生成する（チップ・プレゼントメニュー・エピックゴール・ルーレット・通常チャット。再生用ドライバーとベンチマークで共用）"""
+    username = f'user{rng.randint(1, 300)}'
+    amount = rng.choice([1, 5, 10, 25, 50, 100, 500])
+    kind = rng.random()
+    if kind < 0.1:
+        return (f'<div class="message plugin-message"><div class="plugin-message-content">'
+                f'<span class="plugin-message-plugin-name">Wheel of Fortune</span>'
+                f'<span class="user-levels-username-text">{username}</span> won '
+                f'<span class="plugin-message-accent">Prize {index % 12}</span></div></div>')
+    if kind < 0.5:
+        return (f'<div class="message message-base"><div class="chat-text">'
+                f'<span class="user-levels-username-text">{username}</span> hello #{index}</div></div>')
+    if kind < 0.7:
+        tip_class = 'tip-comment tip-comment-with-highlight tip-menu'
+        inner = ''
+    elif kind < 0.8:
+        tip_class = 'tip-comment'
+        inner = '<div class="tip-comment-epic-goal">Epic Goal</div>'
+    else:
+        tip_class = 'tip-comment'
+        inner = ''
+    return (f'<div class="message message-base" data-row="{index}"><div class="{tip_class}">{inner}'
+            f'<span class="user-levels-username-text">{username}</span>'
+            f'<span class="tip-amount-highlight">{amount} tk</span>'
+            f'<span class="tip-comment-body">comment {index % 40}</span></div></div>')
+
+class ReplayDriver:
+    """monitor_chatからはWebDriver（BrowserTab）と同じように扱える、ページの再生用ドライバー
+    
+    replay://synthetic?rate=20&seed=1&window=300&padding=2000&start=1700000000
+        一定の速さで行が増える合成チャット（benchmark_extractionの合成ページと同じ行）。
+        各行に出現時刻を含むdata-message-idを付けるため、受信側で出現から配信までの時間を測れる。
+        startで開始時刻（UNIX秒）を固定すると、プロセスを再起動しても同じIDの行が同じ時刻に現れる
+    replay:///tmp/snapshots/*.html?interval=5&loop=1
+        保存したページのスナップショットを一定間隔で順に表示する
+    """
+    
+    handle = 'replay'
+    browser_id = 'replay'
+    capabilities = {}
+    # ページの読み込みを待つ必要はない
+    load_wait = 0
+    
+    def __init__(self, session_id):
+        self.session_id = session_id
+        # monitor_chatのログ出力（driver.browser.browser_id）用に自身をブラウザとして見せる
+        self.browser = self
+        self.closed = False
+        self.lock = threading.Lock()
+        self.started_at = None
+        self.snapshots = None
+        self.rows = deque()
+    
+    def get(self, url):
+        parts = urlsplit(url)
+        options = dict(parse_qsl(parts.query))
+        with self.lock:
+            self.started_at = float(options.get('start', time.time()))
+            self.drained_rows = 0
+            self.drained_snapshot = -1
+            if parts.netloc == 'synthetic':
+                self.rate = float(options.get('rate', REPLAY_DEFAULT_RATE))
+                self.seed = int(options.get('seed', 0))
+                self.window = int(options.get('window', REPLAY_DEFAULT_WINDOW))
+                if self.rate <= 0 or self.window <= 0:
+                    raise ValueError('replay rate and window must be positive')
+                self.rows = deque(maxlen=self.window)
+                self.generated = 0
+                padding = int(options.get('padding', REPLAY_DEFAULT_PADDING))
+                filler = ''.join(f'<div class="layout-block item-{i % 50}"><span>filler {i}</span></div>' for i in range(padding))
+                self.page_head = (f'<html><head><title>Replay chat</title></head><body class="synthetic">{filler}'
+                                  f'<div class="chat-wrapper"><div class="messages">')
+                self.page_tail = '</div></div></body></html>'
+            else:
+                paths = sorted(glob.glob(parts.path))
+                if not paths:
+                    raise FileNotFoundError(f"No replay snapshots match {parts.path}")
+                self.snapshots = []
+                for path in paths:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        self.snapshots.append(f.read())
+                self.interval = float(options.get('interval', REPLAY_DEFAULT_INTERVAL))
+                self.loop = options.get('loop', '0') == '1'
+        logger.info(f"Replaying {url} for session {self.session_id}")
+    
+    def _grow(self, now):
+        """現在時刻までに出現した合成チャットの行を生成する（ロック取得中に呼び出すこと）"""
+        due = int((now - self.started_at) * self.rate)
+        # ページに残らない古い行は生成しない
+        start = max(self.generated, due - self.window)
+        for index in range(start, due):
+            appeared_ms = int((self.started_at + index / self.rate) * 1000)
+            row = build_synthetic_row(index, random.Random(self.seed * 1000003 + index))
+            self.rows.append((index, row.replace('<div class="message',
+                                                 f'<div data-message-id="replay:{index}:{appeared_ms}" class="message', 1)))
+        self.generated = max(self.generated, due)
+    
+    def _snapshot_index(self, now):
+        step = int((now - self.started_at) / self.interval)
+        return step % len(self.snapshots) if self.loop else min(step, len(self.snapshots) - 1)
+    
+    @property
+    def page_source(self):
+        now = time.time()
+        with self.lock:
+            if self.snapshots is not None:
+                return self.snapshots[self._snapshot_index(now)]
+            self._grow(now)
+            return self.page_head + ''.join(row for _, row in self.rows) + self.page_tail
+    
+    def _drain(self, now):
+        """ハーベスターの代わりに、前回から増えた行（スナップショットが変わった場合はページ全体）を返す"""
+        if self.snapshots is not None:
+            index = self._snapshot_index(now)
+            if index == self.drained_snapshot:
+                return []
+            self.drained_snapshot = index
+            return [self.snapshots[index]]
+        self._grow(now)
+        fragments = [row for index, row in self.rows if index >= self.drained_rows]
+        self.drained_rows = self.generated
+        return fragments
+    
+    def execute_script(self, script, *args):
+        """監視処理が使うスクリプト（ハーベスターの設置・回収、生存確認）だけを模倣する"""
+        now = time.time()
+        with self.lock:
+            if script is HARVESTER_DRAIN_SCRIPT:
+                return self._drain(now)
+            if script is HARVESTER_INSTALL_SCRIPT:
+                return True
+            if script is PAGE_HEARTBEAT_SCRIPT:
+                if self.snapshots is not None:
+                    last = str(self._snapshot_index(now))
+                else:
+                    self._grow(now)
+                    last = str(self.generated)
+                return {'ready': 'complete', 'container': True, 'messages': len(self.rows) if self.snapshots is None else 0,
+                        'last': last, 'harvester': True}
+        return None
+    
+    def execute_cdp_cmd(self, cmd, cmd_args):
+        raise RuntimeError('CDP is not available in replay')
+    
+    def refresh(self):
+        pass
+    
+    def save_screenshot(self, filename):
+        return False
+    
+    def call_if_idle(self, action):
+        # 再生用ドライバーはセッション専用のため、他のセッションを待たせることはない
+        return True, action(self)
+    
+    def is_alive(self):
+        return not self.closed
+    
+    def quit(self):
+        self.closed = True
+
+def is_replay_url(url):
+    return url.startswith(REPLAY_SCHEME)
+
+def acquire_driver(session_id, url, capture_mode, browser_profile=None):
+    """セッション用のドライバーを用意する（replay://のURLなら再生用ドライバー、それ以外はプールのタブ）"""
+    if REPLAY_ENABLED and is_replay_url(url):
+        return ReplayDriver(session_id)
+    return browser_pool.acquire(session_id, network_capture=(capture_mode == 'network'),
+                                profile=browser_profile or DEFAULT_BROWSER_PROFILE)
+
+@metrics.collector
+def collect_browser_metrics():
+    """ブラウザごとのメモリとタブ数、セッションごとのメモリの目安（同じブラウザのタブで等分した値）・受信バイト数（leanのみ）・JSヒープの使用量"""
+    with browser_pool.lock:
+        browsers = list(browser_pool.browsers)
+    # プロセスの親子関係は1回だけ読み取り、全ブラウザで使い回す
+    children = process_children() if browsers else None
+    for browser in browsers:
+        tabs = list(browser.tabs.values())
+        labels = {'browser_id': str(browser.browser_id), 'profile': browser.profile}
+        yield 'chat_chrome_tabs', labels, len(tabs)
+        # 受信バイト数とJSヒープはプールのメンテナンスで集めた値を読む（ここでブラウザを操作すると監視スレッドを止めてしまう）
+        for tab in tabs:
+            tab_labels = {'session_id': tab.session_id, 'browser_id': str(browser.browser_id), 'profile': browser.profile}
+            if browser.profile == 'lean':
+                yield 'chat_session_downloaded_bytes', tab_labels, tab.bytes_downloaded
+            if tab.js_heap_used is not None:
+                yield 'chat_session_js_heap_used_bytes', tab_labels, tab.js_heap_used
+        rss = browser.rss_bytes(children) if children is not None else None
+        if rss is None:
+            continue
+        yield 'chat_chrome_rss_bytes', labels, rss
+        for tab in tabs:
+            yield 'chat_session_chrome_rss_bytes', {'session_id': tab.session_id, 'browser_id': str(browser.browser_id)}, rss // len(tabs)
+
+metrics.gauge('chat_chrome_rss_bytes', 'Resident memory of a pooled Chrome and its ChromeDriver')
+metrics.gauge('chat_chrome_tabs', 'Open session tabs per pooled Chrome')
+metrics.gauge('chat_session_chrome_rss_bytes', 'Chrome memory per session, estimated as an equal share of its browser')
+metrics.gauge('chat_session_downloaded_bytes', 'Bytes received by a lean-profile session tab (encoded response bodies and WebSocket frames)')
+metrics.gauge('chat_session_js_heap_used_bytes', 'JavaScript heap in use by a session tab, from Runtime.getHeapUsage (excludes DOM, images and other renderer memory)')
+metrics.counter('chat_chrome_downloaded_bytes_total', 'Bytes received by lean-profile Chrome tabs')
+metrics.counter('chat_chrome_blocked_requests_total', 'Requests blocked by the lean browser profile')
+
+# 診断情報の収集レベル
+# off: 収集しない / sampled: Nチェックごと / on_error: エラー時のみ / always: 毎チェック
+DIAGNOSTIC_LEVELS = ('off', 'sampled', 'on_error', 'always')
+DEFAULT_DIAGNOSTIC_LEVEL = os.environ.get('DIAGNOSTIC_LEVEL', 'off')
+DEFAULT_DIAGNOSTIC_SAMPLE_EVERY = int(os.environ.get('DIAGNOSTIC_SAMPLE_EVERY', '12'))
+DIAGNOSTICS_DIR = os.environ.get('DIAGNOSTICS_DIR', '/tmp')
+
+# ページ全体の構造情報を取得するスクリプト
+PAGE_STRUCTURE_SCRIPT = """
+    const allNodes = document.querySelectorAll('div, section, aside');
+    const classes = {};
+    for (let i = 0; i < allNodes.length; i++) {
+        if (allNodes[i].className) {
+            const cls = allNodes[i].className.toString();
+            classes[cls] = (classes[cls] || 0) + 1;
+        }
+    }
+
+    // メッセージ関連の要素を特に探す
+    const messageContainers = document.querySelectorAll(
+        '.messages, .chat-messages, .stream-messages, .chat-list, .message-list, ' + 
+        '.comment-list, [class*="message"], [class*="chat"], [class*="comment"]'
+    );
+
+    const potentialContainers = [];
+    for (let i = 0; i < messageContainers.length; i++) {
+        potentialContainers.push({
+            className: messageContainers[i].className,
+            childCount: messageContainers[i].children.length,
+            html: messageContainers[i].children.length > 0 ? 
+                messageContainers[i].children[0].outerHTML.substring(0, 150) : 'No children'
+        });
+    }
+
+    return {
+        title: document.title,
+        url: window.location.href,
+        bodyClass: document.body.className,
+        topClasses: Object.entries(classes)
+            .sort((a, b) => b[1] - a[1])
+            .slice(0, 20),  // 出現頻度の高い上位20クラス
+        potentialMessageContainers: potentialContainers,
+        // Seleniumから直接検出したメッセージ要素数
+        messageElementCount: document.querySelectorAll(arguments[0]).length
+    }
+"""
+
+class DiagnosticsCollector:
+    """デバッグ用の診断情報をバックグラウンドで収集するワーカー（監視ループの抽出処理をブロックしない）
+    
+    HTMLは監視ループが取得したものを使い、ブラウザの操作（構造の取得・スクリーンショット）はブラウザが空いているときだけ行う
+    """
+    
+    def __init__(self, max_pending=4):
+        self.jobs = Queue(maxsize=max_pending)
+        self.lock = threading.Lock()
+        self.settings = {}
+        self.drivers = {}
+        # 監視ループが最後に取得したページ全体のHTML（診断がoffのセッションは保持しない）
+        self.pages = {}
+        self.ticks = {}
+        self.latest = {}
+        self.dropped = 0
+        self.thread = None
+    
+    def start(self):
+        with self.lock:
+            if self.thread:
+                return
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+    
+    def configure(self, session_id, level=None, sample_every=None):
+        """セッションごとの収集レベルを設定する"""
+        level = level or DEFAULT_DIAGNOSTIC_LEVEL
+        if level not in DIAGNOSTIC_LEVELS:
+            raise ValueError(f"Unknown diagnostic level: {level}")
+        with self.lock:
+            self.settings[session_id] = {
+                'level': level,
+                'sample_every': max(1, int(sample_every or DEFAULT_DIAGNOSTIC_SAMPLE_EVERY))
+            }
+    
+    def attach(self, session_id, driver):
+        """診断で使用するドライバー（タブ）を登録する"""
+        with self.lock:
+            self.drivers[session_id] = driver
+    
+    def detach(self, session_id):
+        with self.lock:
+            self.drivers.pop(session_id, None)
+    
+    def _setting(self, session_id):
+        """セッションの設定（ロックを保持した状態で呼ばれる）"""
+        return self.settings.get(session_id, {'level': DEFAULT_DIAGNOSTIC_LEVEL, 'sample_every': DEFAULT_DIAGNOSTIC_SAMPLE_EVERY})
+    
+    def setting(self, session_id):
+        """セッションの設定（未設定ならNone）"""
+        with self.lock:
+            setting = self.settings.get(session_id)
+            return dict(setting) if setting else None
+    
+    def remember_page(self, session_id, html):
+        """監視ループが取得したページ全体のHTMLを、診断で使えるよう保持する"""
+        with self.lock:
+            if self._setting(session_id)['level'] == 'off':
+                self.pages.pop(session_id, None)
+            else:
+                self.pages[session_id] = html
+    
+    def forget(self, session_id):
+        """セッション終了時に設定とスナップショットを破棄する"""
+        with self.lock:
+            self.settings.pop(session_id, None)
+            self.drivers.pop(session_id, None)
+            self.pages.pop(session_id, None)
+            self.ticks.pop(session_id, None)
+            self.latest.pop(session_id, None)
+    
+    def should_capture(self, session_id, error=False):
+        """今回のチェックで診断を収集するかを判定する（エラー時はoff以外なら収集）"""
+        with self.lock:
+            setting = self._setting(session_id)
+            level = setting['level']
+            if level == 'off':
+                return False
+            if error:
+                return True
+            tick = self.ticks.get(session_id, 0) + 1
+            self.ticks[session_id] = tick
+            if level == 'always':
+                return True
+            return level == 'sampled' and tick % setting['sample_every'] == 0
+    
+    def submit(self, session_id, html=None, reason='tick', error=None):
+        """収集ジョブを登録する（ワーカーが追いつかない場合は破棄して監視ループを待たせない）"""
+        self.start()
+        try:
+            self.jobs.put_nowait({
+                'session_id': session_id,
+                'html': html,
+                'reason': reason,
+                'error': error,
+                'requested_at': datetime.now().isoformat()
+            })
+            return True
+        except Full:
+            with self.lock:
+                self.dropped += 1
+            return False
+    
+    def snapshot(self, session_id):
+        with self.lock:
+            return self.latest.get(session_id)
+    
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                snapshot = self._collect(job)
+                with self.lock:
+                    if job['session_id'] in self.settings:
+                        self.latest[job['session_id']] = snapshot
+                logger.debug(f"Collected diagnostics for session {job['session_id']} ({job['reason']})")
+            except Exception as e:
+                logger.error(f"Failed to collect diagnostics: {str(e)}")
+    
+    def _collect(self, job):
+        session_id = job['session_id']
+        with self.lock:
+            driver = self.drivers.get(session_id)
+            # ページのHTMLは、監視ループが取得したものがあればブラウザから取り直さずに使う
+            html = job['html'] if job['html'] is not None else self.pages.get(session_id)
+        
+        snapshot = {
+            'session_id': session_id,
+            'reason': job['reason'],
+            'error': job['error'],
+            'requested_at': job['requested_at'],
+            'errors': [],
+            'skipped': []
+        }
+        
+        # 同じブラウザの他のタブの抽出を待たせないよう、ブラウザの操作はブラウザが使われていなければ行い、使われていれば見送る
+        if html is None and driver is not None:
+            # 診断を有効にした直後など、監視ループのHTMLがまだない
+            try:
+                ran, html = driver.call_if_idle(lambda d: d.page_source)
+                if not ran:
+                    snapshot['skipped'].append('page_source')
+            except Exception as source_err:
+                snapshot['errors'].append(f"page_source: {str(source_err)}")
+        
+        if html:
+            # デバッグ用に一部のHTMLを保存
+            try:
+                debug_path = os.path.join(DIAGNOSTICS_DIR, f'debug-{session_id}.html')
+                with open(debug_path, 'w', encoding='utf-8') as f:
+                    f.write(html[:200000])  # 最初の20万文字を保存（十分な量）
+                snapshot['debug_html_path'] = debug_path
+            except Exception as write_err:
+                snapshot['errors'].append(f"debug_html: {str(write_err)}")
+            
+            # 重要なセレクターの出現回数をカウント
+            snapshot['html_length'] = len(html)
+            snapshot['html_stats'] = {
+                'messages': html.count('class="messages"'),
+                'message': html.count('class="message"'),
+                'chat-messages': html.count('class="chat-messages"'),
+                'tip-comment': html.count('class="tip-comment"')
+            }
+            
+            # 拡張DOM分析を実行
+            try:
+                snapshot['dom_analysis'] = analyze_dom_structure_enhanced(html)
+            except Exception as analysis_err:
+                snapshot['errors'].append(f"dom_analysis: {str(analysis_err)}")
+        
+        if driver is not None:
+            # ページ全体の構造情報を取得
+            try:
+                ran, structure = driver.call_if_idle(lambda d: d.execute_script(PAGE_STRUCTURE_SCRIPT, MESSAGE_SELECTOR))
+                if ran:
+                    snapshot['page_structure'] = structure
+                else:
+                    snapshot['skipped'].append('page_structure')
+            except Exception as js_err:
+                snapshot['errors'].append(f"page_structure: {str(js_err)}")
+            
+            # スクリーンショットを撮影（HTMLだけでは分からない要素の位置関係を確認）
+            try:
+                screenshot_path = os.path.join(DIAGNOSTICS_DIR, f'debug_screenshot-{session_id}.png')
+                ran, _ = driver.call_if_idle(lambda d: d.save_screenshot(screenshot_path))
+                if ran:
+                    snapshot['screenshot_path'] = screenshot_path
+                else:
+                    snapshot['skipped'].append('screenshot')
+            except Exception as ss_err:
+                snapshot['errors'].append(f"screenshot: {str(ss_err)}")
+        
+        snapshot['captured_at'] = datetime.now().isoformat()
+        return snapshot
+
+diagnostics = DiagnosticsCollector()
+
+class LivenessMonitor:
+    """ページとチャットの流れが生きているかを判定し、停滞したときだけリロードさせる"""
+    
+    def __init__(self, stale_after=None):
+        now = time.time()
+        self.base_stale_after = LIVENESS_STALE_AFTER if stale_after is None else int(stale_after)
+        self.stale_after = self.base_stale_after
+        self.lock = threading.Lock()
+        self.last_activity = now
+        self.last_message = None
+        self.last_heartbeat = None
+        self.last_signature = None
+        self.failures = 0
+        self.reloads = 0
+        self.last_reload = None
+        self.last_reload_reason = None
+    
+    def heartbeat_due(self, now=None):
+        now = now if now is not None else time.time()
+        return self.last_heartbeat is None or (now - self.last_heartbeat) >= LIVENESS_CHECK_INTERVAL
+    
+    def seconds_until_heartbeat(self, now=None):
+        now = now if now is not None else time.time()
+        if self.last_heartbeat is None:
+            return 0
+        return max(0, LIVENESS_CHECK_INTERVAL - (now - self.last_heartbeat))
+    
+    def record_messages(self, count, now=None):
+        """新着メッセージを記録する（流れていれば停滞判定の時間を元に戻す）"""
+        if not count:
+            return
+        now = now if now is not None else time.time()
+        with self.lock:
+            self.last_message = now
+            self.last_activity = now
+            self.stale_after = self.base_stale_after
+    
+    def record_activity(self, now=None):
+        """メッセージ以外の通信やDOMの変化など、フィードが動いている兆候を記録する"""
+        now = now if now is not None else time.time()
+        with self.lock:
+            self.last_activity = now
+    
+    def record_heartbeat(self, heartbeat, now=None):
+        """生存確認の結果を記録する（スクリプトが失敗した場合はNone）"""
+        now = now if now is not None else time.time()
+        with self.lock:
+            self.last_heartbeat = now
+            if not heartbeat or not heartbeat.get('container'):
+                self.failures += 1
+                return
+            self.failures = 0
+            # チャット欄の中身が変わっていれば動きがあるとみなす
+            signature = (heartbeat.get('messages'), heartbeat.get('last'))
+            if signature != self.last_signature:
+                self.last_signature = signature
+                self.last_activity = now
+    
+    def reload_reason(self, now=None):
+        """リロードが必要ならその理由を返す"""
+        now = now if now is not None else time.time()
+        with self.lock:
+            if self.failures >= LIVENESS_MAX_FAILURES:
+                return 'heartbeat_failed'
+            if self.stale_after > 0 and (now - self.last_activity) >= self.stale_after:
+                return 'stale_feed'
+            return None
+    
+    def record_reload(self, reason, now=None):
+        now = now if now is not None else time.time()
+        metrics.inc('chat_page_reloads_total', reason=reason)
+        with self.lock:
+            self.reloads += 1
+            self.last_reload = now
+            self.last_reload_reason = reason
+            self.failures = 0
+            self.last_activity = now
+            self.last_signature = None
+            # 静かなだけのチャンネルを繰り返しリロードしないよう、次の停滞判定までの時間を延ばす
+            if reason == 'stale_feed':
+                self.stale_after = min(self.stale_after * 2, LIVENESS_MAX_STALE_AFTER)
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'reloads': self.reloads,
+                'last_reload_at': datetime.fromtimestamp(self.last_reload).isoformat() if self.last_reload else None,
+                'last_reload_reason': self.last_reload_reason,
+                'last_message_at': datetime.fromtimestamp(self.last_message).isoformat() if self.last_message else None,
+                'seconds_since_activity': round(time.time() - self.last_activity, 1),
+                'stale_after': self.stale_after,
+                'heartbeat_failures': self.failures
+            }
+
+def page_heartbeat(driver):
+    """ページの生存確認を行う（応答がなければNone）"""
+    try:
+        return driver.execute_script(PAGE_HEARTBEAT_SCRIPT, MESSAGE_SELECTOR)
+    except Exception as js_err:
+        logger.error(f"Heartbeat script failed: {str(js_err)}")
+        return None
+
+def initial_poll_interval(capture_mode):
+    """取得方式ごとの最初のチェック間隔（networkモードはJSONの解析のみで軽量なため短くする）"""
+    return NETWORK_POLL_INTERVAL if capture_mode == 'network' else 5
+
+class PollScheduler:
+    """新着メッセージの頻度と抽出にかかった時間から、セッションごとのチェック間隔を調整するスケジューラー"""
+    
+    def __init__(self, min_interval=None, max_interval=None, initial_interval=5):
+        self.min_interval = float(POLL_MIN_INTERVAL if min_interval is None else min_interval)
+        self.max_interval = float(POLL_MAX_INTERVAL if max_interval is None else max_interval)
+        if self.min_interval <= 0 or self.max_interval < self.min_interval:
+            raise ValueError('invalid poll interval bounds')
+        self.lock = threading.Lock()
+        self.interval = self._clamp(initial_interval)
+        self.rate = 0.0  # 新着件数/秒（指数移動平均）
+        self.cost = 0.0  # 1回のチェックにかかった秒数（指数移動平均）
+        self.last_check = None
+        self.checks = 0
+        self.new_messages = 0
+    
+    @classmethod
+    def from_checkpoint(cls, state):
+        """チェックポイント（stats()の値）から、間隔と頻度・コストの推定値を引き継いだスケジューラーを作る"""
+        scheduler = cls(state['min_interval'], state['max_interval'], state['interval'])
+        scheduler.rate = float(state.get('rate_per_sec', 0))
+        scheduler.cost = float(state.get('cost_ms', 0)) / 1000
+        return scheduler
+    
+    def _clamp(self, interval):
+        return min(self.max_interval, max(self.min_interval, interval))
+    
+    def due(self, now=None):
+        """次のチェック時刻になったか"""
+        now = now if now is not None else time.time()
+        return self.last_check is None or (now - self.last_check) >= self.interval
+    
+    def record(self, new_count, cost, now=None):
+        """チェック結果（新着件数と所要時間）を記録し、次の間隔を決める"""
+        now = now if now is not None else time.time()
+        with self.lock:
+            elapsed = (now - self.last_check) if self.last_check is not None else self.interval
+            observed_rate = new_count / max(elapsed, 1e-3)
+            self.rate += POLL_RATE_SMOOTHING * (observed_rate - self.rate)
+            self.cost += POLL_RATE_SMOOTHING * (cost - self.cost)
+            
+            if new_count > 0:
+                # 1回あたりの新着が目安程度になる間隔へ寄せる（投げ銭が続く間は下限まで詰める）
+                # 急増した直後は平均より直近の頻度を優先し、延ばすときは静かなときと同じ倍率までにする
+                target = POLL_TARGET_BATCH / max(self.rate, observed_rate)
+                interval = min(self.interval * POLL_IDLE_BACKOFF, target)
+            else:
+                # 静かな間は徐々に間隔を延ばす
+                interval = self.interval * POLL_IDLE_BACKOFF
+            
+            # 抽出コストが大きいページでは、チェックだけでCPUを使い切らないよう下限を上げる
+            interval = max(interval, self.cost / POLL_MAX_DUTY_CYCLE)
+            self.interval = self._clamp(interval)
+            self.last_check = now
+            self.checks += 1
+            self.new_messages += new_count
+            return self.interval
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'interval': round(self.interval, 3),
+                'min_interval': self.min_interval,
+                'max_interval': self.max_interval,
+                'rate_per_sec': round(self.rate, 3),
+                'cost_ms': round(self.cost * 1000, 1),
+                'checks': self.checks,
+                'new_messages': self.new_messages
+            }
+
+def monitor_chat(url, session_id, message_hub, stop_event, capture_mode=DEFAULT_CAPTURE_MODE, dedup_index=None, scheduler=None, liveness=None, keyword_filter=None,
+                 browser_profile=None):
+    """チャットを監視し、新しいメッセージを配信ハブに送るバックグラウンド処理"""
+    logger.info(f"Starting monitoring for session {session_id} at {url} (capture mode: {capture_mode})")
+    
+    # 過去に処理したメッセージIDを記録（件数・時間窓で上限を設けて長時間のセッションでもメモリを一定に保つ）
+    processed_ids = dedup_index if dedup_index is not None else BoundedDedupIndex()
+    # チェック間隔は新着の頻度と抽出コストに応じて調整する
+    if scheduler is None:
+        scheduler = PollScheduler(initial_interval=initial_poll_interval(capture_mode))
+    # リロードは定期的には行わず、フィードが停滞したときだけ行う
+    liveness = liveness if liveness is not None else LivenessMonitor()
+    # キーワードで絞り込んでから配信する（間隔の調整と停滞判定には絞り込む前の件数を使う）
+    keyword_filter = keyword_filter if keyword_filter is not None else KeywordFilter()
+    
+    # ブラウザインスタンスとドライバーの参照
+    driver = None
+
+    try:
+        # プールからこのセッション専用のタブを割り当てる
+        driver = acquire_driver(session_id, url, capture_mode, browser_profile)
+        logger.info(f"Assigned tab {driver.handle} on browser {driver.browser.browser_id} to session {session_id}")
+        diagnostics.attach(session_id, driver)
+
+        # URLにアクセス
+        driver.get(url)
+        logger.info(f"Browser accessed {url}")
+        
+        # 初期データを送信（接続確認用）
+        initial_messages = [{
+            'id': str(uuid.uuid4()),
+            'text': f'[接続確認] モニタリングを開始しました 【System】',
+            'type': 'システム',
+            'checked': False,
+            'timestamp': datetime.now().isoformat()
+        }]
+        message_hub.put(initial_messages)
+        
+        # 最初のロード待機
+        time.sleep(driver.load_wait)
+        
+        # pushモードではページからのプッシュを受け取るリスナーを起動
+        pushed_fragments = Queue()
+        push_binding = None
+        if capture_mode == 'push':
+            try:
+                listener = CdpBindingListener(driver, PUSH_BINDING_NAME, pushed_fragments.put, stop_event)
+                if listener.start():
+                    push_binding = PUSH_BINDING_NAME
+            except Exception as cdp_err:
+                logger.error(f"Failed to start CDP binding listener, falling back to drain: {str(cdp_err)}")
+        
+        # 差分取得モードではロード後にオブザーバーを設置
+        if capture_mode in ('observer', 'push'):
+            try:
+                install_harvester(driver, push_binding)
+                logger.info("Installed chat harvester observer")
+            except Exception as js_err:
+                logger.error(f"Failed to install harvester: {str(js_err)}")
+        
+        # networkモードでは傍受した通信を読み取る（JSONの解析のみで軽量なため短い間隔で確認）
+        network_reader = None
+        if capture_mode == 'network':
+            network_reader = NetworkFeedReader(driver)
+        
+        # 前回の最終チェック時間（pushモードのフォールバック用）
+        last_check_time = time.time()
+        
+        # 監視ループ
+        while not stop_event.is_set():
+            try:
+                current_time = time.time()
+                
+                # 定期的なチェックの時間になったか
+                is_check_time = scheduler.due(current_time)
+                
+                # 定期的にページの生存確認を行う（オブザーバーが消えていれば設置し直す）
+                if liveness.heartbeat_due(current_time):
+                    heartbeat = page_heartbeat(driver)
+                    liveness.record_heartbeat(heartbeat, current_time)
+                    if heartbeat and capture_mode in ('observer', 'push') and not heartbeat.get('harvester'):
+                        logger.warning("Chat harvester is missing, reinstalling")
+                        try:
+                            install_harvester(driver, push_binding)
+                        except Exception as js_err:
+                            logger.error(f"Failed to reinstall harvester: {str(js_err)}")
+                
+                # フィードが停滞している場合のみブラウザセッションをリフレッシュ
+                reload_reason = liveness.reload_reason(current_time)
+                if reload_reason:
+                    logger.warning(f"Refreshing browser session ({reload_reason})")
+                    driver.refresh()
+                    
+                    # ページロード後にJavaScriptを実行してコンテンツを表示
+                    try:
+                        driver.execute_script("""
+                            // メッセージコンテナをスクロール
+                            const messagesContainer = document.querySelector('.messages');
+                            if (messagesContainer) {
+                                messagesContainer.scrollTop = messagesContainer.scrollHeight;
+                            }
+                        """)
+                    except Exception as js_err:
+                        logger.error(f"Error executing scroll script: {str(js_err)}")
+                        
+                    time.sleep(2)  # ページロード待機時間
+                    liveness.record_reload(reload_reason)
+                    is_check_time = True  # 強制的にチェック
+                    
+                    # リロードでオブザーバーが消えるため再設置（バインディングはリロード後も有効）
+                    if capture_mode in ('observer', 'push'):
+                        try:
+                            install_harvester(driver, push_binding)
+                        except Exception as js_err:
+                            logger.error(f"Failed to reinstall harvester: {str(js_err)}")
+                
+                if capture_mode == 'push':
+                    # プッシュが届くまで待機（アイドル時は次の生存確認まで眠る）
+                    wait_timeout = liveness.seconds_until_heartbeat()
+                    if not push_binding:
+                        wait_timeout = min(wait_timeout, PUSH_FALLBACK_DRAIN_INTERVAL)
+                    fragments = []
+                    listener_stopped = False
+                    try:
+                        payload = pushed_fragments.get(timeout=wait_timeout)
+                        # 同時に届いているプッシュもまとめて処理
+                        while True:
+                            if payload is None:
+                                listener_stopped = True
+                            else:
+                                fragments.extend(json.loads(payload))
+                            payload = pushed_fragments.get_nowait()
+                    except Empty:
+                        pass
+                    
+                    if stop_event.is_set():
+                        break
+                    
+                    if listener_stopped and push_binding:
+                        # リスナーが停止した場合は以降バッファを直接確認する
+                        logger.warning("CDP binding listener stopped, switching to periodic drain")
+                        push_binding = None
+                        install_harvester(driver, None)
+                    
+                    if fragments:
+                        html = wrap_fragments(fragments)
+                    elif not push_binding and (time.time() - last_check_time) >= PUSH_FALLBACK_DRAIN_INTERVAL:
+                        # プッシュに失敗して残っている差分を回収
+                        html = drain_harvested_html(driver)
+                        last_check_time = time.time()
+                    else:
+                        html = None
+                    
+                    if html:
+                        started = time.time()
+                        new_messages = filter_new_messages(extract_messages_from_html(html), processed_ids)
+                        # pushモードでは間隔は使わないが、新着の頻度はAPIで確認できるよう記録する
+                        scheduler.record(len(new_messages), time.time() - started)
+                        metrics.observe('chat_check_seconds', time.time() - started, capture_mode=capture_mode)
+                        metrics.observe('chat_messages_per_check', len(new_messages), capture_mode=capture_mode)
+                        liveness.record_messages(len(new_messages))
+                        matched = keyword_filter.apply(new_messages)
+                        if matched:
+                            logger.info(f"Pushed {len(matched)} new messages ({len(new_messages)} before keyword filter)")
+                            message_hub.put(matched)
+                        if diagnostics.should_capture(session_id):
+                            diagnostics.submit(session_id, reason='push')
+                    continue
+                
+                if capture_mode == 'network':
+                    if is_check_time:
+                        payloads = network_reader.read_payloads()
+                        metrics.observe('chat_page_fetch_seconds', time.time() - current_time, capture_mode=capture_mode)
+                        new_messages = filter_new_messages(extract_messages_from_payloads(payloads), processed_ids)
+                        scheduler.record(len(new_messages), time.time() - current_time)
+                        metrics.observe('chat_check_seconds', time.time() - current_time, capture_mode=capture_mode)
+                        metrics.observe('chat_messages_per_check', len(new_messages), capture_mode=capture_mode)
+                        liveness.record_messages(len(new_messages))
+                        if payloads:
+                            # チャット以外のフレームでも届いていれば通信は停滞していない
+                            liveness.record_activity()
+                        matched = keyword_filter.apply(new_messages)
+                        if matched:
+                            logger.info(f"Captured {len(matched)} new messages from {len(payloads)} network payloads")
+                            message_hub.put(matched)
+                        if diagnostics.should_capture(session_id):
+                            diagnostics.submit(session_id, reason='tick')
+                    time.sleep(0.5)
+                    continue
+                
+                # 定期的なチェック時間かリフレッシュ時にメッセージを取得
+                if is_check_time:
+                    fetch_started = time.time()
+                    if capture_mode == 'observer':
+                        # オブザーバーがバッファした差分のみを取得
+                        html = drain_harvested_html(driver)
+                    else:
+                        # 同じ内容のメッセージのIDが画面に残っている件数で変わらないよう、序数を付けてからページのHTMLを取得
+                        try:
+                            stamp_message_ordinals(driver)
+                        except Exception as js_err:
+                            logger.error(f"Failed to stamp message ordinals: {str(js_err)}")
+                        html = driver.page_source
+                        diagnostics.remember_page(session_id, html)
+                    metrics.observe('chat_page_fetch_seconds', time.time() - fetch_started, capture_mode=capture_mode)
+
+                    # メッセージを抽出
+                    all_messages = extract_messages_from_html(html) if html else []
+                    
+                    # 新しいメッセージのみをフィルタリング
+                    new_messages = filter_new_messages(all_messages, processed_ids)
+                    
+                    # 新着件数と取得・抽出にかかった時間から次のチェック間隔を決める
+                    scheduler.record(len(new_messages), time.time() - current_time)
+                    metrics.observe('chat_check_seconds', time.time() - current_time, capture_mode=capture_mode)
+                    metrics.observe('chat_messages_per_check', len(new_messages), capture_mode=capture_mode)
+                    liveness.record_messages(len(new_messages))
+                    
+                    # キーワードに合うメッセージだけを配信する
+                    matched = keyword_filter.apply(new_messages)
+                    
+                    if matched:
+                        logger.info(f"Found {len(matched)} new messages ({len(new_messages)} before keyword filter)")
+                        # 新しいメッセージをキューに追加
+                        message_hub.put(matched)
+                    elif new_messages:
+                        logger.info(f"Keyword filter dropped all {len(new_messages)} new messages")
+                    else:
+                        # メッセージがなければログ
+                        logger.info("No new messages found")
+                    
+                    # 診断情報の収集はバックグラウンドに任せる（全体のHTMLが取得できていれば渡す）
+                    is_empty_page = capture_mode == 'dom' and not all_messages
+                    if diagnostics.should_capture(session_id, error=is_empty_page):
+                        diagnostics.submit(session_id, html if capture_mode == 'dom' else None,
+                                           reason='empty_page' if is_empty_page else 'tick')
+                
+                # 短い待機で監視ループを継続
+                time.sleep(0.5)
+                
+            except Exception as loop_err:
+                logger.error(f"Error in monitoring loop: {str(loop_err)}")
+                metrics.inc('chat_monitor_errors_total', capture_mode=capture_mode)
+                if diagnostics.should_capture(session_id, error=True):
+                    diagnostics.submit(session_id, reason='error', error=str(loop_err))
+                
+                # ブラウザが応答しなくなった場合は別のブラウザのタブへ移る
+                if not driver.is_alive():
+                    logger.warning(f"Browser for session {session_id} is unhealthy, reassigning tab")
+                    try:
+                        driver.quit()
+                        driver = acquire_driver(session_id, url, capture_mode, browser_profile)
+                        diagnostics.attach(session_id, driver)
+                        driver.get(url)
+                        liveness.record_reload('tab_reassigned')
+                    except Exception as reassign_err:
+                        logger.error(f"Failed to reassign tab: {str(reassign_err)}")
+                
+                # エラーが発生しても継続
+                time.sleep(1)
+        
+        # 監視終了時にブラウザを閉じる
+        diagnostics.detach(session_id)
+        driver.quit()
+        logger.info(f"Monitoring stopped for session {session_id}")
+        
+    except Exception as e:
+        logger.error(f"Error in monitoring thread: {str(e)}")
+        import traceback
+        logger.error(traceback.format_exc())
+        # エラー情報をキューに送信
+        message_hub.put({"error": str(e)})
+        # エラーが発生したらブラウザを閉じる
+        diagnostics.detach(session_id)
+        try:
+            if driver:
+                driver.quit()
+        except:
+            pass
+
+# スクレイパーワーカープロセス数（0ならこのプロセス内のスレッドで監視する）
+SCRAPER_WORKERS = int(os.environ.get('SCRAPER_WORKERS', '0'))
+# ワーカーがセッションの統計をコーディネーターへ送る間隔（秒）
+WORKER_STATS_INTERVAL = 2
+# ワーカーが重複排除インデックスの書き出し（チェックポイントと同じ形式）をコーディネーターへ送る間隔（秒）
+WORKER_DEDUP_SYNC_INTERVAL = 10
+
+def is_child_process():
+    """multiprocessingで起動された子プロセス（スクレイパーワーカー）の中か
+    
+    spawnの子プロセスはこのモジュールを読み込み終えてからparent_process()が設定されるため、読み込み中に立っている_inheritingも見る
+    """
+    return multiprocessing.parent_process() is not None or getattr(multiprocessing.current_process(), '_inheriting', False)
+
+class WorkerSink:
+    """ワーカープロセス内でmonitor_chatの配信先となり、バッチをコーディネーターへ送る"""
+    
+    def __init__(self, session_id, send):
+        self.session_id = session_id
+        self.send = send
+    
+    def put(self, item):
+        self.send(('batch', self.session_id, item))
+
+def scraper_worker_main(conn, worker_id):
+    """スクレイパーワーカープロセスの本体（コーディネーターの指示でセッションを監視し、バッチを送り返す）"""
+    logger.info(f"Scraper worker {worker_id} started (pid {os.getpid()})")
+    if os.environ.get('BROWSER_POOL_PREWARM', '1') == '1':
+        browser_pool.start()
+    
+    send_lock = threading.Lock()
+    
+    def send(message):
+        with send_lock:
+            conn.send(message)
+    
+    sessions = {}
+    while True:
+        try:
+            if conn.poll(WORKER_STATS_INTERVAL):
+                kind, session_id, payload = conn.recv()
+                if kind == 'start':
+                    options = payload['options']
+                    stop_event = threading.Event()
+                    diagnostics.configure(session_id, options['debug_level'], options['debug_sample_every'])
+                    session = {
+                        'stop_event': stop_event,
+                        # 前のワーカーが処理済みのIDを引き継ぎ、表示中の履歴を再送しないようにする
+                        'dedup': BoundedDedupIndex.from_checkpoint(payload['dedup']),
+                        'dedup_synced_at': time.time(),
+                        'scheduler': PollScheduler(options['poll_min_interval'], options['poll_max_interval'],
+                                                   options['poll_interval']),
+                        'liveness': LivenessMonitor(options['stale_after']),
+                        'keywords': KeywordFilter(options['keywords'])
+                    }
+                    session['thread'] = threading.Thread(
+                        target=monitor_chat,
+                        args=(options['url'], session_id, WorkerSink(session_id, send), stop_event, options['capture_mode'],
+                              session['dedup'], session['scheduler'], session['liveness'], session['keywords'],
+                              options.get('browser_profile')),
+                        daemon=True
+                    )
+                    session['thread'].start()
+                    sessions[session_id] = session
+                elif kind == 'stop' and session_id in sessions:
+                    sessions[session_id]['stop_event'].set()
+                elif kind == 'debug_configure' and session_id in sessions:
+                    diagnostics.configure(session_id, payload['level'], payload['sample_every'])
+                elif kind == 'debug_capture' and session_id in sessions:
+                    diagnostics.submit(session_id, reason='on_demand')
+            
+            # このプロセスのメトリクス（ブラウザのメモリを含む）と、動いているセッションの統計を送る
+            send(('metrics', None, metrics.dump()))
+            for session_id, session in list(sessions.items()):
+                if not session['thread'].is_alive():
+                    del sessions[session_id]
+                    diagnostics.forget(session_id)
+                    send(('ended', session_id, None))
+                    continue
+                stats = {
+                    'dedup': session['dedup'].stats(),
+                    'scheduler': session['scheduler'].stats(),
+                    'liveness': session['liveness'].stats(),
+                    'keywords': session['keywords'].stats()
+                }
+                if time.time() - session['dedup_synced_at'] >= WORKER_DEDUP_SYNC_INTERVAL:
+                    stats['dedup_state'] = session['dedup'].checkpoint(SESSION_CHECKPOINT_DEDUP_ENTRIES)
+                    session['dedup_synced_at'] = time.time()
+                # 診断のスナップショットは大きいため、新しく収集されたときだけ送る
+                stats['diagnostics'] = {'pending_jobs': diagnostics.jobs.qsize(), 'dropped_jobs': diagnostics.dropped}
+                snapshot = diagnostics.snapshot(session_id)
+                if snapshot is not None and snapshot is not session.get('debug_sent'):
+                    stats['diagnostics']['snapshot'] = snapshot
+                    session['debug_sent'] = snapshot
+                send(('stats', session_id, stats))
+        except (EOFError, OSError):
+            # コーディネーター（親プロセス）がいなくなった
+            break
+    
+    for session in sessions.values():
+        session['stop_event'].set()
+    logger.info(f"Scraper worker {worker_id} exiting")
+
+class RemoteStats:
+    """ワーカーから最後に報告された統計を保持する（スレッド方式のscheduler/livenessと同じくstats()で参照）"""
+    
+    def __init__(self):
+        self.latest = {}
+    
+    def update(self, stats):
+        self.latest = stats
+    
+    def stats(self):
+        return self.latest
+
+class RemoteDedupState:
+    """ワーカー上の重複排除インデックスの、最後に報告された書き出しと、その後にコーディネーターが受け取ったID
+    
+    コーディネーター側でインデックスを二重に持たず、チェックポイントの書き出しと、
+    ワーカーが落ちた場合に新しいワーカーへ引き継ぐ初期値にだけ使う
+    """
+    
+    def __init__(self, state):
+        self.lock = threading.Lock()
+        self.state = state
+        # 最後の書き出しの後に届いたメッセージのダイジェスト -> 受け取った時刻（次の書き出しで空にする）
+        self.recent = OrderedDict()
+        self.latest = {}
+    
+    def update(self, stats, state=None):
+        with self.lock:
+            self.latest = stats
+            if state is not None:
+                # 同じ接続で先に届いたバッチのIDは、この書き出しに含まれている
+                self.state = state
+                self.recent.clear()
+    
+    def record(self, messages, now=None):
+        now = now if now is not None else time.time()
+        with self.lock:
+            for message in messages:
+                self.recent[BoundedDedupIndex.digest(message['id'])] = now
+    
+    def checkpoint(self, limit=None):
+        """BoundedDedupIndex.checkpointと同じ形式で返す"""
+        with self.lock:
+            entries = self.state['entries'] + [[key, round(seen, 3)] for key, seen in self.recent.items()]
+        if limit is not None:
+            entries = entries[-limit:]
+        return {'capacity': self.state['capacity'], 'ttl': self.state['ttl'], 'entries': entries}
+    
+    def __len__(self):
+        return self.latest.get('size', len(self.state['entries']))
+    
+    def stats(self):
+        return self.latest or {'size': len(self), 'capacity': self.state['capacity'], 'ttl': self.state['ttl']}
+
+class RemoteDiagnostics:
+    """ワーカーから最後に報告された診断の状態（スナップショットは新しく収集されたときだけ届くため、届くまで前の値を残す）"""
+    
+    def __init__(self):
+        self.latest = {'pending_jobs': 0, 'dropped_jobs': 0, 'snapshot': None}
+    
+    def update(self, state):
+        self.latest = dict(self.latest, **state)
+    
+    def stats(self):
+        return self.latest
+
+class RemoteStopEvent(threading.Event):
+    """setするとワーカー上のセッションにも停止を指示するストップイベント"""
+    
+    def __init__(self, coordinator, session_id):
+        super().__init__()
+        self.coordinator = coordinator
+        self.session_id = session_id
+    
+    def set(self):
+        super().set()
+        self.coordinator.stop_session(self.session_id)
+
+class WorkerSessionHandle:
+    """ワーカープロセスで動くセッションを、監視スレッドと同じように扱うためのハンドル"""
+    
+    def __init__(self, coordinator, session_id):
+        self.coordinator = coordinator
+        self.session_id = session_id
+        self.finished = threading.Event()
+    
+    def is_alive(self):
+        return not self.finished.is_set()
+    
+    def join(self, timeout=None):
+        self.finished.wait(timeout)
+
+class ScraperCoordinator:
+    """セッションをスクレイパーワーカープロセスに割り当て、返ってきたバッチを配信ハブへ渡すコーディネーター
+    
+    ワーカーが落ちた場合は同じ枠に新しいワーカーを起動し、そのワーカーのセッションを割り当て直す
+    """
+    
+    def __init__(self, worker_count):
+        self.worker_count = worker_count
+        self.context = multiprocessing.get_context('spawn')
+        self.lock = threading.RLock()
+        self.workers = {}
+        self.sessions = {}
+        self.supervisor = None
+        self.closing = False
+        self.restarts = 0
+        self.rebalanced_sessions = 0
+        # ワーカーID -> 最後に報告されたメトリクス
+        self.worker_metrics = {}
+    
+    @property
+    def enabled(self):
+        return self.worker_count > 0
+    
+    def start(self):
+        """ワーカーを起動する（起動済みなら何もしない）"""
+        with self.lock:
+            if self.supervisor is not None:
+                return
+            for worker_id in range(self.worker_count):
+                self._spawn(worker_id)
+            self.supervisor = threading.Thread(target=self._supervise, daemon=True)
+            self.supervisor.start()
+            atexit.register(self.shutdown)
+    
+    def shutdown(self):
+        """プロセス終了時にワーカーを止める（止めたワーカーを起動し直さないようにする）"""
+        with self.lock:
+            self.closing = True
+            workers = list(self.workers.values())
+        for worker in workers:
+            worker['conn'].close()
+            worker['process'].join(timeout=5)
+            if worker['process'].is_alive():
+                worker['process'].terminate()
+    
+    def _spawn(self, worker_id):
+        parent_conn, child_conn = self.context.Pipe()
+        process = self.context.Process(target=scraper_worker_main, args=(child_conn, worker_id), daemon=True)
+        process.start()
+        child_conn.close()
+        self.workers[worker_id] = {
+            'process': process,
+            'conn': parent_conn,
+            'sessions': set(),
+            'started_at': datetime.now().isoformat()
+        }
+        logger.info(f"Spawned scraper worker {worker_id} (pid {process.pid})")
+    
+    def _send(self, worker_id, message):
+        try:
+            self.workers[worker_id]['conn'].send(message)
+        except (OSError, ValueError) as send_err:
+            # 落ちたワーカーは監視スレッドが検知して割り当て直す
+            logger.error(f"Failed to send to scraper worker {worker_id}: {str(send_err)}")
+    
+    def _assign(self, session_id):
+        """最もセッションの少ないワーカーにセッションを割り当てる"""
+        worker_id = min(self.workers, key=lambda w: len(self.workers[w]['sessions']))
+        session = self.sessions[session_id]
+        session['worker_id'] = worker_id
+        self.workers[worker_id]['sessions'].add(session_id)
+        self._send(worker_id, ('start', session_id, {
+            'options': session['options'],
+            'dedup': session['dedup'].checkpoint(SESSION_CHECKPOINT_DEDUP_ENTRIES)
+        }))
+        return worker_id
+    
+    def start_session(self, session_id, options, hub, dedup_index):
+        """セッションをワーカーで開始し、スレッドの代わりに使うハンドルとストップイベントを返す
+        
+        dedup_indexの内容（チェックポイントから復元した場合など）はワーカーのインデックスの初期値として渡し、こちらでは保持しない
+        """
+        self.start()
+        handle = WorkerSessionHandle(self, session_id)
+        with self.lock:
+            self.sessions[session_id] = {
+                'options': options,
+                'hub': hub,
+                'dedup': RemoteDedupState(dedup_index.checkpoint(SESSION_CHECKPOINT_DEDUP_ENTRIES)),
+                'handle': handle,
+                'scheduler': RemoteStats(),
+                'liveness': RemoteStats(),
+                'keywords': RemoteStats(),
+                'diagnostics': RemoteDiagnostics(),
+                'worker_id': None,
+                'stopping': False
+            }
+            worker_id = self._assign(session_id)
+        logger.info(f"Assigned session {session_id} to scraper worker {worker_id}")
+        return handle, RemoteStopEvent(self, session_id)
+    
+    def stop_session(self, session_id):
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session and session['worker_id'] is not None:
+                session['stopping'] = True
+                self._send(session['worker_id'], ('stop', session_id, None))
+    
+    def configure_debug(self, session_id, setting):
+        """ワーカー上のセッションの診断レベルを変更する（割り当て直した場合も新しいワーカーに引き継ぐ）"""
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                return False
+            session['options']['debug_level'] = setting['level']
+            session['options']['debug_sample_every'] = setting['sample_every']
+            self._send(session['worker_id'], ('debug_configure', session_id,
+                                              {'level': setting['level'], 'sample_every': setting['sample_every']}))
+            return True
+    
+    def capture_debug(self, session_id):
+        """ワーカー上のセッションの診断情報を収集させる（結果は次の統計の報告で届く）"""
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                return False
+            self._send(session['worker_id'], ('debug_capture', session_id, None))
+            return True
+    
+    def debug_state(self, session_id):
+        """ワーカーから報告された診断の状態（待ちジョブ数・破棄数・最新のスナップショット。セッションがなければNone）"""
+        session = self.sessions.get(session_id)
+        return session['diagnostics'].stats() if session is not None else None
+    
+    def remote_stats(self, session_id):
+        """ワーカーから報告されたdedup/scheduler/liveness/keywordsの統計オブジェクトを返す"""
+        session = self.sessions[session_id]
+        return session['dedup'], session['scheduler'], session['liveness'], session['keywords']
+    
+    def _supervise(self):
+        """ワーカーからのメッセージを受け取り、落ちたワーカーを検知する"""
+        while not self.closing:
+            with self.lock:
+                conns = {worker['conn']: worker_id for worker_id, worker in self.workers.items()}
+                sentinels = {worker['process'].sentinel: worker_id for worker_id, worker in self.workers.items()}
+            
+            for ready in wait_connections(list(conns) + list(sentinels), timeout=1):
+                if ready in sentinels:
+                    worker_id = sentinels[ready]
+                    # 落ちる直前に送られたメッセージを先に処理する
+                    self._drain(worker_id)
+                    self._on_worker_exit(worker_id)
+                elif ready in conns:
+                    self._drain(conns[ready])
+    
+    def _drain(self, worker_id):
+        conn = self.workers[worker_id]['conn']
+        try:
+            while conn.poll():
+                self._handle(worker_id, conn.recv())
+        except (EOFError, OSError):
+            pass
+    
+    def _handle(self, worker_id, message):
+        kind, session_id, payload = message
+        if kind == 'metrics':
+            self.worker_metrics[worker_id] = payload
+            return
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None or session['worker_id'] != worker_id:
+                return
+            if kind == 'ended':
+                self.sessions.pop(session_id)
+                self.workers[worker_id]['sessions'].discard(session_id)
+                session['handle'].finished.set()
+                return
+        
+        if kind == 'stats':
+            session['dedup'].update(payload['dedup'], payload.get('dedup_state'))
+            session['scheduler'].update(payload['scheduler'])
+            session['liveness'].update(payload['liveness'])
+            session['keywords'].update(payload['keywords'])
+            session['diagnostics'].update(payload['diagnostics'])
+        elif kind == 'batch':
+            if isinstance(payload, list):
+                # 重複はワーカー側で除かれている。ワーカーが落ちた場合に引き継ぐため、次の書き出しまでIDを控える
+                session['dedup'].record(payload)
+            session['hub'].put(payload)
+    
+    def _on_worker_exit(self, worker_id):
+        """落ちたワーカーを起動し直し、そのワーカーのセッションを割り当て直す"""
+        with self.lock:
+            if self.closing:
+                return
+            worker = self.workers[worker_id]
+            worker['process'].join(timeout=1)
+            logger.error(f"Scraper worker {worker_id} (pid {worker['process'].pid}) exited with code {worker['process'].exitcode}")
+            orphaned = worker['sessions']
+            worker['conn'].close()
+            # 落ちたワーカーのカウンターを引き継ぎ、起動し直しても値が戻らないようにする
+            last_metrics = self.worker_metrics.pop(worker_id, None)
+            if last_metrics is not None:
+                metrics.absorb(last_metrics)
+            self.restarts += 1
+            self._spawn(worker_id)
+            for session_id in orphaned:
+                session = self.sessions[session_id]
+                if session['stopping']:
+                    # 停止を指示済みのセッションは割り当て直さずに終了扱いにする
+                    self.sessions.pop(session_id)
+                    session['handle'].finished.set()
+                    continue
+                new_worker_id = self._assign(session_id)
+                self.rebalanced_sessions += 1
+                logger.info(f"Reassigned session {session_id} to scraper worker {new_worker_id}")
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'workers': [
+                    {
+                        'worker_id': worker_id,
+                        'pid': worker['process'].pid,
+                        'alive': worker['process'].is_alive(),
+                        'sessions': len(worker['sessions']),
+                        'started_at': worker['started_at']
+                    }
+                    for worker_id, worker in sorted(self.workers.items())
+                ],
+                'restarts': self.restarts,
+                'rebalanced_sessions': self.rebalanced_sessions
+            }
+
+scraper_coordinator = ScraperCoordinator(SCRAPER_WORKERS)
+
+# メッセージ履歴を保存するSQLiteファイル（空にすると保存しない）と、1回のトランザクションでまとめて書き込む件数・待ち時間（秒）
+# 既定ではアプリのディレクトリのdata/に置く（コンテナではボリュームにして、再起動しても履歴が残るようにする）
+MESSAGE_STORE_PATH = os.environ.get('MESSAGE_STORE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'chat-messages.sqlite3'))
+MESSAGE_STORE_BATCH_SIZE = int(os.environ.get('MESSAGE_STORE_BATCH_SIZE', '500'))
+MESSAGE_STORE_FLUSH_INTERVAL = float(os.environ.get('MESSAGE_STORE_FLUSH_INTERVAL', '0.5'))
+# 書き込み待ちのバッチ数の上限（超えた分は破棄して監視ループを待たせない）
+MESSAGE_STORE_MAX_PENDING = int(os.environ.get('MESSAGE_STORE_MAX_PENDING', '1000'))
+# /api/messagesで1回に返す件数の既定値と上限
+MESSAGE_PAGE_SIZE = 100
+MESSAGE_MAX_PAGE_SIZE = 500
+
+# 整形済みテキストの末尾からユーザー名を取り出す（【ユーザー名】の形式）
+MESSAGE_USERNAME_PATTERN = re.compile(r'【([^】]*)】\s*$')
+
+MESSAGE_STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT NOT NULL,
+    message_id TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    type TEXT NOT NULL,
+    username TEXT,
+    text TEXT NOT NULL,
+    checked INTEGER NOT NULL DEFAULT 0,
+    payload TEXT NOT NULL,
+    UNIQUE (session_id, message_id)
+);
+CREATE INDEX IF NOT EXISTS messages_session_seq ON messages (session_id, seq);
+CREATE INDEX IF NOT EXISTS messages_session_timestamp ON messages (session_id, timestamp);
+CREATE INDEX IF NOT EXISTS messages_session_user ON messages (session_id, username);
+CREATE INDEX IF NOT EXISTS messages_session_type ON messages (session_id, type);
+"""
+
+class MessageStore:
+    """配信したメッセージをSQLite（WALモード）に追記する履歴ストア
+    
+    書き込みは専用スレッドがまとめて1つのトランザクションで行い、読み出しは呼び出し元のスレッドで別の接続を使う
+    """
+    
+    def __init__(self, path, batch_size=None, flush_interval=None, max_pending=None):
+        self.path = path
+        self.batch_size = max(1, int(batch_size or MESSAGE_STORE_BATCH_SIZE))
+        self.flush_interval = MESSAGE_STORE_FLUSH_INTERVAL if flush_interval is None else float(flush_interval)
+        self.jobs = Queue(maxsize=int(max_pending or MESSAGE_STORE_MAX_PENDING))
+        self.lock = threading.Lock()
+        self.thread = None
+        self.ready = threading.Event()
+        self.error = None
+        self.written = 0
+        self.duplicates = 0
+        self.transactions = 0
+        self.dropped = 0
+        self.checked_updates = 0
+    
+    @property
+    def enabled(self):
+        return bool(self.path)
+    
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=10)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+    
+    def _spawn(self):
+        """書き込みスレッドを起動する（起動済みなら何もしない。スキーマの作成は待たない）"""
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+    
+    def start(self):
+        """書き込みスレッドを起動し、スキーマの作成を待つ（サーバーの起動時に呼ばれる。起動済みなら何もしない）"""
+        if not self.enabled:
+            return
+        self._spawn()
+        self.ready.wait(10)
+    
+    def append(self, session_id, messages):
+        """配信したバッチを書き込み待ちに積む（監視側を待たせないよう、スキーマの作成は待たず、溢れた場合は破棄する）"""
+        if not self.enabled or not isinstance(messages, list) or not messages:
+            return False
+        # 通常はサーバーの起動時に起動済み。書き込みスレッドは積まれた分をスキーマの作成後に書き込む
+        self._spawn()
+        if self.error:
+            return False
+        try:
+            self.jobs.put_nowait(('messages', session_id, messages))
+            return True
+        except Full:
+            with self.lock:
+                self.dropped += len(messages)
+            return False
+    
+    def set_checked(self, session_id, message_ids, checked):
+        """チェック状態の変更を書き込み待ちに積む（メッセージの追記と同じ順序で反映される）"""
+        if not self.enabled:
+            return False
+        self.start()
+        if self.error:
+            return False
+        self.jobs.put(('checked', session_id, (list(message_ids), bool(checked))), timeout=5)
+        return True
+    
+    def _run(self):
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = self._connect()
+            connection.executescript(MESSAGE_STORE_SCHEMA)
+            connection.commit()
+        except Exception as db_err:
+            self.error = str(db_err)
+            logger.error(f"Failed to open message store {self.path}: {self.error}")
+            self.ready.set()
+            return
+        self.ready.set()
+        logger.info(f"Message store opened at {self.path}")
+        
+        while True:
+            jobs = [self.jobs.get()]
+            rows = len(jobs[0][2]) if jobs[0][0] == 'messages' else 1
+            # 続けて届くバッチを少し待ってまとめ、1つのトランザクションで書き込む
+            deadline = time.time() + self.flush_interval
+            while rows < self.batch_size:
+                try:
+                    job = self.jobs.get(timeout=max(0, deadline - time.time()))
+                except Empty:
+                    break
+                jobs.append(job)
+                rows += len(job[2]) if job[0] == 'messages' else 1
+            try:
+                self._write(connection, jobs)
+            except Exception as write_err:
+                logger.error(f"Failed to write {len(jobs)} jobs to message store: {str(write_err)}")
+                connection.rollback()
+    
+    def _write(self, connection, jobs):
+        written = duplicates = checked_updates = 0
+        with connection:
+            for kind, session_id, payload in jobs:
+                if kind == 'messages':
+                    before = connection.total_changes
+                    connection.executemany(
+                        'INSERT OR IGNORE INTO messages (session_id, message_id, timestamp, type, username, text, checked, payload) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                        [self._row(session_id, message) for message in payload]
+                    )
+                    inserted = connection.total_changes - before
+                    written += inserted
+                    duplicates += len(payload) - inserted
+                else:
+                    message_ids, checked = payload
+                    before = connection.total_changes
+                    connection.executemany(
+                        'UPDATE messages SET checked = ? WHERE session_id = ? AND message_id = ?',
+                        [(int(checked), session_id, message_id) for message_id in message_ids]
+                    )
+                    checked_updates += connection.total_changes - before
+        with self.lock:
+            self.written += written
+            self.duplicates += duplicates
+            self.checked_updates += checked_updates
+            self.transactions += 1
+    
+    @staticmethod
+    def _row(session_id, message):
+        text = message.get('text', '')
+        username = message.get('username')
+        if username is None:
+            match = MESSAGE_USERNAME_PATTERN.search(text)
+            username = match.group(1) if match else None
+        return (
+            session_id,
+            message['id'],
+            message.get('timestamp') or datetime.now().isoformat(),
+            message.get('type', ''),
+            username,
+            text,
+            int(bool(message.get('checked'))),
+            json.dumps(message, ensure_ascii=False)
+        )
+    
+    def query(self, session_id=None, cursor=None, limit=None, order='desc', types=None, username=None,
+              since=None, until=None, checked=None, text=None):
+        """条件に合うメッセージを1ページ分返す（cursorは前のページのnext_cursor）"""
+        self.start()
+        if self.error:
+            raise RuntimeError(self.error)
+        limit = min(max(1, int(limit or MESSAGE_PAGE_SIZE)), MESSAGE_MAX_PAGE_SIZE)
+        if order not in ('asc', 'desc'):
+            raise ValueError('order must be asc or desc')
+        
+        clauses = []
+        params = []
+        if session_id:
+            clauses.append('session_id = ?')
+            params.append(session_id)
+        if cursor is not None:
+            clauses.append('seq > ?' if order == 'asc' else 'seq < ?')
+            params.append(int(cursor))
+        if types:
+            clauses.append(f"type IN ({', '.join('?' for _ in types)})")
+            params.extend(types)
+        if username:
+            clauses.append('username = ?')
+            params.append(username)
+        if since:
+            clauses.append('timestamp >= ?')
+            params.append(since)
+        if until:
+            clauses.append('timestamp < ?')
+            params.append(until)
+        if checked is not None:
+            clauses.append('checked = ?')
+            params.append(int(checked))
+        if text:
+            clauses.append("text LIKE ? ESCAPE '\\'")
+            params.append('%' + text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+        
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        sql = (f"SELECT seq, session_id, checked, payload FROM messages {where} "
+               f"ORDER BY seq {order.upper()} LIMIT ?")
+        connection = sqlite3.connect(self.path, timeout=10)
+        try:
+            rows = connection.execute(sql, params + [limit + 1]).fetchall()
+        finally:
+            connection.close()
+        
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        messages = []
+        for seq, row_session_id, row_checked, payload in rows:
+            message = json.loads(payload)
+            message['checked'] = bool(row_checked)
+            message['session_id'] = row_session_id
+            message['seq'] = seq
+            messages.append(message)
+        return {
+            'messages': messages,
+            'next_cursor': str(rows[-1][0]) if has_more else None
+        }
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'enabled': self.enabled,
+                'path': self.path or None,
+                'error': self.error,
+                'pending_jobs': self.jobs.qsize(),
+                'written': self.written,
+                'duplicates': self.duplicates,
+                'transactions': self.transactions,
+                'dropped': self.dropped,
+                'checked_updates': self.checked_updates
+            }
+
+message_store = MessageStore(MESSAGE_STORE_PATH)
+
+# 同時に監視できるセッション数の上限、購読者がいないセッションを回収するまでの時間（秒）、
+# 回収処理の間隔（秒）と、停止時に監視スレッドの終了を待つ時間（秒）
+MAX_SESSIONS = int(os.environ.get('MAX_SESSIONS', '16'))
+SESSION_IDLE_TTL = int(os.environ.get('SESSION_IDLE_TTL', '120'))
+SESSION_REAP_INTERVAL = 10
+SESSION_JOIN_TIMEOUT = 30
+
+# 共有キーの作成時に取り除くクエリパラメータ（流入元の計測用で、表示する配信には影響しない）
+TRACKING_QUERY_PARAMS = ('fbclid', 'gclid', 'ref')
+
+def normalize_stream_url(url):
+    """同じ配信を指すURLが同じ文字列になるよう正規化する（共有キーに使う）"""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower() or 'https'
+    host = (parts.hostname or '').lower()
+    if parts.port and (scheme, parts.port) not in (('http', 80), ('https', 443)):
+        host = f"{host}:{parts.port}"
+    path = parts.path.rstrip('/') or '/'
+    query = urlencode(sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not key.lower().startswith('utm_') and key.lower() not in TRACKING_QUERY_PARAMS
+    ))
+    return urlunsplit((scheme, host, path, query, ''))
+
+class SessionManager:
+    """監視セッションの登録・同時実行数の制限・停止（スレッドの終了待ち）・放置セッションの回収を行う
+    
+    同じURLの監視は1つのスクレイプを共有し、開始要求ごとに発行するセッションID（保有者）を参照カウントとして扱う
+    """
+    
+    def __init__(self, max_sessions, idle_ttl):
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.lock = threading.RLock()
+        # セッションID（保有者） -> スクレイプ。共有中は複数のIDが同じスクレイプを指す
+        self.sessions = {}
+        # 共有キー -> スクレイプ
+        self.by_share_key = {}
+        # 開始処理中のセッションと、停止後にスレッドの終了を待っているセッション（どちらもブラウザを使うため上限に数える）
+        self.reserved = set()
+        self.stopping = {}
+        # チェックポイントから読み戻し、まだ起動していないスクレイプ（スクレイプID -> チェックポイントの記録）
+        self.restorable = {}
+        self.reaper = None
+        self.reaped = 0
+        self.rejected = 0
+        self.leaked = 0
+        self.attached = 0
+        self.revived = 0
+    
+    def __contains__(self, session_id):
+        return session_id in self.sessions
+    
+    def get(self, session_id):
+        return self.sessions.get(session_id)
+    
+    def resume(self, session_id):
+        """セッションを返す（チェックポイントから読み戻したスクレイプの保有者であれば、ここで起動する）"""
+        session = self.sessions.get(session_id)
+        if session is None and self.restorable:
+            session = self.revive(holder_id=session_id)
+        return session
+    
+    def scrape_id_of(self, session_id):
+        """保有者IDに対応するスクレイプのID（起動前の復元待ちのものを含む。見つからなければNone）"""
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is not None:
+                return session['scrape_id']
+            record = self._find_restorable(holder_id=session_id)
+            return record['scrape_id'] if record is not None else None
+    
+    def scrapes(self):
+        """重複を除いたスクレイプの一覧"""
+        with self.lock:
+            return list({session['scrape_id']: session for session in self.sessions.values()}.values())
+    
+    def _in_use(self):
+        running = sum(1 for session in self.scrapes() if session['thread'].is_alive())
+        return running + len(self.reserved) + len(self.stopping)
+    
+    def attach(self, share_key, session_id):
+        """同じ共有キーのスクレイプが動いていれば保有者として加え、そのスクレイプを返す（なければNone）"""
+        with self.lock:
+            if share_key not in self.by_share_key and self.restorable:
+                self.revive(share_key=share_key)
+            session = self.by_share_key.get(share_key)
+            if session is None or not session['thread'].is_alive():
+                return None
+            session['holders'].add(session_id)
+            self.sessions[session_id] = session
+            self.attached += 1
+        logger.info(f"Session {session_id} attached to scrape {session['scrape_id']} ({len(session['holders'])} holders)")
+        return session
+    
+    def reserve(self, session_id):
+        """上限に空きがあれば枠を確保してNone、なければ再試行までの目安の秒数を返す"""
+        with self.lock:
+            if self._in_use() < self.max_sessions:
+                self.reserved.add(session_id)
+                return None
+            self.rejected += 1
+            return self._retry_after()
+    
+    def _retry_after(self):
+        """最も早く空きそうな時刻から再試行の目安を求める（停止中のセッションか、回収予定のセッション）"""
+        now = time.time()
+        if self.stopping:
+            return max(1, int(min(self.stopping.values()) + SESSION_JOIN_TIMEOUT - now))
+        idle = [self.idle_ttl - session['hub'].idle_seconds(now)
+                for session in self.scrapes() if session['hub'].idle_since is not None]
+        if idle:
+            return max(1, int(min(idle)) + SESSION_REAP_INTERVAL)
+        return self.idle_ttl
+    
+    def register(self, session_id, session):
+        """新しいスクレイプを登録する（開始したセッションIDが最初の保有者になる）"""
+        with self.lock:
+            self.reserved.discard(session_id)
+            session['scrape_id'] = session_id
+            session['holders'] = {session_id}
+            self.sessions[session_id] = session
+            if session.get('share_key'):
+                self.by_share_key[session['share_key']] = session
+            self._ensure_reaper()
+    
+    def _ensure_reaper(self):
+        if self.reaper is None:
+            self.reaper = threading.Thread(target=self._reap_loop, daemon=True)
+            self.reaper.start()
+    
+    def cancel(self, session_id):
+        with self.lock:
+            self.reserved.discard(session_id)
+    
+    def stop(self, session_id, reason='requested'):
+        """保有者を外し、最後の保有者であればスクレイプを停止する（監視スレッドの終了はバックグラウンドで待つ）"""
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+            if session is None:
+                # 起動前の復元待ちのスクレイプは、保有者を外すだけで起動しない
+                return self._discard_restorable(session_id)
+            session['holders'].discard(session_id)
+            if session['holders']:
+                logger.info(f"Session {session_id} detached from scrape {session['scrape_id']} ({len(session['holders'])} holders left)")
+                return session
+            if self.by_share_key.get(session.get('share_key')) is session:
+                del self.by_share_key[session['share_key']]
+            scrape_id = session['scrape_id']
+            self.stopping[scrape_id] = time.time()
+        
+        logger.info(f"Stopping scrape {scrape_id} ({reason})")
+        session['stop_event'].set()
+        session['hub'].close()
+        diagnostics.forget(scrape_id)
+        threading.Thread(target=self._join, args=(scrape_id, session), daemon=True).start()
+        return session
+    
+    def _join(self, scrape_id, session):
+        session['thread'].join(SESSION_JOIN_TIMEOUT)
+        with self.lock:
+            self.stopping.pop(scrape_id, None)
+            if session['thread'].is_alive():
+                # ドライバー呼び出しで固まっている。ブラウザプールのヘルスチェックによる回収に任せる
+                self.leaked += 1
+                logger.error(f"Monitoring thread for session {scrape_id} did not exit within {SESSION_JOIN_TIMEOUT}s")
+    
+    def _reap_loop(self):
+        while True:
+            time.sleep(SESSION_REAP_INTERVAL)
+            try:
+                self.reap()
+            except Exception as reap_err:
+                logger.error(f"Error reaping sessions: {str(reap_err)}")
+    
+    def reap(self, now=None):
+        """購読者がいない状態がidle_ttlを超えたスクレイプを、全ての保有者ごと停止する"""
+        now = now if now is not None else time.time()
+        idle = [session for session in self.scrapes() if session['hub'].idle_seconds(now) >= self.idle_ttl]
+        for session in idle:
+            for holder_id in list(session['holders']):
+                self.stop(holder_id, reason='idle')
+            self.reaped += 1
+        # 復元後に購読者が戻ってこなかったスクレイプは、起動しないまま破棄する
+        with self.lock:
+            expired = [scrape_id for scrape_id, record in self.restorable.items()
+                       if now - record['restored_at'] >= self.idle_ttl]
+            for scrape_id in expired:
+                del self.restorable[scrape_id]
+                logger.info(f"Discarded restored scrape {scrape_id} (no subscriber within {self.idle_ttl}s)")
+        return [session['scrape_id'] for session in idle] + expired
+    
+    def checkpoint(self, dedup_limit=None):
+        """動いているスクレイプと起動前の復元待ちのスクレイプを、チェックポイントに書き出せる形で返す"""
+        with self.lock:
+            scrapes = self.scrapes()
+            pending = [dict(record, holders=sorted(record['holders'])) for record in self.restorable.values()]
+        records = []
+        for session in scrapes:
+            if not session['thread'].is_alive():
+                continue
+            records.append({
+                'scrape_id': session['scrape_id'],
+                'holders': sorted(session['holders']),
+                'share_key': session.get('share_key'),
+                'started_at': session['started_at'],
+                'settings': session['settings'],
+                'last_event_id': session['hub'].last_event_id,
+                'dedup': session['dedup'].checkpoint(dedup_limit),
+                # ワーカー方式では最後に報告された統計（報告前なら空）
+                'scheduler': session['scheduler'].stats(),
+                'aggregator': session['aggregator'].snapshot()
+            })
+        return records + pending
+    
+    def restore(self, records, now=None):
+        """チェックポイントの記録を復元待ちとして読み込む（スクレイプは保有者が戻ってきたときに起動する）"""
+        now = now if now is not None else time.time()
+        with self.lock:
+            for record in records:
+                if record['scrape_id'] in self.sessions or record['scrape_id'] in self.restorable:
+                    continue
+                self.restorable[record['scrape_id']] = dict(record, holders=set(record['holders']), restored_at=now)
+            if self.restorable:
+                self._ensure_reaper()
+            return len(self.restorable)
+    
+    def _find_restorable(self, holder_id=None, share_key=None):
+        for record in self.restorable.values():
+            if (holder_id is not None and holder_id in record['holders']) or \
+                    (share_key is not None and record.get('share_key') == share_key):
+                return record
+        return None
+    
+    def _discard_restorable(self, holder_id):
+        """復元待ちのスクレイプから保有者を外す（最後の保有者なら記録ごと破棄）。記録がなければNone"""
+        record = self._find_restorable(holder_id=holder_id)
+        if record is None:
+            return None
+        record['holders'].discard(holder_id)
+        if not record['holders']:
+            del self.restorable[record['scrape_id']]
+        return record
+    
+    def revive(self, holder_id=None, share_key=None):
+        """復元待ちのスクレイプを起動し、保有者を登録し直す（上限に空きがなければ起動せずNone）"""
+        with self.lock:
+            record = self._find_restorable(holder_id=holder_id, share_key=share_key)
+            if record is None:
+                return None
+            scrape_id = record['scrape_id']
+            if self.reserve(scrape_id) is not None:
+                logger.warning(f"Cannot restore scrape {scrape_id}: session limit ({self.max_sessions}) reached")
+                return None
+            del self.restorable[scrape_id]
+            try:
+                session = restore_scrape(record)
+            except Exception as restore_err:
+                self.cancel(scrape_id)
+                logger.error(f"Failed to restore scrape {scrape_id}: {str(restore_err)}")
+                return None
+            if scrape_id not in record['holders']:
+                # 最初の保有者は停止済みで、他の保有者が共有を続けていた
+                session['holders'].discard(scrape_id)
+                self.sessions.pop(scrape_id, None)
+            for holder in record['holders']:
+                session['holders'].add(holder)
+                self.sessions[holder] = session
+            self.revived += 1
+        logger.info(f"Restored scrape {scrape_id} from checkpoint ({len(session['holders'])} holders, last event {record['last_event_id']})")
+        return session
+    
+    def describe(self, session, now=None):
+        """一覧表示用のスクレイプの概要とリソース使用量"""
+        now = now if now is not None else time.time()
+        scrape_id = session['scrape_id']
+        hub_stats = session['hub'].stats()
+        return {
+            'session_id': scrape_id,
+            'holders': sorted(session['holders']),
+            'url': session['url'],
+            'share_key': session.get('share_key'),
+            'capture_mode': session['capture_mode'],
+            'started_at': session['started_at'],
+            'alive': session['thread'].is_alive(),
+            'subscribers': hub_stats['subscribers'],
+            'idle_seconds': round(session['hub'].idle_seconds(now), 1),
+            'resources': {
+                'browser_id': browser_pool.session_browser(scrape_id),
+                'worker_id': scraper_coordinator.sessions.get(scrape_id, {}).get('worker_id') if scraper_coordinator.enabled else None,
+                'browser': browser_pool.session_usage(scrape_id),
+                'dedup_entries': len(session['dedup']),
+                'replay_batches': hub_stats['replay_size'],
+                'buffered_batches': sum(d['buffered'] for d in hub_stats['details'])
+            }
+        }
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'active': len(self.scrapes()),
+                'holders': len(self.sessions),
+                'in_use': self._in_use(),
+                'max_sessions': self.max_sessions,
+                'stopping': len(self.stopping),
+                'idle_ttl': self.idle_ttl,
+                'attached': self.attached,
+                'reaped': self.reaped,
+                'rejected': self.rejected,
+                'leaked_threads': self.leaked,
+                'restorable': len(self.restorable),
+                'revived': self.revived
+            }
+
+session_manager = SessionManager(MAX_SESSIONS, SESSION_IDLE_TTL)
+
+# セッションのチェックポイントを書き出すファイル（空にすると保存・復元しない）と書き出す間隔（秒）
+SESSION_CHECKPOINT_PATH = os.environ.get('SESSION_CHECKPOINT_PATH', '/tmp/chat-sessions.json')
+SESSION_CHECKPOINT_INTERVAL = float(os.environ.get('SESSION_CHECKPOINT_INTERVAL', '10'))
+# 起動時に復元するチェックポイントの古さの上限（秒。クライアントが再接続を諦めている頃合い）
+SESSION_CHECKPOINT_MAX_AGE = int(os.environ.get('SESSION_CHECKPOINT_MAX_AGE', '600'))
+# 1スクレイプあたりに書き出す重複排除のID数（最後に見た順で新しい方から。ページに表示されている分を覆えればよい）
+SESSION_CHECKPOINT_DEDUP_ENTRIES = int(os.environ.get('SESSION_CHECKPOINT_DEDUP_ENTRIES', '2000'))
+# SIGTERM受信時に書き出しを待つ時間（秒）
+SESSION_CHECKPOINT_SIGTERM_TIMEOUT = 5
+SESSION_CHECKPOINT_VERSION = 1
+
+class SessionCheckpointer:
+    """セッションのURL・設定・重複排除の時間窓・最後のイベントID・チェック間隔・集計を、定期的とSIGTERM受信時に書き出す
+    
+    起動時に読み戻したスクレイプは、保有者がストリームに再接続する（または同じ共有キーで開始される）まで起動しない
+    """
+    
+    def __init__(self, path, manager, interval=None):
+        self.path = path
+        self.manager = manager
+        self.interval = float(interval or SESSION_CHECKPOINT_INTERVAL)
+        # 定期的な書き出しとSIGTERM・終了時の書き出しが重ならないようにする
+        self.lock = threading.Lock()
+        self.thread = None
+        self.previous_sigterm = None
+        self.saves = 0
+        self.failures = 0
+        self.restored = 0
+        self.last_saved_at = None
+        self.last_size = 0
+    
+    @property
+    def enabled(self):
+        return bool(self.path)
+    
+    def start(self):
+        """定期的な書き出しを始め、終了時とSIGTERM受信時にも書き出すようにする"""
+        if not self.enabled or self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+        atexit.register(self.save)
+        # シグナルハンドラーはメインスレッドでしか設定できない（サーバーが後から自前のハンドラーを設定した場合は終了時の書き出しに任せる）
+        if threading.current_thread() is threading.main_thread():
+            self.previous_sigterm = signal.signal(signal.SIGTERM, self._on_sigterm)
+    
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            self.save()
+    
+    def save(self):
+        """チェックポイントを書き出す（一時ファイルに書いてから置き換えるため、途中で落ちても前回の内容が残る）"""
+        if not self.enabled:
+            return False
+        if scraper_coordinator.closing:
+            # ワーカーを止めた後はスクレイプが終了扱いになるため、直前（SIGTERM受信時や定期）の書き出しを残す
+            return False
+        with self.lock:
+            try:
+                payload = {
+                    'version': SESSION_CHECKPOINT_VERSION,
+                    'saved_at': time.time(),
+                    'sessions': self.manager.checkpoint(SESSION_CHECKPOINT_DEDUP_ENTRIES)
+                }
+                temp_path = f"{self.path}.tmp"
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    json.dump(payload, f, ensure_ascii=False)
+                os.replace(temp_path, self.path)
+                self.saves += 1
+                self.last_saved_at = payload['saved_at']
+                self.last_size = len(payload['sessions'])
+                return True
+            except Exception as save_err:
+                self.failures += 1
+                logger.error(f"Failed to write session checkpoint {self.path}: {str(save_err)}")
+                return False
+    
+    def restore(self):
+        """前回のチェックポイントを復元待ちとして読み込み、読み込んだスクレイプ数を返す"""
+        if not self.enabled or not os.path.exists(self.path):
+            return 0
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                payload = json.load(f)
+            if payload.get('version') != SESSION_CHECKPOINT_VERSION:
+                logger.warning(f"Ignoring session checkpoint {self.path} with unknown version {payload.get('version')}")
+                return 0
+            age = time.time() - payload['saved_at']
+            if age > SESSION_CHECKPOINT_MAX_AGE:
+                logger.info(f"Ignoring session checkpoint {self.path} written {age:.0f}s ago")
+                return 0
+            self.restored = self.manager.restore(payload['sessions'])
+        except (OSError, ValueError, KeyError, TypeError) as restore_err:
+            logger.error(f"Failed to read session checkpoint {self.path}: {str(restore_err)}")
+            return 0
+        logger.info(f"Restored {self.restored} scrape(s) from session checkpoint {self.path} (started on reconnect)")
+        return self.restored
+    
+    def _on_sigterm(self, signum, frame):
+        """書き出してから元のハンドラーに任せる（元がデフォルトの動作なら終了する）"""
+        # シグナルはメインスレッドで処理されるため、ロックを持ったまま割り込んでいても固まらないよう別スレッドで書き出す
+        writer = threading.Thread(target=self.save, daemon=True)
+        writer.start()
+        writer.join(SESSION_CHECKPOINT_SIGTERM_TIMEOUT)
+        previous = self.previous_sigterm
+        if callable(previous):
+            previous(signum, frame)
+        elif previous != signal.SIG_IGN:
+            raise SystemExit(128 + signum)
+    
+    def stats(self):
+        return {
+            'path': self.path,
+            'enabled': self.enabled,
+            'interval': self.interval,
+            'saves': self.saves,
+            'failures': self.failures,
+            'restored': self.restored,
+            'last_saved_at': self.last_saved_at,
+            'last_sessions': self.last_size
+        }
+
+session_checkpointer = SessionCheckpointer(SESSION_CHECKPOINT_PATH, session_manager)
+
+@metrics.collector
+def collect_session_metrics():
+    """セッション数・購読者数・配信待ちのバッチ数・バックグラウンド処理の待ち件数"""
+    scrapes = session_manager.scrapes()
+    yield 'chat_sessions', {}, len(scrapes)
+    yield 'chat_session_holders', {}, len(session_manager.sessions)
+    for session in scrapes:
+        hub = session['hub']
+        with hub.lock:
+            subscriptions = list(hub.subscribers.values())
+        labels = {'session_id': session['scrape_id'], 'capture_mode': session['capture_mode']}
+        yield 'chat_sse_subscribers', labels, len(subscriptions)
+        yield 'chat_subscriber_buffered_batches', labels, sum(len(s.buffer) for s in subscriptions)
+    yield 'chat_message_store_pending_jobs', {}, message_store.jobs.qsize()
+    yield 'chat_diagnostics_pending_jobs', {}, diagnostics.jobs.qsize()
+
+metrics.gauge('chat_sessions', 'Running scrapes')
+metrics.gauge('chat_session_holders', 'Session ids holding a scrape')
+metrics.gauge('chat_sse_subscribers', 'Connected SSE subscribers per scrape')
+metrics.gauge('chat_subscriber_buffered_batches', 'Batches waiting in subscriber buffers per scrape')
+metrics.gauge('chat_message_store_pending_jobs', 'Batches waiting to be written to the message store')
+metrics.gauge('chat_diagnostics_pending_jobs', 'Diagnostic captures waiting to run')
+
+def launch_scrape(session_id, settings, share_key, dedup_index, scheduler, liveness, keyword_filter,
+                  aggregator=None, last_event_id=0, started_at=None):
+    """枠を確保済みのセッションIDでスクレイプを起動し、セッションマネージャーに登録する（新規開始とチェックポイントからの復元で共通）
+    
+    settingsは検証済みの設定値（ワーカー方式ではそのままワーカーに渡し、チェックポイントにも書き出す）
+    """
+    # セッション用の配信ハブを作成（配信したメッセージは履歴ストアへの追記と集計も行う）
+    aggregator = aggregator or SessionAggregator()
+    message_hub = BroadcastHub(archive=functools.partial(message_store.append, session_id), aggregator=aggregator)
+    # 復元したスクレイプは前回のイベントIDの続きから振り、再接続したクライアントのLast-Event-IDがそのまま使えるようにする
+    message_hub.last_event_id = last_event_id
+    
+    try:
+        if scraper_coordinator.enabled:
+            # ワーカープロセスで監視する（設定値は検証済みのオブジェクトから渡す）
+            monitoring_thread, stop_event = scraper_coordinator.start_session(session_id, settings, message_hub, dedup_index)
+            dedup_index, scheduler, liveness, keyword_filter = scraper_coordinator.remote_stats(session_id)
+        else:
+            # モニタリングスレッドを開始
+            stop_event = threading.Event()
+            monitoring_thread = threading.Thread(
+                target=monitor_chat,
+                args=(settings['url'], session_id, message_hub, stop_event, settings['capture_mode'],
+                      dedup_index, scheduler, liveness, keyword_filter, settings.get('browser_profile'))
+            )
+            monitoring_thread.daemon = True
+            monitoring_thread.start()
+    except Exception:
+        # 確保した枠を返す（返さないと、起動していないセッションが上限に数えられ続ける）
+        session_manager.cancel(session_id)
+        diagnostics.forget(session_id)
+        raise
+    
+    session = {
+        'thread': monitoring_thread,
+        'stop_event': stop_event,
+        'hub': message_hub,
+        'share_key': share_key,
+        'url': settings['url'],
+        'capture_mode': settings['capture_mode'],
+        'settings': settings,
+        'dedup': dedup_index,
+        'scheduler': scheduler,
+        'liveness': liveness,
+        'keywords': keyword_filter,
+        'aggregator': aggregator,
+        'started_at': started_at or datetime.now().isoformat()
+    }
+    session_manager.register(session_id, session)
+    return session
+
+def restore_scrape(record):
+    """チェックポイントの記録からスクレイプを起動し直す（重複排除の時間窓・チェック間隔・集計・イベントIDを引き継ぐ）"""
+    scrape_id = record['scrape_id']
+    settings = dict(record['settings'])
+    if is_replay_url(settings['url']) and not REPLAY_ENABLED:
+        raise ValueError('replay URLs require REPLAY_ENABLED=1')
+    dedup_index = BoundedDedupIndex.from_checkpoint(record['dedup'])
+    if record.get('scheduler'):
+        scheduler = PollScheduler.from_checkpoint(record['scheduler'])
+    else:
+        scheduler = PollScheduler(settings['poll_min_interval'], settings['poll_max_interval'], settings['poll_interval'])
+    settings['poll_interval'] = scheduler.interval
+    liveness = LivenessMonitor(settings['stale_after'])
+    keyword_filter = KeywordFilter(settings['keywords'])
+    diagnostics.configure(scrape_id, settings['debug_level'], settings['debug_sample_every'])
+    return launch_scrape(scrape_id, settings, record.get('share_key'), dedup_index, scheduler, liveness, keyword_filter,
+                         aggregator=SessionAggregator.from_checkpoint(record['aggregator']),
+                         last_event_id=record['last_event_id'], started_at=record.get('started_at'))
+
+@app.route('/api/start-monitoring', methods=['POST'])
+def start_monitoring():
+    """モニタリングセッションを開始するエンドポイント"""
+    data = request.json
+    url = data.get('url')
+    
+    if not url:
+        return jsonify({"error": "URLが必要です"}), 400
+    
+    capture_mode = data.get('capture_mode', DEFAULT_CAPTURE_MODE)
+    if capture_mode not in CAPTURE_MODES:
+        return jsonify({"error": f"capture_modeは{', '.join(CAPTURE_MODES)}のいずれかを指定してください"}), 400
+    
+    if is_replay_url(url):
+        if not REPLAY_ENABLED:
+            return jsonify({"error": "replay://のURLはREPLAY_ENABLED=1で起動した場合のみ使用できます"}), 400
+        if capture_mode == 'network':
+            return jsonify({"error": "replay://のURLではnetworkモードは使用できません"}), 400
+    
+    debug_level = data.get('debug_level', DEFAULT_DIAGNOSTIC_LEVEL)
+    if debug_level not in DIAGNOSTIC_LEVELS:
+        return jsonify({"error": f"debug_levelは{', '.join(DIAGNOSTIC_LEVELS)}のいずれかを指定してください"}), 400
+    
+    browser_profile = data.get('browser_profile', DEFAULT_BROWSER_PROFILE)
+    if browser_profile not in BROWSER_PROFILES:
+        return jsonify({"error": f"browser_profileは{', '.join(BROWSER_PROFILES)}のいずれかを指定してください"}), 400
+    
+    # 新しいセッションIDを生成
+    session_id = str(uuid.uuid4())
+    try:
+        dedup_index = BoundedDedupIndex(data.get('dedup_capacity'), data.get('dedup_ttl'))
+        scheduler = PollScheduler(data.get('poll_min_interval'), data.get('poll_max_interval'), initial_poll_interval(capture_mode))
+        liveness = LivenessMonitor(data.get('stale_after'))
+        diagnostics.configure(session_id, debug_level, data.get('debug_sample_every'))
+    except (TypeError, ValueError):
+        return jsonify({"error": "dedup_capacity・dedup_ttl・debug_sample_every・poll_min_interval・poll_max_interval・stale_afterは正しい数値で指定してください"}), 400
+    
+    try:
+        keyword_filter = KeywordFilter(data.get('keywords'))
+    except re.error as pattern_err:
+        diagnostics.forget(session_id)
+        return jsonify({"error": f"keywordsの正規表現が正しくありません: {pattern_err}"}), 400
+    except (TypeError, ValueError, AttributeError):
+        diagnostics.forget(session_id)
+        return jsonify({"error": f"keywordsにはinclude・exclude・patterns・exclude_patterns（文字列の配列、合計{KEYWORD_MAX_TERMS}件まで）、"
+                                 f"types（{', '.join(KEYWORD_MESSAGE_TYPES)}）、case_sensitiveを指定してください"}), 400
+    
+    # 同じURLを同じ取得方式・ブラウザプロファイル・キーワード条件で監視中のスクレイプがあれば、新しくブラウザを使わずにそれを共有する
+    share_key = None
+    if data.get('share', True):
+        share_key = f"{capture_mode}:{browser_profile}:{normalize_stream_url(url)}"
+        if keyword_filter.enabled:
+            share_key = f"{share_key}#{keyword_filter.fingerprint}"
+    shared = session_manager.attach(share_key, session_id) if share_key else None
+    if shared is not None:
+        diagnostics.forget(session_id)
+        return jsonify({
+            "session_id": session_id,
+            "message": "監視中のセッションを共有しました",
+            "capture_mode": shared['capture_mode'],
+            "browser_profile": shared['settings'].get('browser_profile'),
+            "shared": True,
+            "holders": len(shared['holders']),
+            "scrape_id": shared['scrape_id'],
+            "stream_url": f"/api/stream/{session_id}"
+        })
+    
+    # 同時セッション数の上限に達していれば断る（ブラウザを起動しすぎてメモリ不足になるのを防ぐ）
+    retry_after = session_manager.reserve(session_id)
+    if retry_after is not None:
+        diagnostics.forget(session_id)
+        response = jsonify({
+            "error": f"同時に監視できるセッション数の上限（{session_manager.max_sessions}）に達しています。しばらくしてから再試行してください",
+            "retry_after": retry_after
+        })
+        response.headers['Retry-After'] = str(retry_after)
+        return response, 429
+    
+    launch_scrape(session_id, {
+        'url': url,
+        'capture_mode': capture_mode,
+        'dedup_capacity': dedup_index.capacity,
+        'dedup_ttl': dedup_index.ttl,
+        'poll_min_interval': scheduler.min_interval,
+        'poll_max_interval': scheduler.max_interval,
+        'poll_interval': scheduler.interval,
+        'stale_after': liveness.base_stale_after,
+        'keywords': keyword_filter.spec,
+        'debug_level': debug_level,
+        'debug_sample_every': diagnostics.setting(session_id)['sample_every'],
+        'browser_profile': browser_profile
+    }, share_key, dedup_index, scheduler, liveness, keyword_filter)
+    
+    return jsonify({
         "session_id": session_id,
         "message": "モニタリングを開始しました",
+        "capture_mode": capture_mode,
+        "browser_profile": browser_profile,
+        "shared": False,
+        "holders": 1,
+        "scrape_id": session_id,
         "stream_url": f"/api/stream/{session_id}"
     })
 
 @app.route('/api/stop-monitoring/<session_id>', methods=['POST'])
 def stop_monitoring(session_id):
     """モニタリングセッションを停止するエンドポイント"""
-    if session_id not in active_sessions:
+    # 最後の保有者であればストップイベントをセットし、全購読者のストリームを閉じる（スレッドの終了はバックグラウンドで待つ）
+    session = session_manager.stop(session_id)
+    if session is None:
         return jsonify({"error": "セッションが見つかりません"}), 404
     
-    # ストップイベントをセット
-    stop_events[session_id].set()
-    
-    # セッション情報をクリーンアップ
-    del active_sessions[session_id]
-    del session_queues[session_id]
-    del stop_events[session_id]
-    
-    return jsonify({"message": "モニタリングを停止しました"})
+    if session['holders']:
+        return jsonify({"message": "共有中のセッションから離脱しました", "holders": len(session['holders'])})
+    return jsonify({"message": "モニタリングを停止しました", "holders": 0})
 
 @app.route('/api/stream/<session_id>')
 def stream(session_id):
     """Server-Sent Events (SSE) ストリームを提供するエンドポイント"""
-    if session_id not in active_sessions:
+    # 再起動前のセッションへの再接続であれば、ここでスクレイプを起動し直す
+    session = session_manager.resume(session_id)
+    if session is None:
         return jsonify({"error": "セッションが見つかりません"}), 404
     
+    last_event_id = parse_last_event_id(request.headers.get('Last-Event-ID') or request.args.get('last_event_id'))
+    # format=compactなら簡易形式、Accept-Encodingに応じて圧縮する
+    encoder = SseEncoder(compact=request.args.get('format') == 'compact',
+                         encoding=negotiate_sse_encoding(request.headers.get('Accept-Encoding')))
+    subscription = session['hub'].subscribe(last_event_id)
+    
     def generate():
         try:
             # 接続時にまず初期メッセージを送信
-            yield f"data: {json.dumps({'type': 'connected', 'session_id': session_id})}\n\n"
+            yield encoder.event({'type': 'connected', 'session_id': session_id})
+            if subscription.replay_gap:
+                # 再送ログから溢れた分は送れないことを知らせる
+                yield encoder.event({'type': 'replay_gap', 'first_available': subscription.replay_gap})
             
-            message_queue = session_queues[session_id]
-            stop_event = stop_events[session_id]
+            stop_event = session['stop_event']
             
             # 最後にメッセージを送信した時間を記録
             last_message_time = time.time()
-            last_sample_time = time.time()  # サンプルメッセージ用の別タイマー（使用しない）
             keepalive_interval = 5  # 5秒ごとにキープアライブを送信
             
-            # キューからメッセージを読み取り、クライアントに送信
+            # 自分のバッファに溜まったバッチをまとめて読み取り、クライアントに送信
             while not stop_event.is_set():
-                try:
-                    # タイムアウト付きでキューからメッセージを取得（短めのタイムアウト）
-                    messages = message_queue.get(timeout=1)  # 1秒のタイムアウト
-                    
+                entries = subscription.drain(timeout=1, linger=SSE_COALESCE_WINDOW)  # 1秒のタイムアウト
+                if entries:
+                    data, failed = encoder.batch(entries, subscription)
+                    yield data
                     # エラーメッセージの場合
-                    if isinstance(messages, dict) and "error" in messages:
-                        yield f"data: {json.dumps({'type': 'error', 'error': messages['error']})}\n\n"
+                    if failed:
                         break
-                    
-                    # メッセージを送信
-                    yield f"data: {json.dumps({'type': 'messages', 'messages': messages})}\n\n"
                     last_message_time = time.time()
-                    last_sample_time = time.time()  # 更新（使用しない変数だが念のため）
-                    
-                except Empty:
-                    # キューが空（タイムアウト）の場合
-                    current_time = time.time()
-                    
-                    # 一定時間経過していたらキープアライブを送信
-                    if current_time - last_message_time > keepalive_interval:
-                        logger.info("Sending keepalive to client")
-                        yield f"data: {json.dumps({'type': 'keepalive'})}\n\n"
-                        last_message_time = current_time
-                                            
-                except Exception as e:
-                    # その他のエラー
-                    logger.error(f"Error in stream generation: {str(e)}")
-                    if stop_event.is_set():
-                        break
-                    time.sleep(0.5)  # エラー時の待機時間
+                    continue
                 
-                # ループごとに少し待機
-                time.sleep(0.1)
+                # 配信が追いつかず切断された場合は、クライアントの再接続に任せる
+                if subscription.close_reason == 'slow_consumer':
+                    yield encoder.event({'type': 'slow_consumer'})
+                    yield encoder.finish()
+                    return
+                if subscription.closed:
+                    break
+                
+                # 一定時間経過していたらキープアライブを送信
+                current_time = time.time()
+                if current_time - last_message_time > keepalive_interval:
+                    logger.info("Sending keepalive to client")
+                    yield encoder.event({'type': 'keepalive'})
+                    last_message_time = current_time
             
             # 接続終了時のメッセージ
-            yield f"data: {json.dumps({'type': 'disconnected'})}\n\n"
+            yield encoder.event({'type': 'disconnected'})
+            yield encoder.finish()
             
         except GeneratorExit:
-            # クライアントが接続を閉じた場合
+            # クライアントが接続を閉じた場合（再接続がないまま放置されたセッションは後で回収される）
             logger.info(f"Client disconnected from session {session_id}")
-            if session_id in active_sessions:
-                stop_events[session_id].set()
+        finally:
+            subscription.hub.unsubscribe(subscription)
     
     response = Response(generate(), mimetype='text/event-stream')
     # CORS関連のヘッダーを追加
     response.headers['Cache-Control'] = 'no-cache'
     response.headers['X-Accel-Buffering'] = 'no'  # Nginxのバッファリングを無効化
     response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers.update(encoder.headers)
     return response
 
+@app.route('/api/sessions')
+def list_sessions():
+    """セッションの一覧と、セッションごとのリソース使用量を返すエンドポイント"""
+    return jsonify({
+        "sessions": [session_manager.describe(session) for session in session_manager.scrapes()],
+        "manager": session_manager.stats(),
+        "message_store": message_store.stats(),
+        "checkpoint": session_checkpointer.stats()
+    })
+
+@app.route('/api/sessions/<session_id>')
+def session_status(session_id):
+    """セッションの状態（重複排除インデックスの統計など）を返すエンドポイント"""
+    session = session_manager.get(session_id)
+    if session is None:
+        return jsonify({"error": "セッションが見つかりません"}), 404
+    
+    return jsonify({
+        "session_id": session_id,
+        "scrape_id": session['scrape_id'],
+        "holders": len(session['holders']),
+        "url": session['url'],
+        "capture_mode": session['capture_mode'],
+        "started_at": session['started_at'],
+        "alive": session['thread'].is_alive(),
+        "dedup": session['dedup'].stats(),
+        "scheduler": session['scheduler'].stats(),
+        "liveness": session['liveness'].stats(),
+        "keywords": session['keywords'].stats(),
+        "aggregation": session['aggregator'].stats(),
+        "broadcast": session['hub'].stats()
+    })
+
+def resolve_store_session(session_id):
+    """履歴ストアのセッションIDを返す（監視中の共有セッションの保有者IDはスクレイプのIDに読み替える）"""
+    scrape_id = session_manager.scrape_id_of(session_id) if session_id else None
+    return scrape_id or session_id
+
+@app.route('/api/messages')
+def list_messages():
+    """保存済みのメッセージ履歴をカーソルでページ送りしながら返すエンドポイント"""
+    if not message_store.enabled:
+        return jsonify({"error": "メッセージ履歴の保存が無効になっています"}), 503
+    
+    args = request.args
+    types = [t for value in args.getlist('type') for t in value.split(',') if t]
+    checked = args.get('checked')
+    if checked not in (None, 'true', 'false'):
+        return jsonify({"error": "checkedはtrueかfalseで指定してください"}), 400
+    
+    try:
+        page = message_store.query(
+            session_id=resolve_store_session(args.get('session_id')),
+            cursor=args.get('cursor'),
+            limit=args.get('limit'),
+            order=args.get('order', 'desc'),
+            types=types,
+            username=args.get('user'),
+            since=args.get('since'),
+            until=args.get('until'),
+            checked=None if checked is None else checked == 'true',
+            text=args.get('q')
+        )
+    except ValueError:
+        return jsonify({"error": "cursor・limitは整数、orderはascかdescで指定してください"}), 400
+    except (RuntimeError, sqlite3.Error) as store_err:
+        logger.error(f"Failed to query message store: {str(store_err)}")
+        return jsonify({"error": "メッセージ履歴を読み込めませんでした"}), 503
+    
+    return jsonify(page)
+
+@app.route('/api/messages/checked', methods=['POST'])
+def update_checked():
+    """メッセージのチェック状態を履歴ストアに保存するエンドポイント"""
+    if not message_store.enabled:
+        return jsonify({"error": "メッセージ履歴の保存が無効になっています"}), 503
+    
+    data = request.json or {}
+    session_id = data.get('session_id')
+    message_ids = data.get('ids')
+    if not session_id or not isinstance(message_ids, list) or not all(isinstance(i, str) for i in message_ids):
+        return jsonify({"error": "session_idとids（メッセージIDの配列）が必要です"}), 400
+    
+    try:
+        accepted = message_store.set_checked(resolve_store_session(session_id), message_ids, bool(data.get('checked', True)))
+    except Full:
+        accepted = False
+    if not accepted:
+        return jsonify({"error": "チェック状態を保存できませんでした"}), 503
+    return jsonify({"message": "チェック状態を保存しました", "count": len(message_ids)})
+
+@app.route('/api/stats/<session_id>')
+def session_stats(session_id):
+    """セッションの集計（ユーザーごとのチップ・種類ごとの件数・景品・上位の送信者）を返すエンドポイント"""
+    session = session_manager.get(session_id)
+    if session is None:
+        return jsonify({"error": "セッションが見つかりません"}), 404
+    
+    return jsonify({
+        "session_id": session_id,
+        "scrape_id": session['scrape_id'],
+        # このイベントID以降のstatsイベントを適用すれば最新の集計になる
+        "last_event_id": session['hub'].last_event_id,
+        "stats": session['aggregator'].snapshot()
+    })
+
+@app.route('/api/debug/<session_id>', methods=['GET', 'POST'])
+def debug_snapshot(session_id):
+    """セッションの最新の診断スナップショットを返すエンドポイント（POSTでレベル変更・即時収集）"""
+    session = session_manager.get(session_id)
+    if session is None:
+        return jsonify({"error": "セッションが見つかりません"}), 404
+    
+    # 共有中のセッションでは、診断情報はスクレイプ単位で管理する
+    session_id = session['scrape_id']
+    
+    if request.method == 'POST':
+        data = request.json or {}
+        if 'level' in data or 'sample_every' in data:
+            level = data.get('level', (diagnostics.setting(session_id) or {}).get('level'))
+            if level not in DIAGNOSTIC_LEVELS:
+                return jsonify({"error": f"levelは{', '.join(DIAGNOSTIC_LEVELS)}のいずれかを指定してください"}), 400
+            diagnostics.configure(session_id, level, data.get('sample_every'))
+            if scraper_coordinator.enabled:
+                # 診断はワーカープロセス内で収集するため、設定をワーカーへ送る
+                scraper_coordinator.configure_debug(session_id, diagnostics.setting(session_id))
+        if data.get('capture', True):
+            if scraper_coordinator.enabled:
+                scraper_coordinator.capture_debug(session_id)
+            else:
+                diagnostics.submit(session_id, reason='on_demand')
+    
+    if scraper_coordinator.enabled:
+        state = scraper_coordinator.debug_state(session_id) or {'pending_jobs': 0, 'dropped_jobs': 0, 'snapshot': None}
+    else:
+        state = {
+            "pending_jobs": diagnostics.jobs.qsize(),
+            "dropped_jobs": diagnostics.dropped,
+            "snapshot": diagnostics.snapshot(session_id)
+        }
+    return jsonify({
+        "session_id": session_id,
+        "settings": diagnostics.setting(session_id),
+        **state
+    })
+
+@app.route('/api/browser-pool')
+def browser_pool_status():
+    """ブラウザプールの状態を返すエンドポイント（ワーカー方式ではワーカーの状態も返す）"""
+    return jsonify({
+        "browsers": browser_pool.stats(),
+        "max_browsers": browser_pool.max_browsers,
+        "max_tabs": browser_pool.max_tabs,
+        "scraper_workers": scraper_coordinator.stats() if scraper_coordinator.enabled else None
+    })
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus形式のメトリクスを返すエンドポイント（ワーカー方式ではワーカーの値も合算する）"""
+    remote = dict(scraper_coordinator.worker_metrics) if scraper_coordinator.enabled else None
+    return Response(metrics.render(remote), mimetype='text/plain; version=0.0.4')
+
 @app.route('/dashboard')
 def dashboard():
     """ダッシュボードページを提供するエンドポイント"""
@@ -664,5 +5091,44 @@ def test_js():
         logger.error(f"Error reading test JavaScript: {str(e)}")
         return "console.error('Error loading JavaScript file');"
 
+# 起動時にブラウザ（ワーカー方式ではワーカープロセス）を温めておく（最初のセッション開始を高速化）
+# ワーカープロセスもこのモジュールを読み込むため、親プロセスでのみ行う
+background_services_lock = threading.Lock()
+background_services_started = False
+
+def start_background_services():
+    """ブラウザの事前起動（またはスクレイパーワーカーの起動）・履歴ストアの起動と、セッションのチェックポイントの復元・定期書き出しを始める
+    
+    モジュールの読み込みでは何も起動しない。サーバーの起動時（asgi.pyのlifespan.startup、python app.py）に呼び出し、
+    それ以外のWSGIサーバーでは最初のリクエストの前に呼び出される。2回目以降の呼び出しは何もしない
+    """
+    global background_services_started
+    with background_services_lock:
+        if background_services_started or is_child_process():
+            return
+        background_services_started = True
+    
+    if os.environ.get('BROWSER_POOL_PREWARM', '1') == '1':
+        if scraper_coordinator.enabled:
+            scraper_coordinator.start()
+        else:
+            browser_pool.start()
+    
+    # 履歴ストアの書き込みスレッド（監視スレッドからの最初の追記で起動を待たせないよう、先に起動する）
+    message_store.start()
+    
+    # 前回のプロセスが書き出したセッションを読み戻し、定期的な書き出しを始める
+    if session_checkpointer.enabled:
+        session_checkpointer.restore()
+        session_checkpointer.start()
+
+@app.before_first_request
+def start_background_services_on_first_request():
+    """起動フックを持たないWSGIサーバー（gunicorn app:app など）向けに、最初のリクエストの前に起動する"""
+    start_background_services()
+
 if __name__ == '__main__':
-    app.run(debug=True, host="0.0.0.0", port=5000, threaded=True)
\ No newline at end of file
+    # Flaskの自動リロード（debug=True）では監視用の親プロセスもここを通るため、配信する子プロセスでのみ起動する
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_services()
+    app.run(debug=True, host="0.0.0.0", port=5000, threaded=True)
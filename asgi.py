@@ -0,0 +1,173 @@
+# asgi.py
+"""非同期（ASGI）サーバー用のエントリーポイント
+
+SSEストリームはスレッドを占有しないコルーチンとして配信し、それ以外のAPIは
+従来のFlaskアプリをスレッドプール上で実行する。ブラウザ操作は引き続き
+セッションごとの監視スレッドで行う。
+
+起動例:
+    uvicorn asgi:application --host 0.0.0.0 --port 5000
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+from queue import Empty
+from urllib.parse import parse_qs
+
+from a2wsgi import WSGIMiddleware
+
+from app import (app as flask_app, session_manager, parse_last_event_id, SseEncoder, negotiate_sse_encoding,
+                 SSE_COALESCE_WINDOW, start_background_services)
+
+logger = logging.getLogger(__name__)
+
+# SSEストリームとして非同期に処理するパス
+STREAM_PATH = re.compile(r'^/api/stream/([^/]+)/?$')
+# メッセージがない場合にキープアライブを送る間隔（秒）
+KEEPALIVE_INTERVAL = 5
+# Flask側のAPIを実行するスレッド数
+WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', '10'))
+
+wsgi_application = WSGIMiddleware(flask_app, workers=WSGI_THREADS)
+
+SSE_HEADERS = [
+    (b'content-type', b'text/event-stream; charset=utf-8'),
+    (b'cache-control', b'no-cache'),
+    (b'x-accel-buffering', b'no'),  # Nginxのバッファリングを無効化
+    (b'access-control-allow-origin', b'*'),
+]
+
+async def send_json(send, status, payload):
+    """JSONレスポンスを返す"""
+    body = json.dumps(payload).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode('ascii')),
+            (b'access-control-allow-origin', b'*'),
+        ]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+async def wait_for_disconnect(receive, disconnected, wakeup):
+    """クライアントの切断を監視し、待機中のストリームを起こす"""
+    while True:
+        event = await receive()
+        if event['type'] == 'http.disconnect':
+            disconnected.set()
+            wakeup.set()
+            return
+
+async def stream(scope, receive, send, session_id):
+    """Server-Sent Events (SSE) ストリームを提供する（購読バッファへの到着をasyncio.Eventで待つ）"""
+    # 再起動前のセッションへの再接続であれば、ここでスクレイプを起動し直す（ブラウザの取得は監視スレッドで行う）
+    # 起動し直す場合はワーカープロセスや履歴ストアの起動を待つことがあるため、他のストリームを止めないようスレッドプールで実行する
+    session = await asyncio.get_running_loop().run_in_executor(None, session_manager.resume, session_id)
+    if session is None:
+        await send_json(send, 404, {"error": "セッションが見つかりません"})
+        return
+
+    # ブラウザの自動再接続はLast-Event-IDヘッダー、monitor.jsの再接続はクエリで最後のイベントIDを渡す
+    headers = dict(scope.get('headers') or [])
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    last_event_id = parse_last_event_id(
+        headers.get(b'last-event-id', b'').decode('latin-1') or (query.get('last_event_id') or [None])[0]
+    )
+    # format=compactなら簡易形式、Accept-Encodingに応じて圧縮する
+    encoder = SseEncoder(compact=(query.get('format') or [None])[0] == 'compact',
+                         encoding=negotiate_sse_encoding(headers.get(b'accept-encoding', b'').decode('latin-1')))
+    subscription = session['hub'].subscribe(last_event_id)
+    stop_event = session['stop_event']
+    loop = asyncio.get_running_loop()
+    wakeup = asyncio.Event()
+    disconnected = asyncio.Event()
+    subscription.add_waiter(loop, wakeup)
+    watcher = loop.create_task(wait_for_disconnect(receive, disconnected, wakeup))
+
+    async def write(data, more_body=True):
+        await send({'type': 'http.response.body', 'body': data, 'more_body': more_body})
+
+    async def emit(payload):
+        await write(encoder.event(payload))
+
+    try:
+        response_headers = SSE_HEADERS + [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                          for name, value in encoder.headers.items()]
+        await send({'type': 'http.response.start', 'status': 200, 'headers': response_headers})
+        # 接続時にまず初期メッセージを送信
+        await emit({'type': 'connected', 'session_id': session_id})
+        if subscription.replay_gap:
+            # 再送ログから溢れた分は送れないことを知らせる
+            await emit({'type': 'replay_gap', 'first_available': subscription.replay_gap})
+        last_message_time = loop.time()
+        failed = False
+
+        while not stop_event.is_set() and not disconnected.is_set():
+            # 通知を取りこぼさないよう、バッファを確認する前にクリアする
+            wakeup.clear()
+            entries = subscription.drain_nowait()
+            if entries:
+                # 溜まっていたバッチをまとめて1回で送る
+                data, failed = encoder.batch(entries, subscription)
+                await write(data)
+                last_message_time = loop.time()
+                if failed:
+                    break
+                continue
+            if subscription.closed:
+                break
+
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=KEEPALIVE_INTERVAL)
+            except asyncio.TimeoutError:
+                # 一定時間メッセージがなければキープアライブを送信
+                if loop.time() - last_message_time >= KEEPALIVE_INTERVAL:
+                    await emit({'type': 'keepalive'})
+                    last_message_time = loop.time()
+            else:
+                if SSE_COALESCE_WINDOW > 0 and not subscription.closed:
+                    # 続けて届くバッチを同じフレームにまとめる
+                    await asyncio.sleep(SSE_COALESCE_WINDOW)
+
+        if disconnected.is_set():
+            # クライアントが接続を閉じた場合（再接続がないまま放置されたセッションは後で回収される）
+            logger.info(f"Client disconnected from session {session_id}")
+            return
+
+        if subscription.close_reason == 'slow_consumer' and not failed:
+            # 配信が追いつかず切断された場合は、クライアントの再接続に任せる
+            await emit({'type': 'slow_consumer'})
+        else:
+            # 接続終了時のメッセージ
+            await emit({'type': 'disconnected'})
+        await write(encoder.finish(), more_body=False)
+    finally:
+        subscription.remove_waiter(loop, wakeup)
+        subscription.hub.unsubscribe(subscription)
+        watcher.cancel()
+
+async def application(scope, receive, send):
+    """SSEストリームだけを非同期に処理し、それ以外はFlaskアプリに渡すASGIアプリケーション"""
+    if scope['type'] == 'http' and scope['method'] == 'GET':
+        match = STREAM_PATH.match(scope['path'])
+        if match:
+            await stream(scope, receive, send, match.group(1))
+            return
+
+    if scope['type'] == 'lifespan':
+        # ブラウザプール（またはスクレイパーワーカー）とチェックポイントはここで起動し、管理はapp側に任せる
+        while True:
+            event = await receive()
+            if event['type'] == 'lifespan.startup':
+                # SIGTERM時の書き出しのハンドラーを設定するため、メインスレッド（イベントループ）で呼び出す
+                start_background_services()
+                await send({'type': 'lifespan.startup.complete'})
+            elif event['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    await wsgi_application(scope, receive, send)
@@ -0,0 +1,116 @@
+# benchmark_extraction.py
+"""保存したページのスナップショットを使って抽出エンジンの速度と出力の一致を比較するベンチマーク
+
+使用例:
+    python benchmark_extraction.py /tmp/debug.html snapshots/*.html
+    python benchmark_extraction.py --synthetic 2000 --engines bs4,lxml --repeat 5
+"""
+import argparse
+import glob
+import logging
+import random
+import statistics
+import time
+
+from app import EXTRACTION_ENGINES, build_synthetic_row, get_extraction_engine
+
+REFERENCE_ENGINE = 'bs4'
+
+def build_synthetic_page(rows, seed=0, padding=2000):
+    """チャット欄以外の要素を含むページ全体を生成する（実ページに近い大きさにするための埋め草付き）"""
+    rng = random.Random(seed)
+    filler = ''.join(f'<div class="layout-block item-{i % 50}"><span>filler {i}</span></div>' for i in range(padding))
+    chat = ''.join(build_synthetic_row(i, rng) for i in range(rows))
+    return (f'<html><head><title>Synthetic chat</title></head><body class="synthetic">{filler}'
+            f'<div class="chat-wrapper"><div class="messages">{chat}</div></div></body></html>')
+
+def load_snapshots(patterns, synthetic_rows):
+    """スナップショットのパス（globパターン可）を読み込む。指定がなければ合成ページを使う"""
+    snapshots = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)):
+            with open(path, 'r', encoding='utf-8') as f:
+                snapshots.append((path, f.read()))
+    if not snapshots:
+        snapshots.append((f'synthetic:{synthetic_rows}', build_synthetic_page(synthetic_rows)))
+    return snapshots
+
+def comparable(messages, ignore_ids):
+    """比較に使う項目だけを取り出す（タイムスタンプは実行時刻のため除外）"""
+    return [
+        (None if ignore_ids else m['id'], m['text'], m['type'], m['checked'],
+         m.get('username'), m.get('amount'), m.get('comment'), m.get('prize'))
+        for m in messages
+    ]
+
+def run_engine(name, snapshots, repeat):
+    """エンジンごとに解析時間・抽出時間を計測する"""
+    extractor = get_extraction_engine(name)
+    parse_times = []
+    extract_times = []
+    message_count = 0
+    outputs = {}
+
+    for label, html in snapshots:
+        for _ in range(repeat):
+            started = time.perf_counter()
+            document = extractor.parse(html)
+            parsed = time.perf_counter()
+            messages = extractor.extract_from_document(document)
+            finished = time.perf_counter()
+
+            parse_times.append((parsed - started) * 1000)
+            extract_times.append((finished - parsed) * 1000)
+            message_count += len(messages)
+        outputs[label] = messages
+
+    total_seconds = (sum(parse_times) + sum(extract_times)) / 1000
+    return {
+        'engine': extractor.name,
+        'parse_ms': statistics.mean(parse_times),
+        'extract_ms': statistics.mean(extract_times),
+        'total_ms': statistics.mean(p + e for p, e in zip(parse_times, extract_times)),
+        'messages_per_sec': message_count / total_seconds if total_seconds else 0.0,
+        'outputs': outputs
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='抽出エンジンのベンチマーク')
+    parser.add_argument('snapshots', nargs='*', help='ページのスナップショット（例: /tmp/debug.html）')
+    parser.add_argument('--engines', default=','.join(EXTRACTION_ENGINES), help='比較するエンジン（カンマ区切り）')
+    parser.add_argument('--repeat', type=int, default=3, help='1ページあたりの計測回数')
+    parser.add_argument('--synthetic', type=int, default=1000, help='スナップショットがない場合に生成するチャット行数')
+    parser.add_argument('--ignore-ids', action='store_true', help='メッセージIDの一致を確認しない')
+    args = parser.parse_args()
+
+    # エンジン内のINFOログが計測に混ざらないようにする
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger('app').setLevel(logging.WARNING)
+
+    snapshots = load_snapshots(args.snapshots, args.synthetic)
+    engines = [e.strip() for e in args.engines.split(',') if e.strip()]
+    if REFERENCE_ENGINE not in engines:
+        engines.insert(0, REFERENCE_ENGINE)
+
+    print(f"{len(snapshots)} snapshot(s), {sum(len(h) for _, h in snapshots) / 1024:.0f} KiB total, repeat={args.repeat}")
+    print(f"{'engine':<8} {'parse ms':>10} {'extract ms':>11} {'total ms':>10} {'msgs/sec':>12}  output")
+
+    results = {name: run_engine(name, snapshots, args.repeat) for name in engines}
+    reference = results[REFERENCE_ENGINE]['outputs']
+    mismatched = False
+
+    for name in engines:
+        result = results[name]
+        mismatches = [
+            label for label in reference
+            if comparable(result['outputs'][label], args.ignore_ids) != comparable(reference[label], args.ignore_ids)
+        ]
+        mismatched = mismatched or bool(mismatches)
+        status = 'identical' if not mismatches else f"MISMATCH in {', '.join(mismatches)}"
+        print(f"{result['engine']:<8} {result['parse_ms']:>10.2f} {result['extract_ms']:>11.2f} "
+              f"{result['total_ms']:>10.2f} {result['messages_per_sec']:>12.0f}  {status}")
+
+    return 1 if mismatched else 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,289 @@
+# load_test.py
+"""再生用ドライバー（replay://）で多数のセッションとSSEクライアントを動かし、出現から配信までの時間を測る負荷試験
+
+Chromeや外部サイトには接続しない。合成チャットの各行は出現時刻を含むIDを持つため、
+SSEで受け取った時刻との差をエンドツーエンドの遅延として集計する。
+
+使用例:
+    python load_test.py --spawn --steps 1,2,4,8,16 --rate 20 --clients 2
+    REPLAY_ENABLED=1 uvicorn asgi:application --port 5000 &
+    python load_test.py --base-url http://127.0.0.1:5000 --steps 4 --duration 30
+"""
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+from app import process_children, find_free_port
+
+REPLAY_ID_PREFIX = 'replay:'
+
+def request_json(base_url, method, path, payload=None, timeout=30):
+    """APIを呼び出して(ステータス, JSON)を返す"""
+    parts = urlsplit(base_url)
+    connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=timeout)
+    try:
+        body = json.dumps(payload) if payload is not None else None
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        connection.request(method, path, body=body, headers=headers)
+        response = connection.getresponse()
+        data = response.read()
+        return response.status, json.loads(data) if data else None
+    finally:
+        connection.close()
+
+class SseClient(threading.Thread):
+    """1つのSSEストリームを読み、再生用のメッセージの遅延を記録するクライアント"""
+
+    def __init__(self, base_url, session_id, recorder):
+        super().__init__(daemon=True)
+        self.base_url = base_url
+        self.session_id = session_id
+        self.recorder = recorder
+        self.stopped = threading.Event()
+        self.connection = None
+        self.seen = set()
+        self.error = None
+
+    def run(self):
+        parts = urlsplit(self.base_url)
+        try:
+            self.connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=60)
+            self.connection.request('GET', f'/api/stream/{self.session_id}')
+            response = self.connection.getresponse()
+            if response.status != 200:
+                raise RuntimeError(f"stream returned {response.status}")
+            while not self.stopped.is_set():
+                line = response.readline()
+                if not line:
+                    break
+                if line.startswith(b'data: '):
+                    self._handle(json.loads(line[6:]), time.time())
+        except Exception as stream_err:
+            if not self.stopped.is_set():
+                self.error = str(stream_err)
+        finally:
+            if self.connection is not None:
+                self.connection.close()
+
+    def _handle(self, event, received_at):
+        if event.get('type') != 'messages':
+            return
+        for message in event['messages']:
+            message_id = message.get('id', '')
+            if not message_id.startswith(REPLAY_ID_PREFIX) or message_id in self.seen:
+                continue
+            self.seen.add(message_id)
+            appeared_ms = int(message_id.rsplit(':', 1)[1])
+            self.recorder.record(appeared_ms / 1000, received_at)
+
+    def stop(self):
+        self.stopped.set()
+        try:
+            if self.connection is not None and self.connection.sock is not None:
+                self.connection.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+class LatencyRecorder:
+    """全クライアントの遅延を集める（計測開始前に出現した行は、初回チェックまでの待ち時間を含むため捨てる）"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.recording = False
+        self.started_at = None
+        self.samples = []
+
+    def record(self, appeared_at, received_at):
+        with self.lock:
+            if self.recording and appeared_at >= self.started_at:
+                self.samples.append(received_at - appeared_at)
+
+    def start(self):
+        with self.lock:
+            self.recording = True
+            self.started_at = time.time()
+            self.samples = []
+
+    def stop(self):
+        with self.lock:
+            self.recording = False
+            return list(self.samples)
+
+def percentile(samples, fraction):
+    """最近傍順位法によるパーセンタイル"""
+    if not samples:
+        return float('nan')
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+def process_tree_cpu_seconds(root_pid):
+    """プロセスとその子孫が使ったCPU時間（秒）"""
+    children = process_children() or {}
+    ticks_per_second = os.sysconf('SC_CLK_TCK')
+    total = 0
+    pending = [root_pid]
+    while pending:
+        pid = pending.pop()
+        try:
+            with open(f'/proc/{pid}/stat', 'rb') as f:
+                fields = f.read().rsplit(b')', 1)[1].split()
+            # utime, stime（')'の後の3番目から数えて12・13番目）
+            total += int(fields[11]) + int(fields[12])
+        except (OSError, IndexError, ValueError):
+            continue
+        pending.extend(children.get(pid, []))
+    return total / ticks_per_second
+
+def spawn_server(port, workers):
+    """再生用ドライバーを有効にしたASGIサーバーを子プロセスで起動し、応答するまで待つ"""
+    env = dict(os.environ,
+               REPLAY_ENABLED='1',
+               BROWSER_POOL_PREWARM='0',
+               MAX_SESSIONS='100000',
+               SCRAPER_WORKERS=str(workers),
+               SESSION_CHECKPOINT_PATH='',
+               MESSAGE_STORE_PATH=os.path.join('/tmp', f'load-test-{port}.sqlite3'))
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'asgi:application', '--host', '127.0.0.1', '--port', str(port),
+         '--log-level', 'warning'],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            request_json(base_url, 'GET', '/api/sessions', timeout=2)
+            return process, base_url
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError('server did not start within 30s')
+
+def run_step(args, base_url, session_count, server_pid):
+    """セッション数を固定して一定時間計測する"""
+    recorder = LatencyRecorder()
+    session_ids = []
+    clients = []
+    rejected = 0
+
+    for index in range(session_count):
+        status, data = request_json(base_url, 'POST', '/api/start-monitoring', {
+            'url': f'replay://synthetic?rate={args.rate}&seed={index}&window={args.window}&padding={args.padding}',
+            'capture_mode': args.capture_mode,
+            'share': False
+        })
+        if status == 429:
+            rejected += 1
+            continue
+        if status != 200:
+            raise RuntimeError(f"start-monitoring returned {status}: {data}")
+        session_ids.append(data['session_id'])
+        for _ in range(args.clients):
+            client = SseClient(base_url, data['session_id'], recorder)
+            client.start()
+            clients.append(client)
+
+    # 初回のチェック間隔が落ち着くまで待ってから計測する
+    time.sleep(args.warmup)
+    cpu_before = process_tree_cpu_seconds(server_pid) if server_pid else None
+    started = time.time()
+    recorder.start()
+    time.sleep(args.duration)
+    samples = recorder.stop()
+    elapsed = time.time() - started
+    cpu_after = process_tree_cpu_seconds(server_pid) if server_pid else None
+
+    for client in clients:
+        client.stop()
+    for session_id in session_ids:
+        request_json(base_url, 'POST', f'/api/stop-monitoring/{session_id}')
+    for client in clients:
+        client.join(timeout=5)
+
+    return {
+        'sessions': len(session_ids),
+        'rejected': rejected,
+        'clients': len(clients),
+        'client_errors': sum(1 for c in clients if c.error),
+        'messages': len(samples),
+        'messages_per_sec': len(samples) / elapsed if elapsed else 0.0,
+        'p50': percentile(samples, 0.50),
+        'p90': percentile(samples, 0.90),
+        'p99': percentile(samples, 0.99),
+        'max': max(samples) if samples else float('nan'),
+        'cores': (cpu_after - cpu_before) / elapsed if server_pid and elapsed else None
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='再生用ドライバーを使った負荷試験')
+    parser.add_argument('--base-url', help='REPLAY_ENABLED=1で起動済みのサーバー（例: http://127.0.0.1:5000）')
+    parser.add_argument('--spawn', action='store_true', help='サーバーを子プロセスで起動する（CPU使用量も測る）')
+    parser.add_argument('--server-pid', type=int, help='--base-url のサーバーのPID（CPU使用量を測る場合）')
+    parser.add_argument('--workers', type=int, default=0, help='--spawn 時のSCRAPER_WORKERS')
+    parser.add_argument('--steps', default='1,2,4,8', help='計測するセッション数（カンマ区切り）')
+    parser.add_argument('--clients', type=int, default=1, help='セッションごとのSSEクライアント数')
+    parser.add_argument('--rate', type=float, default=10, help='セッションごとに1秒あたりに増えるチャット行数')
+    parser.add_argument('--window', type=int, default=300, help='ページに残すチャット行数')
+    parser.add_argument('--padding', type=int, default=2000, help='チャット欄以外の埋め草の要素数')
+    parser.add_argument('--capture-mode', default='observer', choices=('dom', 'observer', 'push'), help='取得方式')
+    parser.add_argument('--warmup', type=float, default=10, help='計測前に待つ秒数')
+    parser.add_argument('--duration', type=float, default=20, help='1ステップの計測秒数')
+    parser.add_argument('--slo', type=float, default=5.0, help='維持できたとみなすp99遅延の上限（秒）')
+    args = parser.parse_args()
+
+    if not args.spawn and not args.base_url:
+        parser.error('--spawn か --base-url のどちらかを指定してください')
+
+    process = None
+    if args.spawn:
+        process, base_url = spawn_server(find_free_port(), args.workers)
+        server_pid = process.pid
+    else:
+        base_url = args.base_url.rstrip('/')
+        server_pid = args.server_pid
+
+    steps = [int(s) for s in args.steps.split(',') if s.strip()]
+    print(f"capture_mode={args.capture_mode} rate={args.rate}/s per session, clients={args.clients} per session, "
+          f"warmup={args.warmup}s duration={args.duration}s slo(p99)={args.slo}s")
+    print(f"{'sessions':>8} {'clients':>7} {'msgs/sec':>9} {'p50 s':>7} {'p90 s':>7} {'p99 s':>7} {'max s':>7} {'cores':>6}  status")
+
+    sustainable = None
+    try:
+        for session_count in steps:
+            result = run_step(args, base_url, session_count, server_pid)
+            ok = result['messages'] > 0 and result['p99'] <= args.slo and not result['rejected'] and not result['client_errors']
+            if ok:
+                sustainable = result
+            cores = f"{result['cores']:.2f}" if result['cores'] is not None else '-'
+            notes = [] if ok else ['OVER SLO' if result['messages'] else 'NO MESSAGES']
+            if result['rejected']:
+                notes.append(f"{result['rejected']} rejected")
+            if result['client_errors']:
+                notes.append(f"{result['client_errors']} client errors")
+            print(f"{result['sessions']:>8} {result['clients']:>7} {result['messages_per_sec']:>9.1f} {result['p50']:>7.2f} "
+                  f"{result['p90']:>7.2f} {result['p99']:>7.2f} {result['max']:>7.2f} {cores:>6}  {'ok' if ok else ', '.join(notes)}")
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+
+    if sustainable is None:
+        print("No step met the SLO")
+        return 1
+    per_core = ''
+    if sustainable['cores']:
+        per_core = f", {sustainable['sessions'] / max(sustainable['cores'], 0.01):.1f} sessions per core"
+    print(f"Max sustainable sessions: {sustainable['sessions']}{per_core}")
+    return 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
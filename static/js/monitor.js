@@ -1,12 +1,19 @@
 // 状態を管理する変数
 let isMonitoring = false;
 let sessionId = null;
+let scrapeId = null; // サーバーの履歴ストアでのセッションID（共有中のスクレイプのID）
 let eventSource = null;
+let lastEventId = null; // 最後に受信したイベントID（再接続時に取りこぼした分だけを受け取るため）
+let sessionStats = null; // サーバー側の集計（接続時に取得し、statsイベントの差分を反映する）
+let sessionStatsEventId = 0; // sessionStatsに反映済みの最後のイベントID（これ以前の差分は適用しない）
+let pendingStatsDeltas = null; // 集計の現在値を取得している間に届いた差分（[イベントID, 差分]の配列）
 let messages = [];
 let hideMessages = false;
 let hideEpicGoals = false;
 let hideExcludedWords = false;
+let serverExcludeWords = false; // 除外ワードをサーバー側で破棄する（配信・保存されないため、表示を戻せない）
 let excludeWords = Array(20).fill('');  // 20個の空の除外ワード
+let excludePattern = null; // 除外ワードをまとめた正規表現（除外ワードの変更時に作り直す）
 let sortMode = 'time';
 let groupLimits = {}; // グループごとの個別上限設定
 
@@ -19,6 +26,7 @@ const checkboxList = document.getElementById('checkboxList');
 const hideMessagesCheckbox = document.getElementById('hideMessages');
 const hideEpicGoalsCheckbox = document.getElementById('hideEpicGoals');
 const hideExcludedWordsCheckbox = document.getElementById('hideExcludedWords');
+const serverExcludeWordsCheckbox = document.getElementById('serverExcludeWords');
 const sortModeSelect = document.getElementById('sortMode');
 const removeCheckedButton = document.getElementById('removeChecked');
 const resetButton = document.getElementById('reset');
@@ -27,24 +35,29 @@ const excludeWordsModal = document.getElementById('excludeWordsModal');
 const closeModalButton = document.getElementById('closeModal');
 const saveExcludeWordsButton = document.getElementById('saveExcludeWords');
 const excludeWordsList = document.querySelector('.exclude-words-list');
+const statsSummary = document.getElementById('statsSummary');
 
 // ローカルストレージから設定を読み込む
 function loadSettings() {
   hideMessages = localStorage.getItem('hideMessages') === 'true';
   hideEpicGoals = localStorage.getItem('hideEpicGoals') === 'true';
   hideExcludedWords = localStorage.getItem('hideExcludedWords') === 'true';
+  serverExcludeWords = localStorage.getItem('serverExcludeWords') === 'true';
   
   const storedExcludeWords = JSON.parse(localStorage.getItem('excludeWords') || '[]');
   excludeWords = storedExcludeWords.length ? storedExcludeWords : Array(20).fill('');
+  excludePattern = buildExcludePattern(excludeWords);
   
   sortMode = localStorage.getItem('sortMode') || 'time';
   groupLimits = JSON.parse(localStorage.getItem('groupLimits') || '{}');
   messages = JSON.parse(localStorage.getItem('messages') || '[]');
+  messages.forEach(ensureMessageFields);
 
   // UIに設定を反映
   hideMessagesCheckbox.checked = hideMessages;
   hideEpicGoalsCheckbox.checked = hideEpicGoals;
   hideExcludedWordsCheckbox.checked = hideExcludedWords;
+  serverExcludeWordsCheckbox.checked = serverExcludeWords;
   sortModeSelect.value = sortMode;
 }
 
@@ -77,7 +90,8 @@ async function startMonitoring() {
       headers: {
         'Content-Type': 'application/json',
       },
-      body: JSON.stringify({ url }),
+      // サーバーでの破棄を選んだ場合のみ、除外ワードをサーバー側のフィルターとして渡す
+      body: JSON.stringify({ url, keywords: buildKeywordFilter() }),
     });
 
     if (!response.ok) {
@@ -87,6 +101,11 @@ async function startMonitoring() {
 
     const data = await response.json();
     sessionId = data.session_id;
+    scrapeId = data.scrape_id || data.session_id;
+    lastEventId = null;
+    sessionStats = null;
+    sessionStatsEventId = 0;
+    pendingStatsDeltas = null;
     
     // Server-Sent Eventsの接続を開始
     connectToEventStream(data.session_id);
@@ -130,8 +149,6 @@ async function stopMonitoring() {
 
 // EventStreamに接続する関数
 function connectToEventStream(sid) {
-  eventSource = new EventSource(`/api/stream/${sid}`);
-  
   // 接続エラーカウンター
   let errorCount = 0;
   const maxErrors = 3;
@@ -139,10 +156,15 @@ function connectToEventStream(sid) {
   // 自動再接続タイマー
   let reconnectTimer = null;
   
-  eventSource.onmessage = (event) => {
+  const handleMessage = (event) => {
     // エラーカウンターをリセット（メッセージが来たので）
     errorCount = 0;
     
+    // 再接続時に続きから受け取れるようイベントIDを記録
+    if (event.lastEventId) {
+      lastEventId = event.lastEventId;
+    }
+    
     console.log("Received event data:", event.data);
     let data;
     try {
@@ -155,17 +177,16 @@ function connectToEventStream(sid) {
     console.log("Parsed event data:", data);
     
     switch (data.type) {
-      case 'messages':
-        console.log(`Received ${data.messages.length} messages from server`);
-        if (data.messages.length > 0) {
-          console.log("Sample message:", data.messages[0]);
-        }
+      case 'messages': {
+        const batch = expandCompactMessages(data);
+        console.log(`Received ${batch.length} messages from server`);
         
         // メッセージを受信したら即座に表示を更新
         requestAnimationFrame(() => {
-          addNewMessages(data.messages);
+          addNewMessages(batch);
         });
         break;
+      }
         
       case 'error':
         errorElement.textContent = data.error;
@@ -180,12 +201,19 @@ function connectToEventStream(sid) {
         console.log("Connected to stream with session ID:", data.session_id);
         errorElement.textContent = '';
         
+        // 集計の現在値を取得（以降はstatsイベントの差分を反映）
+        loadSessionStats(sid);
+        
         // 既存メッセージを再表示（接続時に一度更新）
         requestAnimationFrame(() => {
           updateCheckboxList();
         });
         break;
       
+      case 'stats':
+        applyStatsDelta(data.stats, Number(event.lastEventId) || 0);
+        break;
+      
       case 'keepalive':
         console.log("Received keepalive");
         // キープアライブ受信時にもチェックリストのレンダリングを要求
@@ -199,7 +227,7 @@ function connectToEventStream(sid) {
     }
   };
   
-  eventSource.onerror = (error) => {
+  const handleError = (error) => {
     console.error('EventSource error:', error);
     errorCount++;
     
@@ -221,18 +249,146 @@ function connectToEventStream(sid) {
           eventSource.close();
         }
         
-        // 新しい接続を作成
-        eventSource = new EventSource(`/api/stream/${sid}`);
+        // 新しい接続を作成（最後に受信したイベント以降を再送してもらう）
+        openEventSource();
         console.log("Attempting to reconnect...");
       }, 5000);
     }
   };
+  
+  const openEventSource = () => {
+    // 簡易形式で受け取る（圧縮はブラウザがAccept-Encodingで自動的に交渉する）
+    const query = '?format=compact' + (lastEventId ? `&last_event_id=${encodeURIComponent(lastEventId)}` : '');
+    eventSource = new EventSource(`/api/stream/${sid}${query}`);
+    eventSource.onmessage = handleMessage;
+    eventSource.onerror = handleError;
+  };
+  
+  openEventSource();
+}
+
+// 簡易形式（種類の表・基準時刻からのミリ秒・項目順の配列）のメッセージを元の形に戻す
+const COMPACT_FIELDS = ['id', 'type', 'timestamp', 'text', 'username', 'amount', 'comment', 'prize', 'keywords'];
+
+function expandCompactMessages(data) {
+  if (!data.r) return data.messages;
+  return data.r.map(row => {
+    const message = { checked: false };
+    row.forEach((value, index) => {
+      if (value !== null) message[COMPACT_FIELDS[index]] = value;
+    });
+    message.type = data.y[row[1]];
+    message.timestamp = row[2] != null && data.t != null ? new Date(data.t + row[2]).toISOString() : null;
+    return message;
+  });
+}
+
+// サーバーの集計の現在値を取得する
+// 取得中に届いた差分は溜めておき、現在値のイベントIDより後のものだけを現在値の上に反映する
+async function loadSessionStats(sid) {
+  pendingStatsDeltas = [];
+  try {
+    const response = await fetch(`/api/stats/${sid}`);
+    if (response.ok) {
+      const data = await response.json();
+      sessionStats = data.stats;
+      sessionStatsEventId = data.last_event_id || 0;
+    }
+  } catch (err) {
+    console.error('Failed to load session stats:', err);
+  }
+  const deltas = pendingStatsDeltas;
+  pendingStatsDeltas = null;
+  deltas.forEach(([eventId, delta]) => applyStatsDelta(delta, eventId));
+  renderStatsSummary();
+}
+
+// statsイベントの差分を反映する（差分は変更された項目の現在値なので上書きするだけでよい）
+function applyStatsDelta(delta, eventId) {
+  if (pendingStatsDeltas) {
+    // 現在値を取得中（取得後に反映する）
+    pendingStatsDeltas.push([eventId, delta]);
+    return;
+  }
+  if (eventId && eventId <= sessionStatsEventId) {
+    // 取得した現在値に含まれている差分
+    return;
+  }
+  if (eventId) {
+    sessionStatsEventId = eventId;
+  }
+  if (!sessionStats) {
+    sessionStats = { messages: 0, coins: 0, user_count: 0, types: {}, users: {}, prizes: {}, top_tippers: [] };
+  }
+  sessionStats.messages = delta.messages;
+  sessionStats.coins = delta.coins;
+  sessionStats.user_count = delta.user_count;
+  Object.assign(sessionStats.types, delta.types);
+  Object.assign(sessionStats.users, delta.users);
+  Object.assign(sessionStats.prizes, delta.prizes || {});
+  if (delta.top_tippers) {
+    sessionStats.top_tippers = delta.top_tippers;
+  }
+  renderStatsSummary();
 }
 
-// メッセージが除外ワードを含むかチェック
+// 集計の概要を表示する
+function renderStatsSummary() {
+  if (!sessionStats) {
+    statsSummary.textContent = '';
+    return;
+  }
+  const topTippers = sessionStats.top_tippers
+    .slice(0, 3)
+    .map(entry => `${entry.username} (${entry.coins})`)
+    .join(', ');
+  statsSummary.textContent =
+    `${sessionStats.messages}件 / ${sessionStats.coins}tk / ${sessionStats.user_count}ユーザー` +
+    (topTippers ? ` / 上位: ${topTippers}` : '');
+}
+
+// 項目を持たない古い形式のメッセージ（保存済みのもの）は、表示用テキストから一度だけ項目を取り出す
+function ensureMessageFields(message) {
+  if (message.username !== undefined) return;
+  const usernameMatch = message.text.match(/【(.*?)】/);
+  message.username = usernameMatch ? usernameMatch[1] : null;
+  const match = message.text.match(/\[(.*?)\] (.*?)：(.*?) 【/);
+  if (!match) return;
+  if (message.type === 'ルーレット') {
+    message.prize = match[3];
+  } else {
+    const amountMatch = match[2].match(/\d[\d,]*/);
+    message.amount = amountMatch ? parseInt(amountMatch[0].replace(/,/g, ''), 10) : null;
+    message.comment = match[3];
+  }
+}
+
+// 内容でグループ化するときのキー（チップはコメント、ルーレットは景品でまとめる）
+function messageGroupKey(message) {
+  if (message.comment !== undefined) return `[${message.type}] ：${message.comment}`;
+  if (message.prize !== undefined) return `[${message.type}] ：${message.prize}`;
+  return null;
+}
+
+// サーバーに渡すキーワードフィルター（サーバーでの破棄を選んだ場合の、監視開始時の除外ワード）
+// 「除外ワードを非表示」は表示だけの切り替えなので、ここでは使わない
+function buildKeywordFilter() {
+  if (!serverExcludeWords) return {};
+  return { exclude: excludeWords.filter(word => word), case_sensitive: true };
+}
+
+// 除外ワードを1つの正規表現にまとめる（除外ワードがなければnull）
+function buildExcludePattern(words) {
+  const escaped = words
+    .filter(word => word)
+    .map(word => word.replace(/[.*+?^${}()|[\]\\]/g, '\\$&'));
+  return escaped.length ? new RegExp(escaped.join('|')) : null;
+}
+
+// メッセージが除外ワードを含むかチェック（監視開始後に追加した除外ワードと、保存済みのメッセージ用）
 function containsExcludeWord(text) {
-  if (!hideExcludedWords) return false;
-  return excludeWords.some(word => word && text.includes(word));
+  if (!hideExcludedWords || !excludePattern) return false;
+  return excludePattern.test(text);
 }
 
 // 新しいメッセージを追加する関数の最適化版
@@ -258,6 +414,9 @@ function addNewMessages(newMessages) {
     if (!existingIds.has(message.id)) {
       // レンダリング状態を追跡するフラグを追加
       message.rendered = false;
+      // チェック状態をサーバーに保存するため、履歴ストアのセッションIDを記録
+      message.store_session = scrapeId;
+      ensureMessageFields(message);
       
       // メッセージ配列に追加
       messages.push(message);
@@ -278,6 +437,24 @@ function addNewMessages(newMessages) {
   }
 }
 
+// チェック状態をサーバーの履歴ストアに保存する（セッションごとにまとめて送信）
+function persistChecked(changedMessages, checked) {
+  const idsBySession = {};
+  changedMessages.forEach(message => {
+    if (!message.store_session) return;
+    (idsBySession[message.store_session] = idsBySession[message.store_session] || []).push(message.id);
+  });
+  Object.entries(idsBySession).forEach(([storeSession, ids]) => {
+    fetch('/api/messages/checked', {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+      },
+      body: JSON.stringify({ session_id: storeSession, ids, checked }),
+    }).catch(err => console.error('Failed to save checked state:', err));
+  });
+}
+
 // メッセージアイテムを作成する関数
 function createMessageItem(message, index, isGrouped = false, count = 1, isOverLimit = false) {
   const div = document.createElement('div');
@@ -292,6 +469,7 @@ function createMessageItem(message, index, isGrouped = false, count = 1, isOverL
     message.checked = checkbox.checked;
     // ローカルストレージに保存
     saveSettings('messages', messages);
+    persistChecked([message], checkbox.checked);
   });
 
   const label = document.createElement('label');
@@ -300,9 +478,7 @@ function createMessageItem(message, index, isGrouped = false, count = 1, isOverL
   
   // グループ化されている場合はユーザー名のみ表示
   if (isGrouped) {
-    // ユーザー名部分を抽出 (【username】の形式から)
-    const usernameMatch = message.text.match(/【(.*?)】/);
-    const username = usernameMatch ? usernameMatch[1] : 'Unknown';
+    const username = message.username || 'Unknown';
     
     // ユーザー名の後に投稿回数を表示
     const usernameText = document.createTextNode(username);
@@ -321,9 +497,7 @@ function createMessageItem(message, index, isGrouped = false, count = 1, isOverL
       label.appendChild(countSpan);
     }
   } else {
-    // メッセージタイプを抽出
-    const typeMatch = message.text.match(/\[(.*?)\]/);
-    const messageType = typeMatch ? typeMatch[1] : '';
+    const messageType = message.type || '';
     
     // メッセージタイプを表示する要素
     if (messageType) {
@@ -335,6 +509,11 @@ function createMessageItem(message, index, isGrouped = false, count = 1, isOverL
     
     // メッセージ本文
     label.appendChild(document.createTextNode(" " + message.text));
+    
+    // サーバー側のキーワードフィルターで一致した語句
+    if (message.keywords && message.keywords.length) {
+      label.title = `一致: ${message.keywords.join(', ')}`;
+    }
   }
   
   div.appendChild(label);
@@ -369,15 +548,18 @@ function updateCheckboxList() {
     filteredMessages.forEach((message, index) => {
       checkboxList.appendChild(createMessageItem(message, index));
     });
+  } else if (sortMode === 'amount') {
+    // 金額順（同額なら新しい順）
+    filteredMessages.sort((a, b) => (b.amount || 0) - (a.amount || 0) || new Date(b.timestamp) - new Date(a.timestamp));
+    filteredMessages.forEach((message, index) => {
+      checkboxList.appendChild(createMessageItem(message, index));
+    });
   } else {
     // 内容でグループ化
     const groupedMessages = {};
     filteredMessages.forEach(message => {
-      const match = message.text.match(/\[(.*?)\] .*?：(.*?) 【/);
-      if (match) {
-        const [, type, commentText] = match;
-        const groupKey = `[${type}] ：${commentText}`;
-
+      const groupKey = messageGroupKey(message);
+      if (groupKey !== null) {
         if (!groupedMessages[groupKey]) {
           groupedMessages[groupKey] = [];
         }
@@ -393,9 +575,8 @@ function updateCheckboxList() {
       // ユーザーごとのカウント用マップを作成
       const userCounts = {};
       messages.forEach(message => {
-        const usernameMatch = message.text.match(/【(.*?)】/);
-        if (usernameMatch) {
-          const username = usernameMatch[1];
+        const username = message.username;
+        if (username) {
           userCounts[username] = (userCounts[username] || 0) + 1;
         }
       });
@@ -462,9 +643,8 @@ function updateCheckboxList() {
         const recountedUserCounts = {};
         
         messages.forEach((message) => {
-          const usernameMatch = message.text.match(/【(.*?)】/);
-          if (usernameMatch) {
-            const username = usernameMatch[1];
+          const username = message.username;
+          if (username) {
             recountedUserCounts[username] = (recountedUserCounts[username] || 0) + 1;
             
             // 無制限の場合は全てカウント、そうでなければ上限まで
@@ -499,9 +679,8 @@ function updateCheckboxList() {
         
         // まずメッセージをユーザーごとにグループ化
         groupMessages.forEach(message => {
-          const usernameMatch = message.text.match(/【(.*?)】/);
-          if (usernameMatch) {
-            const username = usernameMatch[1];
+          const username = message.username;
+          if (username) {
             if (!userMessages[username]) {
               userMessages[username] = [];
             }
@@ -570,17 +749,20 @@ function updateCheckboxList() {
         const newState = !allChecked;
 
         // 表示されている項目のチェック状態を変更
+        const changed = [];
         checkboxes.forEach(checkbox => {
           checkbox.checked = newState;
           const messageId = checkbox.id.replace('checkbox-', '');
           const messageIndex = messages.findIndex(m => m.id === messageId);
           if (messageIndex !== -1) {
             messages[messageIndex].checked = newState;
+            changed.push(messages[messageIndex]);
           }
         });
 
         // ストレージを更新
         saveSettings('messages', messages);
+        persistChecked(changed, newState);
       });
 
       checkboxList.appendChild(groupDiv);
@@ -607,6 +789,12 @@ hideExcludedWordsCheckbox.addEventListener('change', function () {
   updateCheckboxList();
 });
 
+// サーバーでの破棄は次に監視を開始したときから反映される
+serverExcludeWordsCheckbox.addEventListener('change', function () {
+  serverExcludeWords = this.checked;
+  saveSettings('serverExcludeWords', serverExcludeWords);
+});
+
 sortModeSelect.addEventListener('change', function () {
   sortMode = this.value;
   saveSettings('sortMode', sortMode);
@@ -631,6 +819,7 @@ saveExcludeWordsButton.addEventListener('click', function() {
   excludeWords = filtered.length ? filtered : Array(20).fill('');
   
   saveSettings('excludeWords', excludeWords);
+  excludePattern = buildExcludePattern(excludeWords);
   excludeWordsModal.classList.remove('show');
   updateCheckboxList();
 });
@@ -0,0 +1,170 @@
+// fakedom.js
+// ページ内スクリプトのテスト用の最小限のDOM（クラス・属性の部分一致・子孫結合子のセレクターだけに対応）
+// 標準入力で {html, steps} を受け取り、各ステップの結果をJSONで標準出力に書き出す
+'use strict';
+
+class Text {
+    constructor(value) {
+        this.nodeType = 3;
+        this.value = value;
+        this.parentElement = null;
+    }
+    get textContent() {
+        return this.value;
+    }
+    get outerHTML() {
+        return this.value;
+    }
+}
+
+class Element {
+    constructor(tagName, attributes) {
+        this.nodeType = 1;
+        this.tagName = tagName;
+        this.attributes = new Map(Object.entries(attributes || {}));
+        this.childNodes = [];
+        this.parentElement = null;
+    }
+    getAttribute(name) {
+        return this.attributes.has(name) ? this.attributes.get(name) : null;
+    }
+    hasAttribute(name) {
+        return this.attributes.has(name);
+    }
+    setAttribute(name, value) {
+        this.attributes.set(name, String(value));
+    }
+    get className() {
+        return this.getAttribute('class') || '';
+    }
+    get children() {
+        return this.childNodes.filter((node) => node.nodeType === 1);
+    }
+    get textContent() {
+        return this.childNodes.map((node) => node.textContent).join('');
+    }
+    get outerHTML() {
+        const attributes = Array.from(this.attributes).map(([k, v]) => ` ${k}="${v}"`).join('');
+        return `<${this.tagName}${attributes}>${this.childNodes.map((node) => node.outerHTML).join('')}</${this.tagName}>`;
+    }
+    appendChild(node) {
+        node.parentElement = this;
+        this.childNodes.push(node);
+        document.notify({addedNodes: [node]});
+        return node;
+    }
+    removeChild(node) {
+        this.childNodes = this.childNodes.filter((child) => child !== node);
+        node.parentElement = null;
+        return node;
+    }
+    matches(selector) {
+        return selector.split(',').some((part) => matchComplex(this, part.trim().split(/\s+/)));
+    }
+    querySelectorAll(selector) {
+        const found = [];
+        const walk = (el) => {
+            for (const child of el.children) {
+                if (child.matches(selector)) {
+                    found.push(child);
+                }
+                walk(child);
+            }
+        };
+        walk(this);
+        return found;
+    }
+    querySelector(selector) {
+        return this.querySelectorAll(selector)[0] || null;
+    }
+}
+
+// 単純セレクター（.class と [class*="..."] の組み合わせ）に一致するか
+const matchCompound = (el, compound) => {
+    const classes = el.className.split(/\s+/);
+    const tokens = compound.match(/\.[\w-]+|\[class\*="[^"]*"\]/g) || [];
+    return tokens.length > 0 && tokens.every((token) => token.startsWith('.')
+        ? classes.includes(token.slice(1))
+        : el.className.includes(token.slice(9, -2)));
+};
+
+// 子孫結合子でつないだセレクターに一致するか
+const matchComplex = (el, compounds) => {
+    if (!matchCompound(el, compounds[compounds.length - 1])) {
+        return false;
+    }
+    let rest = compounds.slice(0, -1);
+    for (let ancestor = el.parentElement; ancestor && rest.length; ancestor = ancestor.parentElement) {
+        if (matchCompound(ancestor, rest[rest.length - 1])) {
+            rest = rest.slice(0, -1);
+        }
+    }
+    return rest.length === 0;
+};
+
+// JSONで表した要素 [tag, attributes, ...children] から要素を作る
+const build = (spec) => {
+    if (typeof spec === 'string') {
+        return new Text(spec);
+    }
+    const [tagName, attributes, ...children] = spec;
+    const el = new Element(tagName, attributes);
+    for (const child of children) {
+        const node = build(child);
+        node.parentElement = el;
+        el.childNodes.push(node);
+    }
+    return el;
+};
+
+const observers = [];
+class MutationObserver {
+    constructor(callback) {
+        this.callback = callback;
+    }
+    observe() {
+        observers.push(this);
+    }
+}
+
+const document = {
+    body: null,
+    readyState: 'complete',
+    querySelectorAll: (selector) => document.body.querySelectorAll(selector),
+    querySelector: (selector) => document.body.querySelector(selector),
+    notify: (record) => observers.forEach((observer) => observer.callback([record])),
+};
+
+const findByPath = (path) => path.reduce((el, index) => el.children[index], document.body);
+
+const input = JSON.parse(require('fs').readFileSync(0, 'utf8'));
+global.window = global;
+global.document = document;
+global.MutationObserver = MutationObserver;
+global.pushed = [];
+document.body = build(input.body);
+
+const results = input.steps.map((step) => {
+    switch (step.op) {
+        case 'run':
+            return new Function(step.script).apply(null, step.args);
+        case 'append':
+            findByPath(step.path).appendChild(build(step.node));
+            return null;
+        case 'remove': {
+            const el = findByPath(step.path);
+            el.parentElement.removeChild(el);
+            return null;
+        }
+        case 'bind':
+            window[step.name] = (payload) => pushed.push(...JSON.parse(payload));
+            return null;
+        case 'pushed':
+            return pushed.splice(0);
+        case 'html':
+            return document.body.outerHTML;
+        default:
+            throw new Error(`unknown step ${step.op}`);
+    }
+});
+process.stdout.write(JSON.stringify(results));
@@ -0,0 +1,96 @@
+# test_broadcast_hub.py
+"""ブロードキャストハブの配信・遅い購読者の扱い・再接続時の再送"""
+from queue import Empty
+
+import pytest
+
+from app import BroadcastHub
+
+def test_every_subscriber_receives_each_batch_with_increasing_ids():
+    hub = BroadcastHub(capacity=8, policy='drop_oldest')
+    first = hub.subscribe()
+    second = hub.subscribe()
+    hub.put([{'id': 'a'}])
+    hub.put([{'id': 'b'}])
+    expected = [(1, [{'id': 'a'}]), (2, [{'id': 'b'}])]
+    assert first.drain_nowait() == expected
+    assert second.drain_nowait() == expected
+    with pytest.raises(Empty):
+        first.get_nowait()
+
+def test_drop_oldest_keeps_the_newest_batches():
+    hub = BroadcastHub(capacity=2, policy='drop_oldest')
+    slow = hub.subscribe()
+    for n in range(5):
+        hub.put([n])
+    assert slow.drain_nowait() == [(4, [3]), (5, [4])]
+    assert slow.dropped == 3
+    assert hub.subscriber_count() == 1
+
+def test_disconnect_policy_closes_only_the_slow_subscriber():
+    hub = BroadcastHub(capacity=2, policy='disconnect')
+    slow = hub.subscribe()
+    fast = hub.subscribe()
+    for n in range(3):
+        hub.put([n])
+        fast.drain_nowait()
+    assert slow.closed and slow.close_reason == 'slow_consumer'
+    assert not fast.closed
+    assert hub.subscriber_count() == 1
+    assert hub.stats()['slow_disconnects'] == 1
+
+def test_invalid_settings_are_rejected():
+    with pytest.raises(ValueError):
+        BroadcastHub(capacity=-1)
+    with pytest.raises(ValueError):
+        BroadcastHub(policy='block')
+
+def test_close_ends_current_and_later_subscriptions():
+    hub = BroadcastHub(capacity=2)
+    subscription = hub.subscribe()
+    hub.close()
+    assert subscription.closed and subscription.close_reason == 'session_stopped'
+    assert hub.subscribe().closed
+
+def test_idle_time_starts_when_the_last_subscriber_leaves():
+    hub = BroadcastHub(capacity=2)
+    subscription = hub.subscribe()
+    assert hub.idle_seconds() == 0
+    assert hub.unsubscribe(subscription) == 0
+    assert hub.idle_seconds(now=hub.idle_since + 5) == 5
+
+def test_resume_replays_only_batches_after_last_event_id():
+    hub = BroadcastHub(capacity=8, replay_size=8)
+    for n in range(4):
+        hub.put([n])
+    subscription = hub.subscribe(last_event_id=2)
+    assert subscription.drain_nowait() == [(3, [2]), (4, [3])]
+    assert subscription.replay_gap is None
+    assert subscription.replayed_until == 4
+    hub.put([4])
+    assert subscription.drain_nowait() == [(5, [4])]
+
+def test_resume_past_the_replay_log_reports_the_gap():
+    hub = BroadcastHub(capacity=8, replay_size=3)
+    for n in range(6):
+        hub.put([n])
+    # イベント2の後から再開したいが、再送ログには4以降しか残っていない
+    subscription = hub.subscribe(last_event_id=2)
+    assert subscription.replay_gap == 4
+    assert [event_id for event_id, _ in subscription.drain_nowait()] == [4, 5, 6]
+
+def test_caught_up_resume_replays_nothing():
+    hub = BroadcastHub(capacity=8, replay_size=8)
+    hub.put([0])
+    subscription = hub.subscribe(last_event_id=1)
+    assert subscription.drain_nowait() == []
+    assert subscription.replay_gap is None
+
+def test_event_id_from_another_hub_replays_everything():
+    hub = BroadcastHub(capacity=8, replay_size=8)
+    hub.put([0])
+    hub.put([1])
+    # 再起動前のハブのIDはこのハブより先に進んでいる
+    subscription = hub.subscribe(last_event_id=100)
+    assert [event_id for event_id, _ in subscription.drain_nowait()] == [1, 2]
+    assert subscription.replay_gap is None
@@ -0,0 +1,76 @@
+# test_browser_pool.py
+"""ブラウザプールの割り当て（Chromeの代わりに起動の遅い偽のブラウザを使う）"""
+import threading
+import time
+
+import app
+from app import BrowserPool
+
+class FakeBrowser:
+    """PooledBrowserのうち、プールの割り当てが使う部分だけを持つ偽のブラウザ"""
+    
+    def __init__(self, browser_id, network_capture=False, profile='standard'):
+        time.sleep(0.05)
+        self.browser_id = browser_id
+        self.network_capture = network_capture
+        self.profile = profile
+        self.tabs = {}
+        self.pending_tabs = 0
+        self.sessions_served = 0
+        self.started_at = time.time()
+        self.healthy = True
+        self.draining = False
+    
+    def open_tab(self, session_id):
+        time.sleep(0.01)
+        self.tabs[session_id] = session_id
+        return self
+
+def make_pool(monkeypatch, max_browsers, max_tabs):
+    monkeypatch.setattr(app, 'PooledBrowser', FakeBrowser)
+    pool = BrowserPool(warm_size=0, max_browsers=max_browsers, max_tabs=max_tabs, health_check_interval=60,
+                       max_age=3600, max_sessions_served=1000)
+    monkeypatch.setattr(pool, 'start', lambda: None)
+    return pool
+
+def test_concurrent_acquires_respect_browser_and_tab_limits(monkeypatch):
+    pool = make_pool(monkeypatch, max_browsers=2, max_tabs=2)
+    results = []
+    
+    def acquire(index):
+        try:
+            results.append(pool.acquire(f'session-{index}'))
+        except RuntimeError:
+            results.append(None)
+    
+    threads = [threading.Thread(target=acquire, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    assert len(pool.browsers) == 2
+    assert all(len(b.tabs) <= 2 for b in pool.browsers)
+    assert sum(len(b.tabs) for b in pool.browsers) == sum(1 for r in results if r is not None)
+    assert pool.pending_launches == 0 and all(b.pending_tabs == 0 for b in pool.browsers)
+    
+    # 起動を待っている間に断られた分も、起動後は空いたタブ枠に入る
+    for index in range(4 - sum(len(b.tabs) for b in pool.browsers)):
+        pool.acquire(f'late-{index}')
+    assert sorted(len(b.tabs) for b in pool.browsers) == [2, 2]
+
+def test_failed_launch_returns_reserved_slot(monkeypatch):
+    pool = make_pool(monkeypatch, max_browsers=1, max_tabs=1)
+    
+    def broken(*args):
+        raise OSError('chrome failed to start')
+    
+    monkeypatch.setattr(app, 'PooledBrowser', broken)
+    try:
+        pool.acquire('session-1')
+    except OSError:
+        pass
+    assert pool.pending_launches == 0
+    
+    monkeypatch.setattr(app, 'PooledBrowser', FakeBrowser)
+    assert pool.acquire('session-2') is pool.browsers[0]
@@ -0,0 +1,60 @@
+# test_dedup_index.py
+"""重複排除インデックスの件数・時間窓による追い出しと、チェックポイントからの復元"""
+import time
+
+from app import BoundedDedupIndex, filter_new_messages
+
+def test_check_and_add_reports_first_sighting_only():
+    index = BoundedDedupIndex(capacity=10, ttl=0)
+    assert index.check_and_add('a') is True
+    assert index.check_and_add('a') is False
+    assert 'a' in index and 'b' not in index
+    assert index.stats()['hits'] == 1 and index.stats()['misses'] == 1
+
+def test_capacity_evicts_least_recently_seen():
+    index = BoundedDedupIndex(capacity=2, ttl=0)
+    index.check_and_add('a', now=1)
+    index.check_and_add('b', now=2)
+    # 再び見えたIDは新しい扱いになり、追い出されない
+    index.check_and_add('a', now=3)
+    index.check_and_add('c', now=4)
+    assert len(index) == 2
+    assert 'a' in index and 'b' not in index and 'c' in index
+    assert index.stats()['evictions'] == 1
+
+def test_ttl_expires_ids_not_seen_within_the_window():
+    index = BoundedDedupIndex(capacity=10, ttl=60)
+    index.check_and_add('a', now=0)
+    index.check_and_add('b', now=50)
+    index.check_and_add('c', now=100)
+    assert 'a' not in index and 'b' in index
+    assert index.stats()['expirations'] == 1
+
+def test_reappearing_evicted_id_counts_as_false_reemit():
+    index = BoundedDedupIndex(capacity=1, ttl=0)
+    index.check_and_add('a', now=1)
+    index.check_and_add('b', now=2)
+    assert index.check_and_add('a', now=3) is True
+    assert index.stats()['false_reemits'] == 1
+
+def test_checkpoint_round_trip_keeps_newest_entries():
+    index = BoundedDedupIndex(capacity=10, ttl=600)
+    now = time.time()
+    for n, message_id in enumerate('abcd'):
+        index.check_and_add(message_id, now=now + n)
+    restored = BoundedDedupIndex.from_checkpoint(index.checkpoint(limit=3))
+    assert (restored.capacity, restored.ttl) == (10, 600)
+    assert [m in restored for m in 'abcd'] == [False, True, True, True]
+    assert restored.check_and_add('d') is False
+
+def test_restore_drops_entries_outside_the_window():
+    index = BoundedDedupIndex(capacity=10, ttl=60)
+    index.check_and_add('old', now=time.time() - 120)
+    index.check_and_add('new')
+    restored = BoundedDedupIndex.from_checkpoint(index.checkpoint())
+    assert 'old' not in restored and 'new' in restored
+
+def test_filter_new_messages_drops_already_seen_ids():
+    index = BoundedDedupIndex(capacity=10, ttl=0)
+    assert filter_new_messages([{'id': 'a'}, {'id': 'b'}], index) == [{'id': 'a'}, {'id': 'b'}]
+    assert filter_new_messages([{'id': 'b'}, {'id': 'c'}], index) == [{'id': 'c'}]
@@ -0,0 +1,95 @@
+# test_diagnostics.py
+"""診断情報の収集が同じブラウザの他のタブの抽出を待たせないこと"""
+import threading
+import time
+
+import pytest
+
+import app
+from app import BrowserTab, DiagnosticsCollector
+
+class FakeDriver:
+    def __init__(self):
+        self.calls = []
+    
+    @property
+    def page_source(self):
+        self.calls.append('page_source')
+        return '<html></html>'
+    
+    def execute_script(self, script, *args):
+        self.calls.append('execute_script')
+        return {'title': 'chat'}
+    
+    def save_screenshot(self, filename):
+        self.calls.append('save_screenshot')
+        return True
+
+class FakeBrowser:
+    """PooledBrowserのうち、タブの操作が使う部分だけを持つ偽のブラウザ"""
+    
+    def __init__(self):
+        self.browser_id = 1
+        self.lock = threading.RLock()
+        self.driver = FakeDriver()
+    
+    def switch_to(self, handle):
+        pass
+
+@pytest.fixture
+def collector(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'DIAGNOSTICS_DIR', str(tmp_path))
+    collector = DiagnosticsCollector()
+    collector.configure('s1', 'always')
+    return collector
+
+def job(html=None):
+    return {'session_id': 's1', 'html': html, 'reason': 'tick', 'error': None, 'requested_at': 'now'}
+
+def test_collect_reuses_the_page_fetched_by_the_monitoring_loop(collector):
+    browser = FakeBrowser()
+    collector.attach('s1', BrowserTab(browser, 'tab', 's1'))
+    collector.remember_page('s1', '<div class="messages"></div>')
+    snapshot = collector._collect(job())
+    assert snapshot['html_stats']['messages'] == 1
+    assert 'page_source' not in browser.driver.calls
+    assert snapshot['page_structure'] == {'title': 'chat'} and 'screenshot_path' in snapshot
+
+def test_collect_skips_browser_work_while_another_tab_uses_the_browser(collector):
+    browser = FakeBrowser()
+    collector.attach('s1', BrowserTab(browser, 'tab', 's1'))
+    held = threading.Event()
+    release = threading.Event()
+    
+    def extract():
+        with browser.lock:
+            held.set()
+            release.wait(5)
+    
+    extractor = threading.Thread(target=extract)
+    extractor.start()
+    held.wait(5)
+    try:
+        started = time.monotonic()
+        snapshot = collector._collect(job('<html></html>'))
+        assert time.monotonic() - started < 1
+    finally:
+        release.set()
+        extractor.join()
+    assert snapshot['skipped'] == ['page_structure', 'screenshot']
+    assert browser.driver.calls == []
+
+def test_collect_reads_the_page_only_from_an_idle_browser(collector):
+    # 診断を有効にした直後は、監視ループが取得したHTMLがまだない
+    browser = FakeBrowser()
+    collector.attach('s1', BrowserTab(browser, 'tab', 's1'))
+    snapshot = collector._collect(job())
+    assert browser.driver.calls[0] == 'page_source'
+    assert snapshot['html_length'] == len('<html></html>')
+    assert snapshot['skipped'] == []
+
+def test_pages_are_not_kept_while_diagnostics_are_off(collector):
+    collector.configure('s1', 'off')
+    collector.remember_page('s1', '<html></html>')
+    assert 's1' not in collector.pages
+    assert collector.setting('s1') == {'level': 'off', 'sample_every': app.DEFAULT_DIAGNOSTIC_SAMPLE_EVERY}
@@ -0,0 +1,85 @@
+# test_extraction_engines.py
+"""lxmlエンジンがbs4エンジン（従来の実装）とIDまで同じメッセージを抽出すること"""
+import random
+
+import pytest
+
+from app import ORDINAL_ATTRIBUTE, build_synthetic_row, get_extraction_engine
+
+def tip(username, amount, comment, row_class='message message-base', tip_class='tip-comment', inner='', attrs=''):
+    return (f'<div class="{row_class}"{attrs}><div class="{tip_class}">{inner}'
+            f'<span class="user-levels-username-text">{username}</span>'
+            f'<span class="tip-amount-highlight">{amount}</span>'
+            f'<span class="tip-comment-body">{comment}</span></div></div>')
+
+def wheel(username, prize, row_class='message plugin-message', name_class='plugin-message-plugin-name',
+          accent_class='plugin-message-accent', user_class='user-levels-username-text', plugin='Wheel of Fortune'):
+    return (f'<div class="{row_class}"><div class="plugin-message-content">'
+            f'<span class="{name_class}">{plugin}</span>'
+            f'<span class="{user_class}">{username}</span> won '
+            f'<span class="{accent_class}">{prize}</span></div></div>')
+
+def page(*rows, container='messages'):
+    return f'<html><head><title>chat</title></head><body><div class="{container}">{"".join(rows)}</div></body></html>'
+
+FIXTURES = {
+    'synthetic': page(*(build_synthetic_row(i, random.Random(i)) for i in range(300))),
+    'tip_types': page(
+        tip('alice', '10 tk', 'hi'),
+        tip('bob', '1,000 tk', 'menu item', tip_class='tip-comment tip-comment-with-highlight tip-menu'),
+        tip('carol', '50 tk', 'goal', inner='<div class="tip-comment-epic-goal">Epic Goal</div>'),
+        # 数値のないチップ表記と、空のコメント
+        tip('dave', 'tk', '')
+    ),
+    'wheel_variants': page(
+        wheel('erin', 'Prize 1'),
+        # クラスの部分一致だけで見つかる項目
+        wheel('frank', 'Prize 2', name_class='x-plugin-name', accent_class='x-accent', user_class='x-username'),
+        wheel('grace', 'Prize 3', plugin='Dice'),
+        wheel('heidi', ''),
+        wheel('', 'Prize 4', user_class='user-levels-username-text')
+    ),
+    'duplicates_and_whitespace': page(
+        tip('alice', '10 tk', 'same'),
+        tip(' alice ', '10  tk', 'same'),
+        tip('alice', '10 tk', 'same', attrs=f' {ORDINAL_ATTRIBUTE}="0"'),
+        tip('alice', '10 tk', 'same', attrs=f' {ORDINAL_ATTRIBUTE}="1"'),
+        # 序数が外側の要素にだけ付いている
+        f'<div {ORDINAL_ATTRIBUTE}="2">{tip("alice", "10 tk", "same")}</div>',
+        tip('ivan', '5 tk', 'has id', attrs=' data-message-id="server-1"')
+    ),
+    'containers': ''.join([
+        page(tip('judy', '1 tk', 'in chat-messages'), container='chat-messages'),
+        page(tip('mallory', '2 tk', 'in stream-messages', row_class='message'), container='stream-messages'),
+        page(tip('niaj', '3 tk', 'in chat-list', row_class='message-item'), container='chat-list'),
+        # コンテナの外の.messageは対象外（中の.tip-commentは対象）
+        page(tip('olivia', '4 tk', 'outside', row_class='message'), container='sidebar'),
+        page(f'<div class="custom-message-item-row">{tip("peggy", "6 tk", "partial class")}</div>', container='feed')
+    ]),
+    'text_content': page(
+        tip('rupert', '7 tk', 'a &amp; b &lt;3 <b>bold</b> 絵文字🎉'),
+        tip('sybil', '8 tk', 'line\n  break'),
+        wheel('trent', 'Prize <i>5</i> &amp; more')
+    )
+}
+
+def comparable(messages):
+    """タイムスタンプ（実行時刻）以外の全項目"""
+    return [{key: value for key, value in message.items() if key != 'timestamp'} for message in messages]
+
+def extract(engine, html):
+    extractor = get_extraction_engine(engine)
+    return extractor.extract_from_document(extractor.parse(html))
+
+@pytest.mark.parametrize('name', sorted(FIXTURES))
+def test_lxml_output_matches_bs4(name):
+    expected = comparable(extract('bs4', FIXTURES[name]))
+    assert expected, name
+    assert comparable(extract('lxml', FIXTURES[name])) == expected
+
+def test_ids_are_stable_across_runs():
+    html = FIXTURES['duplicates_and_whitespace']
+    ids = [message['id'] for message in extract('lxml', html)]
+    assert ids == [message['id'] for message in extract('lxml', html)]
+    # 同じ内容でも序数が違えば別のID、ページ側のIDはそのまま使う
+    assert len(set(ids)) == len(ids) and 'server-1' in ids
@@ -0,0 +1,133 @@
+# test_harvester.py
+"""ページ内スクリプト（ハーベスター・domモードの序数付与）を最小限のDOM上のNode.jsで実行するテスト"""
+import json
+import os
+import shutil
+import subprocess
+
+import pytest
+
+import app
+from app import (HARVESTER_INSTALL_SCRIPT, HARVESTER_DRAIN_SCRIPT, DOM_ORDINAL_SCRIPT, MESSAGE_SELECTOR,
+                 HARVESTER_MAX_BUFFER, ORDINAL_ATTRIBUTE, ELEMENT_KEY_ATTRIBUTE, ElementMessageCache,
+                 extract_messages_from_html, get_extraction_engine, wrap_fragments)
+
+FAKEDOM = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fakedom.js')
+
+pytestmark = pytest.mark.skipif(shutil.which('node') is None, reason='Node.js is required')
+
+def tip(username, amount, comment):
+    return ['div', {'class': 'message message-base'},
+            ['div', {'class': 'tip-comment'},
+             ['span', {'class': 'user-levels-username-text'}, username],
+             ['span', {'class': 'tip-amount-highlight'}, f'{amount} tk'],
+             ['span', {'class': 'tip-comment-body'}, comment]]]
+
+def page(*rows):
+    return ['body', {}, ['div', {'class': 'chat-wrapper'}, ['div', {'class': 'messages'}, *rows]]]
+
+# .chat-wrapper > .messages の位置
+MESSAGES_PATH = [0, 0]
+
+def run_steps(body, steps):
+    completed = subprocess.run(['node', FAKEDOM], input=json.dumps({'body': body, 'steps': steps}),
+                               capture_output=True, text=True, check=True)
+    return json.loads(completed.stdout)
+
+def install(push_binding=None):
+    return {'op': 'run', 'script': HARVESTER_INSTALL_SCRIPT,
+            'args': [MESSAGE_SELECTOR, HARVESTER_MAX_BUFFER, push_binding, ORDINAL_ATTRIBUTE]}
+
+def drain():
+    return {'op': 'run', 'script': HARVESTER_DRAIN_SCRIPT, 'args': []}
+
+def message_ids(fragments):
+    return [m['id'] for m in extract_messages_from_html(wrap_fragments(fragments))]
+
+def test_install_harvests_visible_messages_with_ordinals():
+    installed, fragments = run_steps(page(tip('alice', 10, 'hi'), tip('alice', 10, 'hi'), tip('bob', 5, 'yo')),
+                                     [install(), drain()])
+    assert installed is True
+    assert len(fragments) == 3
+    assert [f'{ORDINAL_ATTRIBUTE}="{n}"' in f for n, f in zip((0, 1, 0), fragments)] == [True, True, True]
+    # 同じ内容の2行は別のIDになる
+    assert not set(message_ids(fragments[:1])) & set(message_ids(fragments[1:2]))
+
+def test_observer_collects_added_rows_once_per_drain():
+    _, first, _, _, second, third = run_steps(page(tip('alice', 10, 'hi')), [
+        install(), drain(),
+        {'op': 'append', 'path': MESSAGES_PATH, 'node': tip('bob', 5, 'yo')},
+        {'op': 'append', 'path': MESSAGES_PATH, 'node': tip('carol', 1, 'hey')},
+        drain(), drain()
+    ])
+    assert len(first) == 1
+    assert [('bob' in f, 'carol' in f) for f in second] == [(True, False), (False, True)]
+    assert third == []
+
+def test_repeated_message_keeps_new_ordinal_after_old_one_scrolls_out():
+    _, first, _, _, second = run_steps(page(tip('alice', 10, 'hi')), [
+        install(), drain(),
+        # 古い行が画面から消えた後に、同じ内容の行が届く
+        {'op': 'remove', 'path': MESSAGES_PATH + [0]},
+        {'op': 'append', 'path': MESSAGES_PATH, 'node': tip('alice', 10, 'hi')},
+        drain()
+    ])
+    assert message_ids(first) != message_ids(second)
+
+def test_push_binding_receives_rows():
+    results = run_steps(page(tip('alice', 10, 'hi')), [
+        {'op': 'bind', 'name': 'pushTarget'},
+        install('pushTarget'),
+        {'op': 'append', 'path': MESSAGES_PATH, 'node': tip('bob', 5, 'yo')},
+        {'op': 'pushed'}, drain()
+    ])
+    pushed, remaining = results[3], results[4]
+    assert len(pushed) == 2 and 'bob' in pushed[1]
+    assert remaining == []
+
+def dom_stamp():
+    return {'op': 'run', 'script': DOM_ORDINAL_SCRIPT, 'args': [MESSAGE_SELECTOR, ORDINAL_ATTRIBUTE, ELEMENT_KEY_ATTRIBUTE]}
+
+def test_dom_ordinals_are_stable_across_scroll_out():
+    stamp = dom_stamp()
+    results = run_steps(page(tip('alice', 10, 'hi'), tip('alice', 10, 'hi')), [
+        stamp, stamp,
+        {'op': 'remove', 'path': MESSAGES_PATH + [0]},
+        {'op': 'append', 'path': MESSAGES_PATH, 'node': tip('alice', 10, 'hi')},
+        stamp
+    ])
+    # 2回目は付与済みの要素を数え直さず、消えた行の序数を新しい行に使い回さない
+    assert results[0] == 2 and results[1] == 0 and results[4] == 1
+
+@pytest.mark.parametrize('engine', ['bs4', 'lxml'])
+def test_dom_rescan_reuses_messages_of_keyed_elements(engine, monkeypatch):
+    cache = ElementMessageCache(100)
+    monkeypatch.setattr(app, 'element_message_cache', cache)
+    extractor = get_extraction_engine(engine)
+    _, first_html, _, _, second_html = run_steps(page(tip('alice', 10, 'hi'), tip('alice', 10, 'hi')), [
+        dom_stamp(), {'op': 'html'},
+        {'op': 'append', 'path': MESSAGES_PATH, 'node': tip('bob', 5, 'yo')},
+        dom_stamp(), {'op': 'html'}
+    ])
+    assert first_html.count(ELEMENT_KEY_ATTRIBUTE) == 4  # 外側の行と、入れ子の.tip-comment
+    first = extractor.extract_from_document(extractor.parse(first_html))
+    entries = len(cache.entries)
+    
+    # 付与済みの要素は項目を走査し直さない（書き換えても前回のメッセージが使われる）
+    second = extractor.extract_from_document(extractor.parse(second_html.replace('>hi<', '>changed<')))
+    assert [m['id'] for m in second[:len(first)]] == [m['id'] for m in first]
+    assert all(m['comment'] == 'hi' for m in second[:len(first)])
+    assert [m['username'] for m in second[len(first):]] == ['bob', 'bob']
+    assert len(cache.entries) == entries + 2
+    
+    # キーのないHTMLでも同じIDになる
+    unkeyed = extractor.extract_from_document(extractor.parse(second_html.replace(ELEMENT_KEY_ATTRIBUTE, 'data-other')))
+    assert [m['id'] for m in unkeyed] == [m['id'] for m in second]
+
+def test_element_cache_evicts_the_least_recently_used_key():
+    cache = ElementMessageCache(2)
+    cache.put('a', [])
+    cache.put('b', [])
+    cache.get('a')
+    cache.put('c', [])
+    assert list(cache.entries) == ['a', 'c']
@@ -0,0 +1,62 @@
+# test_keyword_filter.py
+"""キーワードフィルターの絞り込みと、正規表現の受け付け条件"""
+import re
+
+import pytest
+
+import app
+from app import KeywordFilter
+
+def chat(text, message_type='メッセージ'):
+    return {'type': message_type, 'text': text}
+
+@pytest.fixture
+def regex_enabled(monkeypatch):
+    monkeypatch.setattr(app, 'KEYWORD_REGEX_ENABLED', True)
+
+def test_include_words_record_matched_keywords_longest_first():
+    keyword_filter = KeywordFilter({'include': ['tip', 'big tip']})
+    matched = keyword_filter.apply([chat('a BIG TIP arrived'), chat('hello')])
+    assert [m['keywords'] for m in matched] == [['big tip']]
+    assert keyword_filter.stats()['dropped_unmatched'] == 1
+
+def test_exclude_words_and_types():
+    keyword_filter = KeywordFilter({'exclude': ['spam'], 'types': ['ルーレット']})
+    messages = [chat('prize', 'ルーレット'), chat('spam prize', 'ルーレット'), chat('prize'), chat('connected', 'system')]
+    assert [m['text'] for m in keyword_filter.apply(messages)] == ['prize', 'connected']
+
+def test_regex_patterns_can_be_disabled(monkeypatch):
+    monkeypatch.setattr(app, 'KEYWORD_REGEX_ENABLED', False)
+    with pytest.raises(re.error):
+        KeywordFilter({'patterns': ['tip']})
+    with pytest.raises(re.error):
+        KeywordFilter({'exclude_patterns': ['tip']})
+
+@pytest.mark.parametrize('pattern', [r'(a+)+b', r'(a|aa)*b', r'(x)\1', r'(?P<name>x)', r'a.*b.*c.*d', r'(\d{2})+'])
+def test_costly_or_group_dependent_patterns_are_rejected(regex_enabled, pattern):
+    with pytest.raises(re.error):
+        KeywordFilter({'patterns': [pattern]})
+
+def test_patterns_keep_their_own_group_numbers(regex_enabled):
+    # 各正規表現は個別にコンパイルされるため、語句のグループと番号が衝突しない
+    keyword_filter = KeywordFilter({'include': ['hello'], 'patterns': [r'(\d+) tk'], 'exclude_patterns': [r'^spam']})
+    matched = keyword_filter.apply([chat('hello 50 tk'), chat('spam 50 tk'), chat('nothing')])
+    assert [m['keywords'] for m in matched] == [['hello', r'(\d+) tk']]
+
+def test_regex_only_sees_the_head_of_long_messages(regex_enabled, monkeypatch):
+    monkeypatch.setattr(app, 'KEYWORD_MAX_REGEX_TEXT_LENGTH', 10)
+    keyword_filter = KeywordFilter({'patterns': ['needle']})
+    assert keyword_filter.apply([chat('x' * 20 + 'needle')]) == []
+
+def test_fingerprint_ignores_order_and_blank_terms():
+    first = KeywordFilter({'include': ['a', 'b', ' ']})
+    second = KeywordFilter({'include': ['b', 'a']})
+    assert first.fingerprint == second.fingerprint
+    assert KeywordFilter().fingerprint is None
+
+def test_matched_keywords_are_recorded_on_copies():
+    # 元のメッセージはハブ・履歴・他の共有者と共有されている
+    original = chat('big tip')
+    matched, = KeywordFilter({'include': ['tip']}).apply([original])
+    assert matched['keywords'] == ['tip']
+    assert 'keywords' not in original
@@ -0,0 +1,128 @@
+# test_message_store.py
+"""履歴ストアの書き込みと、/api/messagesのページ送り・絞り込み・チェック状態の反映"""
+import threading
+import time
+
+import pytest
+
+import app
+from app import MessageStore
+
+def message(n, message_type='メッセージ', username='alice', text=None):
+    return {'id': f'm{n}', 'type': message_type, 'username': username, 'text': text or f'hello {n}',
+            'timestamp': f'2024-01-01T12:00:{n:02d}', 'checked': False}
+
+def wait_until(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = MessageStore(str(tmp_path / 'history' / 'messages.sqlite3'), flush_interval=0.01)
+    store.start()
+    monkeypatch.setattr(app, 'message_store', store)
+    return store
+
+@pytest.fixture
+def client(store, monkeypatch):
+    # 最初のリクエストでブラウザを起動しないようにする
+    monkeypatch.setattr(app, 'background_services_started', True)
+    return app.app.test_client()
+
+def written(store, count):
+    return wait_until(lambda: store.stats()['written'] >= count)
+
+def test_append_does_not_wait_for_the_writer(tmp_path):
+    store = MessageStore(str(tmp_path / 'messages.sqlite3'))
+    blocked = threading.Event()
+    release = threading.Event()
+    original_connect = store._connect
+    
+    def slow_connect():
+        blocked.set()
+        release.wait(5)
+        return original_connect()
+    
+    store._connect = slow_connect
+    started = time.monotonic()
+    assert store.append('s1', [message(1)])
+    assert time.monotonic() - started < 1
+    assert blocked.wait(5)
+    release.set()
+    assert written(store, 1)
+
+def test_duplicate_ids_are_written_once(store):
+    store.append('s1', [message(1), message(2)])
+    store.append('s1', [message(2), message(3)])
+    assert written(store, 3)
+    assert wait_until(lambda: store.stats()['duplicates'] == 1)
+    store.append('s2', [message(1)])
+    assert written(store, 4)
+
+def test_cursor_pagination_walks_every_message_once(store, client):
+    store.append('s1', [message(n) for n in range(7)])
+    assert written(store, 7)
+    seen = []
+    cursor = None
+    for _ in range(5):
+        query = {'session_id': 's1', 'limit': 3, 'order': 'asc'}
+        if cursor:
+            query['cursor'] = cursor
+        page = client.get('/api/messages', query_string=query).get_json()
+        seen.extend(m['id'] for m in page['messages'])
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+    assert seen == [f'm{n}' for n in range(7)]
+    
+    newest = client.get('/api/messages', query_string={'session_id': 's1', 'limit': 2}).get_json()
+    assert [m['id'] for m in newest['messages']] == ['m6', 'm5']
+    older = client.get('/api/messages', query_string={'session_id': 's1', 'limit': 5, 'cursor': newest['next_cursor']}).get_json()
+    assert [m['id'] for m in older['messages']] == ['m4', 'm3', 'm2', 'm1', 'm0']
+    assert older['next_cursor'] is None
+
+def test_type_user_and_text_filters(store, client):
+    store.append('s1', [
+        message(1, 'メッセージ', 'alice', 'big tip 100%'),
+        message(2, 'ルーレット', 'bob', 'won a hug'),
+        message(3, 'エピックゴール', 'alice', 'goal reached'),
+        message(4, 'メッセージ', 'carol', 'tip_100')
+    ])
+    assert written(store, 4)
+    
+    def ids(**query):
+        page = client.get('/api/messages', query_string=dict(query, session_id='s1', order='asc')).get_json()
+        return [m['id'] for m in page['messages']]
+    
+    assert ids(type='ルーレット,エピックゴール') == ['m2', 'm3']
+    assert ids(user='alice') == ['m1', 'm3']
+    assert ids(q='tip') == ['m1', 'm4']
+    # LIKEのワイルドカードは文字として扱う
+    assert ids(q='100%') == ['m1']
+    assert ids(q='p_1') == ['m4']
+    assert ids(type='メッセージ', user='carol') == ['m4']
+
+def test_invalid_queries_are_rejected(client):
+    assert client.get('/api/messages', query_string={'order': 'sideways'}).status_code == 400
+    assert client.get('/api/messages', query_string={'cursor': 'abc'}).status_code == 400
+    assert client.get('/api/messages', query_string={'checked': 'maybe'}).status_code == 400
+
+def test_checked_update_applies_after_the_batch_queued_before_it(store, client):
+    # 追記がまだ書き込まれていなくても、チェック状態の変更は追記の後に反映される
+    store.append('s1', [message(1), message(2)])
+    response = client.post('/api/messages/checked', json={'session_id': 's1', 'ids': ['m2']})
+    assert response.status_code == 200
+    assert wait_until(lambda: store.stats()['checked_updates'] == 1)
+    
+    page = client.get('/api/messages', query_string={'session_id': 's1', 'checked': 'true'}).get_json()
+    assert [m['id'] for m in page['messages']] == ['m2']
+    assert page['messages'][0]['checked'] is True
+    
+    client.post('/api/messages/checked', json={'session_id': 's1', 'ids': ['m2'], 'checked': False})
+    assert wait_until(lambda: store.stats()['checked_updates'] == 2)
+    page = client.get('/api/messages', query_string={'session_id': 's1', 'checked': 'false'}).get_json()
+    assert [m['id'] for m in page['messages']] == ['m2', 'm1']
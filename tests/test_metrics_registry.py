@@ -0,0 +1,125 @@
+# test_metrics_registry.py
+"""Prometheusのテキスト形式・ラベルのエスケープ・ワーカーの値の合算と、配信までの時間の記録"""
+from datetime import datetime, timedelta
+
+import pytest
+
+import app
+from app import BroadcastHub, MetricsRegistry, SseEncoder
+
+def make_registry():
+    registry = MetricsRegistry()
+    registry.counter('test_events_total', 'Events by type')
+    registry.histogram('test_seconds', 'Durations', buckets=(0.1, 1))
+    registry.gauge('test_open', 'Open things')
+    return registry
+
+def samples(text):
+    """HELP・TYPE以外の行を {系列: 値} にする"""
+    return dict(line.rsplit(' ', 1) for line in text.splitlines() if not line.startswith('#'))
+
+def test_render_writes_help_type_and_sorted_labels():
+    registry = make_registry()
+    registry.inc('test_events_total', type='b', engine='lxml')
+    registry.inc('test_events_total', 2, type='a', engine='lxml')
+    registry.inc('test_events_total', 0, type='never')
+    text = registry.render()
+    lines = text.splitlines()
+    assert lines[:4] == ['# HELP test_events_total Events by type', '# TYPE test_events_total counter',
+                         'test_events_total{engine="lxml",type="a"} 2', 'test_events_total{engine="lxml",type="b"} 1']
+    # 値のないメトリクスもHELPとTYPEは出力する
+    assert '# TYPE test_open gauge' in lines and text.endswith('\n')
+    assert 'never' not in text
+
+def test_histogram_buckets_are_cumulative():
+    registry = make_registry()
+    for value in (0.05, 0.5, 0.5, 7):
+        registry.observe('test_seconds', value, engine='bs4')
+    assert samples(registry.render()) == {
+        'test_seconds_bucket{engine="bs4",le="0.1"}': '1',
+        'test_seconds_bucket{engine="bs4",le="1"}': '3',
+        'test_seconds_bucket{engine="bs4",le="+Inf"}': '4',
+        'test_seconds_sum{engine="bs4"}': '8.05',
+        'test_seconds_count{engine="bs4"}': '4'
+    }
+
+def test_label_values_are_escaped():
+    registry = make_registry()
+    registry.inc('test_events_total', type='a"b\\c\nd')
+    assert samples(registry.render()) == {'test_events_total{type="a\\"b\\\\c\\nd"}': '1'}
+
+def test_worker_dumps_are_merged_and_gauges_labelled_by_worker():
+    local = make_registry()
+    local.inc('test_events_total', type='tip')
+    local.observe('test_seconds', 0.5)
+    local.collector(lambda: [('test_open', {'browser': '1'}, 2)])
+    
+    worker = make_registry()
+    worker.inc('test_events_total', 3, type='tip')
+    worker.inc('test_events_total', type='wheel')
+    worker.observe('test_seconds', 0.05)
+    worker.collector(lambda: [('test_open', {'browser': '1'}, 5.0)])
+    
+    assert samples(local.render({2: worker.dump()})) == {
+        'test_events_total{type="tip"}': '4',
+        'test_events_total{type="wheel"}': '1',
+        'test_seconds_bucket{le="0.1"}': '1',
+        'test_seconds_bucket{le="1"}': '2',
+        'test_seconds_bucket{le="+Inf"}': '2',
+        'test_seconds_sum': '0.55',
+        'test_seconds_count': '2',
+        'test_open{browser="1"}': '2',
+        'test_open{browser="1",worker="2"}': '5'
+    }
+    # 出力しても自身の値には取り込まない
+    assert samples(local.render())['test_events_total{type="tip"}'] == '1'
+
+def test_absorbed_dump_of_an_exited_worker_is_kept():
+    local = make_registry()
+    worker = make_registry()
+    worker.inc('test_events_total', 3, type='tip')
+    worker.observe('test_seconds', 0.5)
+    local.absorb(worker.dump())
+    local.absorb(worker.dump())
+    rendered = samples(local.render())
+    assert rendered['test_events_total{type="tip"}'] == '6'
+    assert rendered['test_seconds_count'] == '2'
+
+def test_failing_collector_does_not_break_render():
+    registry = make_registry()
+    
+    @registry.collector
+    def broken():
+        raise RuntimeError('gone')
+    
+    registry.collector(lambda: [('test_open', {}, 1)])
+    assert samples(registry.render()) == {'test_open': '1'}
+
+@pytest.fixture
+def latency(monkeypatch):
+    registry = MetricsRegistry()
+    registry.histogram('chat_emit_latency_seconds', 'latency')
+    monkeypatch.setattr(app, 'metrics', registry)
+    return lambda: registry.dump()['values'].get(('chat_emit_latency_seconds', ()), [0])[-1]
+
+def batch(seconds_ago):
+    return [{'id': f'm{seconds_ago}', 'type': 'メッセージ', 'text': 't', 'checked': False,
+             'timestamp': (datetime.now() - timedelta(seconds=seconds_ago)).isoformat()}]
+
+def test_emit_latency_is_observed_once_per_batch(latency):
+    hub = BroadcastHub(capacity=8)
+    subscribers = [hub.subscribe() for _ in range(3)]
+    hub.put(batch(1))
+    hub.put(batch(2))
+    for subscription in subscribers:
+        SseEncoder().batch(subscription.drain_nowait(), subscription)
+    assert latency() == 2
+    
+    # 再接続した購読者への再送は数えない
+    late = hub.subscribe(last_event_id=0)
+    SseEncoder().batch(late.drain_nowait(), late)
+    assert latency() == 2
+    hub.put(batch(0))
+    for subscription in subscribers + [late]:
+        SseEncoder().batch(subscription.drain_nowait(), subscription)
+    assert latency() == 3
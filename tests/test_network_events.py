@@ -0,0 +1,99 @@
+# test_network_events.py
+"""networkモードで傍受したチャットイベントのJSONからメッセージへの変換（フレームの形ごとの表）"""
+import json
+
+import pytest
+
+from app import extract_messages_from_payloads, network_event_to_message
+
+def event(event_type, username='alice', user_key='userData', **details):
+    payload = {'type': event_type, 'details': details}
+    if username is not None:
+        payload[user_key] = {'username': username}
+    return payload
+
+def fields(message):
+    """IDとタイムスタンプ以外の項目"""
+    return {key: value for key, value in message.items() if key not in ('id', 'timestamp')}
+
+def tip_message(message_type, username, amount, coin_text, comment):
+    return {'text': f'[{message_type}] {coin_text}：{comment} 【{username}】', 'type': message_type, 'username': username,
+            'checked': False, 'amount': amount, 'comment': comment}
+
+def wheel_message(username, prize):
+    return {'text': f'[ルーレット] ：{prize} 【{username}】', 'type': 'ルーレット', 'username': username,
+            'checked': False, 'prize': prize}
+
+CONVERTED = [
+    # チップ
+    ('tip', event('tip', amount=50, body=' hi '), tip_message('メッセージ', 'alice', 50, '50', 'hi')),
+    ('tip_text_and_user_key', event('Tip', user_key='user', amount='1,000', text='yo'),
+     tip_message('メッセージ', 'alice', 1000, '1,000', 'yo')),
+    ('tip_username_in_details', {'type': 'tip', 'details': {'amount': 5, 'username': ' bob '}},
+     tip_message('メッセージ', 'bob', 5, '5', '')),
+    # エピックゴール
+    ('goal_by_type', event('epicGoalTip', amount=25, body='go'), tip_message('エピックゴール', 'alice', 25, '25', 'go')),
+    ('goal_by_source', event('tip', amount=25, source='epicGoal'), tip_message('エピックゴール', 'alice', 25, '25', '')),
+    ('goal_by_flag', event('tip', amount=25, isEpicGoal=True), tip_message('エピックゴール', 'alice', 25, '25', '')),
+    # プレゼントメニュー
+    ('menu_by_source', event('tip', amount=10, source='tipMenu', body='Dance'),
+     tip_message('プレゼントメニュー', 'alice', 10, '10', 'Dance')),
+    ('menu_by_item', event('tip', amount=10, tipMenuItem='Dance'), tip_message('プレゼントメニュー', 'alice', 10, '10', '')),
+    ('menu_by_tip_data', event('tip', amount=10, tipData={'tipMenu': True}), tip_message('プレゼントメニュー', 'alice', 10, '10', '')),
+    # ルーレット
+    ('wheel_by_type', event('wheelOfFortuneResult', prize='Hug'), wheel_message('alice', 'Hug')),
+    ('wheel_by_plugin', event('plugin', pluginName='Wheel of Fortune', winningItem=' Kiss '), wheel_message('alice', 'Kiss')),
+    ('wheel_result_field', event('wheel', result='Song'), wheel_message('alice', 'Song')),
+    ('wheel_body_field', event('wheel', body='Spin again'), wheel_message('alice', 'Spin again')),
+]
+
+IGNORED = [
+    ('wheel_without_prize', event('wheel')),
+    ('wheel_without_user', event('wheel', username=None, prize='Hug')),
+    ('tip_without_amount', event('tip', body='hi')),
+    ('tip_without_user', event('tip', username=None, amount=5)),
+    ('tip_blank_user', event('tip', username='   ', amount=5)),
+    ('other_type_with_amount', event('lovense', amount=5)),
+    ('plain_chat', event('text', body='hello')),
+    ('menu_data_not_a_dict', event('privateTip', amount=5, tipData='menu')),
+]
+
+@pytest.mark.parametrize('name, frame, expected', CONVERTED, ids=[case[0] for case in CONVERTED])
+def test_event_shapes_are_converted(name, frame, expected):
+    assert fields(network_event_to_message(frame)) == expected
+
+@pytest.mark.parametrize('name, frame', IGNORED, ids=[case[0] for case in IGNORED])
+def test_events_without_required_fields_are_ignored(name, frame):
+    assert network_event_to_message(frame) is None
+
+def test_user_that_is_not_an_object_falls_back_to_details():
+    frame = {'type': 'tip', 'userData': 'u-123', 'details': {'amount': 5, 'username': 'carol'}}
+    assert network_event_to_message(frame)['username'] == 'carol'
+    assert network_event_to_message(dict(frame, userData=['carol'], details={'amount': 5})) is None
+
+def test_ids_come_from_the_event_id_or_its_content():
+    frame = event('tip', amount=5)
+    assert network_event_to_message(frame)['id'] == network_event_to_message(json.loads(json.dumps(frame)))['id']
+    assert network_event_to_message(frame)['id'] != network_event_to_message(event('tip', amount=6))['id']
+    with_id = network_event_to_message(dict(frame, id=42))
+    assert with_id['id'] == network_event_to_message(dict(event('tip', amount=99), id=42))['id']
+    assert with_id['id'] != network_event_to_message(frame)['id']
+
+TIP = json.dumps(event('tip', amount=5, body='one'))
+WHEEL = json.dumps(event('wheel', prize='Hug'))
+
+@pytest.mark.parametrize('payloads, expected', [
+    ([TIP], ['one']),
+    # 改行区切りの複数JSONと、入れ子の中のイベント
+    ([f'{TIP}\n{WHEEL}'], ['one', 'Hug']),
+    ([json.dumps({'data': {'events': [json.loads(TIP), {'type': 'ping'}]}})], ['one']),
+    ([json.dumps([json.loads(WHEEL), json.loads(TIP)]).encode('utf-8')], ['Hug', 'one']),
+    # 壊れたフレームは飛ばし、同じバッチの他のフレームは変換する
+    (['{"type": "tip", "details": {"amount": 5', TIP], ['one']),
+    ([b'\xff\xfe\x00garbage', TIP], ['one']),
+    (['2probe', '42["message", {}]', '', None, TIP], ['one']),
+    ([json.dumps({'type': 'tip', 'details': 'not an object'}), json.dumps({'type': 7, 'details': {}})], []),
+], ids=['single', 'ndjson', 'nested', 'array_bytes', 'truncated', 'binary', 'non_json', 'not_events'])
+def test_payload_frames(payloads, expected):
+    messages = extract_messages_from_payloads(payloads)
+    assert [message.get('comment', message.get('prize')) for message in messages] == expected
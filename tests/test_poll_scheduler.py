@@ -0,0 +1,53 @@
+# test_poll_scheduler.py
+"""チェック間隔の調整（新着の頻度・抽出コスト・上下限）"""
+import pytest
+
+from app import PollScheduler
+
+def test_first_check_is_due_immediately_then_waits_for_the_interval():
+    scheduler = PollScheduler(1, 10, initial_interval=5)
+    assert scheduler.due(now=0)
+    scheduler.record(0, 0.0, now=0)
+    assert not scheduler.due(now=scheduler.interval - 0.1)
+    assert scheduler.due(now=scheduler.interval)
+
+def test_quiet_chat_backs_off_up_to_the_maximum():
+    scheduler = PollScheduler(1, 10, initial_interval=5)
+    now = 0
+    intervals = []
+    for _ in range(5):
+        intervals.append(scheduler.record(0, 0.0, now=now))
+        now += intervals[-1]
+    assert intervals == sorted(intervals)
+    assert intervals[-1] == 10
+
+def test_busy_chat_tightens_down_to_the_minimum():
+    scheduler = PollScheduler(1, 10, initial_interval=5)
+    now = 0
+    for _ in range(5):
+        now += scheduler.interval
+        scheduler.record(50, 0.0, now=now)
+    assert scheduler.interval == 1
+
+def test_expensive_extraction_raises_the_floor():
+    scheduler = PollScheduler(1, 10, initial_interval=1)
+    now = 0
+    for _ in range(10):
+        now += scheduler.interval
+        scheduler.record(50, 1.0, now=now)
+    # 1回1秒かかるチェックはCPUの25%までに抑える
+    assert scheduler.interval >= 3
+
+def test_invalid_bounds_are_rejected():
+    with pytest.raises(ValueError):
+        PollScheduler(0, 10)
+    with pytest.raises(ValueError):
+        PollScheduler(5, 1)
+
+def test_checkpoint_keeps_interval_and_estimates():
+    scheduler = PollScheduler(1, 10, initial_interval=5)
+    scheduler.record(4, 0.2, now=5)
+    restored = PollScheduler.from_checkpoint(scheduler.stats())
+    assert restored.interval == pytest.approx(scheduler.interval, abs=1e-3)
+    assert restored.rate == pytest.approx(scheduler.rate, abs=1e-3)
+    assert restored.cost == pytest.approx(scheduler.cost, abs=1e-3)
@@ -0,0 +1,120 @@
+# test_scraper_coordinator.py
+"""スクレイパーワーカーが落ちたときの起動し直し・割り当て直しと、診断の転送（合成チャットの再生で、Chromeは使わない）"""
+import collections
+import os
+import signal
+import time
+
+import pytest
+
+from app import BoundedDedupIndex, BroadcastHub, ScraperCoordinator
+
+OPTIONS = {
+    'url': 'replay://synthetic?rate=40&window=200',
+    'capture_mode': 'observer',
+    'debug_level': 'off',
+    'debug_sample_every': 12,
+    'poll_min_interval': 0.5,
+    'poll_max_interval': 1,
+    'poll_interval': 0.5,
+    'stale_after': 60,
+    'keywords': {},
+    'browser_profile': None
+}
+
+@pytest.fixture
+def coordinator(monkeypatch):
+    # ワーカーはspawnで起動され、環境変数を読み直す
+    monkeypatch.setenv('REPLAY_ENABLED', '1')
+    monkeypatch.setenv('BROWSER_POOL_PREWARM', '0')
+    coordinator = ScraperCoordinator(1)
+    yield coordinator
+    coordinator.shutdown()
+
+def wait_until(condition, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.2)
+    return False
+
+class Collector:
+    """ハブに届いたメッセージのIDを集める"""
+    
+    def __init__(self, hub):
+        self.subscription = hub.subscribe()
+        self.ids = []
+    
+    def count(self):
+        for _, batch in self.subscription.drain_nowait():
+            assert isinstance(batch, list), batch
+            self.ids.extend(message['id'] for message in batch)
+        return len(self.ids)
+
+def start(coordinator, options=OPTIONS):
+    hub = BroadcastHub(capacity=10000, replay_size=10000)
+    collector = Collector(hub)
+    handle, stop_event = coordinator.start_session('s1', dict(options), hub, BoundedDedupIndex())
+    return collector, handle, stop_event
+
+def kill_worker(coordinator, session_id):
+    worker_id = coordinator.sessions[session_id]['worker_id']
+    pid = coordinator.workers[worker_id]['process'].pid
+    os.kill(pid, signal.SIGKILL)
+    return pid
+
+def test_crashed_worker_is_respawned_and_its_session_reassigned_without_duplicates(coordinator):
+    collector, handle, stop_event = start(coordinator)
+    assert wait_until(lambda: collector.count() >= 20)
+    
+    killed_pid = kill_worker(coordinator, 's1')
+    assert wait_until(lambda: coordinator.restarts == 1)
+    before = collector.count()
+    assert wait_until(lambda: collector.count() >= before + 20)
+    
+    stats = coordinator.stats()
+    assert stats['rebalanced_sessions'] == 1
+    assert stats['workers'][0]['pid'] != killed_pid and stats['workers'][0]['alive']
+    assert stats['workers'][0]['sessions'] == 1
+    # 新しいワーカーは引き継いだIDを処理済みとして扱い、表示中の履歴を再送しない
+    duplicates = [message_id for message_id, count in collections.Counter(collector.ids).items() if count > 1]
+    assert duplicates == []
+    
+    stop_event.set()
+    handle.join(15)
+    assert not handle.is_alive()
+    assert 's1' not in coordinator.sessions
+
+def test_session_stopped_before_the_crash_is_not_reassigned(coordinator):
+    collector, handle, stop_event = start(coordinator)
+    assert wait_until(lambda: collector.count() > 0)
+    with coordinator.lock:
+        # 停止の指示がワーカーに届く前に落ちた場合
+        coordinator.sessions['s1']['stopping'] = True
+    kill_worker(coordinator, 's1')
+    assert wait_until(lambda: not handle.is_alive())
+    assert coordinator.restarts == 1 and coordinator.rebalanced_sessions == 0
+
+def test_debug_settings_and_snapshots_are_forwarded_to_the_worker(coordinator):
+    # domモードでは、ワーカーの監視ループが取得したページのHTMLが診断に使われる
+    collector, handle, stop_event = start(coordinator, dict(OPTIONS, capture_mode='dom'))
+    assert wait_until(lambda: collector.count() > 0)
+    assert coordinator.debug_state('s1')['snapshot'] is None
+    
+    assert coordinator.configure_debug('s1', {'level': 'sampled', 'sample_every': 1000})
+    # 次のチェックで取得したページが診断に使われる
+    seen = collector.count()
+    assert wait_until(lambda: collector.count() > seen)
+    assert coordinator.capture_debug('s1')
+    assert wait_until(lambda: (coordinator.debug_state('s1')['snapshot'] or {}).get('reason') == 'on_demand')
+    assert coordinator.debug_state('s1')['snapshot']['html_length'] > 0
+    
+    # 割り当て直した新しいワーカーにも設定が引き継がれる
+    kill_worker(coordinator, 's1')
+    assert wait_until(lambda: coordinator.restarts == 1)
+    assert coordinator.sessions['s1']['options']['debug_level'] == 'sampled'
+    first = coordinator.debug_state('s1')['snapshot']['captured_at']
+    assert coordinator.capture_debug('s1')
+    assert wait_until(lambda: coordinator.debug_state('s1')['snapshot']['captured_at'] != first)
+    stop_event.set()
@@ -0,0 +1,63 @@
+# test_session_aggregator.py
+"""セッションの集計と、差分を重ねた結果が集計全体と一致すること"""
+from app import BroadcastHub, SessionAggregator, merge_stats_delta
+
+def tip(username, amount, message_type='メッセージ', prize=None):
+    return {'type': message_type, 'username': username, 'amount': amount, 'prize': prize}
+
+def test_counts_users_types_and_prizes():
+    aggregator = SessionAggregator()
+    aggregator.add([tip('alice', 10), tip('bob', 0), tip('alice', 5, 'ルーレット', 'hug')])
+    snapshot = aggregator.snapshot()
+    assert (snapshot['messages'], snapshot['coins'], snapshot['user_count']) == (3, 15, 2)
+    assert snapshot['types'] == {'メッセージ': {'count': 2, 'coins': 10}, 'ルーレット': {'count': 1, 'coins': 5}}
+    assert snapshot['users']['alice'] == {'coins': 15, 'count': 2}
+    assert snapshot['prizes'] == {'hug': 1}
+
+def test_system_messages_and_anonymous_rows_are_not_counted():
+    aggregator = SessionAggregator()
+    assert aggregator.add([{'type': 'system', 'username': 'x', 'amount': 1}, tip(None, 10)]) is None
+    assert aggregator.snapshot()['messages'] == 0
+
+def test_delta_carries_only_changed_items():
+    aggregator = SessionAggregator()
+    aggregator.add([tip('alice', 10), tip('bob', 5, 'ルーレット', 'hug')])
+    delta = aggregator.add([tip('bob', 0)])
+    assert set(delta['users']) == {'bob'}
+    assert set(delta['types']) == {'メッセージ'}
+    assert 'prizes' not in delta and 'top_tippers' not in delta
+
+def test_top_tippers_are_bounded_and_ordered():
+    aggregator = SessionAggregator(top_n=2)
+    aggregator.add([tip('alice', 10), tip('bob', 20), tip('carol', 5)])
+    assert [e['username'] for e in aggregator.snapshot()['top_tippers']] == ['bob', 'alice']
+    delta = aggregator.add([tip('carol', 30)])
+    assert delta['top_tippers'] == [{'username': 'carol', 'coins': 35}, {'username': 'bob', 'coins': 20}]
+
+def test_merged_deltas_on_a_snapshot_match_the_aggregate():
+    aggregator = SessionAggregator(top_n=3)
+    aggregator.add([tip('alice', 10)])
+    base = aggregator.snapshot()
+    merged = None
+    for batch in ([tip('bob', 5, 'ルーレット', 'hug')], [tip('alice', 1), tip('dave', 50)]):
+        merged = merge_stats_delta(merged, aggregator.add(batch))
+    final = aggregator.snapshot()
+    for key in ('types', 'users', 'prizes'):
+        base[key].update(merged[key])
+    for key in ('messages', 'coins', 'user_count', 'top_tippers'):
+        base[key] = merged[key]
+    assert base == final
+
+def test_checkpoint_round_trip():
+    aggregator = SessionAggregator()
+    aggregator.add([tip('alice', 10), tip('bob', 5, 'ルーレット', 'hug')])
+    restored = SessionAggregator.from_checkpoint(aggregator.snapshot())
+    assert restored.snapshot() == aggregator.snapshot()
+
+def test_hub_publishes_the_delta_right_after_its_batch():
+    hub = BroadcastHub(capacity=8, aggregator=SessionAggregator())
+    subscription = hub.subscribe()
+    hub.put([tip('alice', 10)])
+    (messages_id, _), (stats_id, stats) = subscription.drain_nowait()
+    assert stats_id == messages_id + 1
+    assert stats['stats']['coins'] == 10
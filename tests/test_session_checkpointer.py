@@ -0,0 +1,80 @@
+# test_session_checkpointer.py
+"""チェックポイントの書き出しと読み戻し（セッション管理の代わりに記録するだけの偽物を使う）"""
+import json
+import os
+import time
+
+import pytest
+
+import app
+from app import SESSION_CHECKPOINT_VERSION, SessionCheckpointer
+
+class FakeManager:
+    """SessionManagerのうち、チェックポイントが使う部分だけを持つ偽物"""
+    
+    def __init__(self, records=None):
+        self.records = records or []
+        self.restored = None
+        self.dedup_limit = None
+    
+    def checkpoint(self, dedup_limit=None):
+        self.dedup_limit = dedup_limit
+        return self.records
+    
+    def restore(self, records, now=None):
+        self.restored = records
+        return len(records)
+
+RECORDS = [{'scrape_id': 's1', 'url': 'https://example.com/room', 'last_event_id': 42}]
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'sessions.json')
+
+def write(path, **payload):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'version': SESSION_CHECKPOINT_VERSION, 'saved_at': time.time(), 'sessions': RECORDS, **payload}, f)
+
+def test_save_then_restore_round_trip(path):
+    saver = SessionCheckpointer(path, FakeManager(RECORDS))
+    assert saver.save() is True
+    assert not os.path.exists(f"{path}.tmp")
+    assert saver.stats()['last_sessions'] == 1
+    assert saver.manager.dedup_limit == app.SESSION_CHECKPOINT_DEDUP_ENTRIES
+    
+    manager = FakeManager()
+    assert SessionCheckpointer(path, manager).restore() == 1
+    assert manager.restored == RECORDS
+
+def test_save_is_skipped_while_workers_are_shutting_down(path, monkeypatch):
+    monkeypatch.setattr(app.scraper_coordinator, 'closing', True)
+    assert SessionCheckpointer(path, FakeManager(RECORDS)).save() is False
+    assert not os.path.exists(path)
+
+def test_disabled_without_a_path():
+    checkpointer = SessionCheckpointer('', FakeManager(RECORDS))
+    assert not checkpointer.enabled
+    assert checkpointer.save() is False
+    assert checkpointer.restore() == 0
+
+@pytest.mark.parametrize('payload', [{'version': SESSION_CHECKPOINT_VERSION + 1},
+                                     {'saved_at': 0}])
+def test_unknown_version_or_stale_checkpoint_is_ignored(path, payload):
+    write(path, **payload)
+    manager = FakeManager()
+    assert SessionCheckpointer(path, manager).restore() == 0
+    assert manager.restored is None
+
+def test_corrupt_checkpoint_is_ignored(path):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{"version": 1, "saved_')
+    assert SessionCheckpointer(path, FakeManager()).restore() == 0
+
+def test_failed_write_keeps_the_previous_checkpoint(path):
+    write(path)
+    os.mkdir(f"{path}.tmp")
+    checkpointer = SessionCheckpointer(path, FakeManager([]))
+    assert checkpointer.save() is False
+    assert checkpointer.stats()['failures'] == 1
+    manager = FakeManager()
+    assert SessionCheckpointer(path, manager).restore() == 1
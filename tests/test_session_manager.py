@@ -0,0 +1,133 @@
+# test_session_manager.py
+"""セッションの上限・起動失敗時の枠の返却・共有と停止・放置セッションの回収・URLの正規化（監視処理の代わりに停止を待つだけの偽物を使う）"""
+import time
+
+import pytest
+
+import app
+from app import MessageStore, SessionManager, normalize_stream_url
+
+URL = 'https://example.com/room'
+
+def fake_monitor(url, session_id, hub, stop_event, *args):
+    """monitor_chatの代わりに、停止の指示を待つだけの監視スレッド"""
+    stop_event.wait(10)
+
+@pytest.fixture
+def manager(monkeypatch):
+    manager = SessionManager(max_sessions=2, idle_ttl=60)
+    # 回収はテストから時刻を指定して呼び出す
+    monkeypatch.setattr(manager, '_ensure_reaper', lambda: None)
+    monkeypatch.setattr(app, 'session_manager', manager)
+    monkeypatch.setattr(app, 'monitor_chat', fake_monitor)
+    monkeypatch.setattr(app, 'message_store', MessageStore(''))
+    return manager
+
+@pytest.fixture
+def client(manager, monkeypatch):
+    # 最初のリクエストでブラウザを起動しないようにする
+    monkeypatch.setattr(app, 'background_services_started', True)
+    return app.app.test_client()
+
+def start(client, url=URL, **options):
+    return client.post('/api/start-monitoring', json=dict(options, url=url))
+
+def wait_until(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+def test_start_beyond_the_limit_is_rejected_with_retry_after(client, manager):
+    assert start(client, 'https://example.com/a').status_code == 200
+    assert start(client, 'https://example.com/b').status_code == 200
+    response = start(client, 'https://example.com/c')
+    assert response.status_code == 429
+    body = response.get_json()
+    # 購読者のいないスクレイプが回収されるまでの目安
+    assert response.headers['Retry-After'] == str(body['retry_after'])
+    assert 60 <= body['retry_after'] <= 60 + app.SESSION_REAP_INTERVAL
+    assert manager.stats()['rejected'] == 1 and manager.stats()['in_use'] == 2
+    # 同じURLの共有は上限に数えない
+    assert start(client, 'https://example.com/a').get_json()['shared'] is True
+
+def test_reservations_count_towards_the_limit_until_registered_or_cancelled(manager):
+    assert manager.reserve('s1') is None
+    assert manager.reserve('s2') is None
+    assert manager.reserve('s3') is not None
+    manager.cancel('s2')
+    assert manager.reserve('s3') is None
+    assert manager.stats()['in_use'] == 2
+
+@pytest.mark.parametrize('runner', ['thread', 'worker'])
+def test_failed_launch_returns_its_reservation(client, manager, monkeypatch, runner):
+    def broken(*args, **kwargs):
+        raise RuntimeError("can't start new thread")
+    
+    with monkeypatch.context() as patch:
+        if runner == 'worker':
+            patch.setattr(app.scraper_coordinator, 'worker_count', 1)
+            patch.setattr(app.scraper_coordinator, 'start_session', broken)
+        else:
+            patch.setattr(app.threading, 'Thread', broken)
+        assert start(client).status_code == 500
+    assert manager.stats()['in_use'] == 0 and not manager.reserved
+    # 返した枠で上限まで起動できる
+    assert start(client).status_code == 200
+    assert start(client, 'https://example.com/other').status_code == 200
+
+def test_shared_scrape_stops_when_the_last_holder_leaves(client, manager):
+    first = start(client).get_json()
+    second = start(client, f'{URL}/?utm_source=x').get_json()
+    assert second['shared'] is True and second['scrape_id'] == first['session_id']
+    assert second['holders'] == 2
+    session = manager.get(first['session_id'])
+    
+    response = client.post(f"/api/stop-monitoring/{first['session_id']}")
+    assert response.get_json()['holders'] == 1
+    assert not session['stop_event'].is_set()
+    assert manager.get(second['session_id']) is session
+    
+    response = client.post(f"/api/stop-monitoring/{second['session_id']}")
+    assert response.get_json()['holders'] == 0
+    assert session['stop_event'].is_set()
+    assert manager.by_share_key == {} and manager.sessions == {}
+    assert wait_until(lambda: manager.stats()['stopping'] == 0 and manager.stats()['in_use'] == 0)
+    assert client.post(f"/api/stop-monitoring/{second['session_id']}").status_code == 404
+
+def test_scrapes_with_other_settings_are_not_shared(client, manager):
+    first = start(client).get_json()
+    lean = start(client, browser_profile='lean').get_json()
+    assert lean['shared'] is False and lean['browser_profile'] == 'lean'
+    assert start(client).get_json()['browser_profile'] == first['browser_profile']
+    assert start(client, browser_profile='lean').get_json()['scrape_id'] == lean['session_id']
+    # 上限（2）に達していても、共有できるスクレイプには加われる
+    assert start(client, capture_mode='observer').status_code == 429
+
+def test_idle_scrapes_are_reaped_with_all_holders(client, manager):
+    idle = start(client).get_json()
+    start(client)
+    watched = start(client, 'https://example.com/watched').get_json()
+    subscription = manager.get(watched['session_id'])['hub'].subscribe()
+    
+    assert manager.reap(now=time.time() + 30) == []
+    assert manager.reap(now=time.time() + 61) == [idle['session_id']]
+    assert manager.stats()['holders'] == 1 and manager.reaped == 1
+    assert manager.get(watched['session_id'])['hub'] is subscription.hub
+    subscription.hub.unsubscribe(subscription)
+
+@pytest.mark.parametrize('url, expected', [
+    ('https://Example.COM/room/', 'https://example.com/room'),
+    ('HTTPS://example.com:443/room', 'https://example.com/room'),
+    ('http://example.com:8080/room', 'http://example.com:8080/room'),
+    ('https://example.com', 'https://example.com/'),
+    ('https://example.com/room?b=2&a=1', 'https://example.com/room?a=1&b=2'),
+    ('https://example.com/room?utm_source=x&UTM_Medium=y&fbclid=1&gclid=2&ref=top&tab=chat',
+     'https://example.com/room?tab=chat'),
+    ('https://example.com/room?flag=&x=1#chat', 'https://example.com/room?flag=&x=1'),
+    ('  https://example.com/room  ', 'https://example.com/room'),
+])
+def test_normalize_stream_url(url, expected):
+    assert normalize_stream_url(url) == expected
@@ -0,0 +1,102 @@
+# test_sse_encoder.py
+"""SSEのまとめ・簡易形式・圧縮（簡易形式はmonitor.jsのexpandCompactMessagesで展開して確かめる）"""
+import json
+import os
+import re
+import shutil
+import subprocess
+import zlib
+from datetime import datetime
+
+import pytest
+
+from app import SSE_COMPACT_FIELDS, BroadcastHub, SseEncoder, Subscription, compact_messages
+
+MONITOR_JS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'static', 'js', 'monitor.js')
+
+def monitor_source():
+    with open(MONITOR_JS, encoding='utf-8') as f:
+        return f.read()
+
+def expand_in_monitor_js(data):
+    """monitor.jsのCOMPACT_FIELDSとexpandCompactMessagesだけを取り出してNode.jsで実行する"""
+    source = monitor_source()
+    fields = re.search(r'^const COMPACT_FIELDS = .*$', source, re.M).group(0)
+    expand = re.search(r'^function expandCompactMessages\(data\) \{.*?^\}', source, re.M | re.S).group(0)
+    script = f"{fields}\n{expand}\nconsole.log(JSON.stringify(expandCompactMessages({json.dumps(data)})));"
+    completed = subprocess.run(['node', '-e', script], capture_output=True, text=True, check=True)
+    return json.loads(completed.stdout)
+
+def parse_events(text):
+    """SSEのテキストを(イベントID, ペイロード)の列にする"""
+    events = []
+    for block in text.strip().split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in block.split('\n'))
+        events.append((int(fields['id']) if 'id' in fields else None, json.loads(fields['data'])))
+    return events
+
+def message(n, **fields):
+    return {'id': f'm{n}', 'type': 'メッセージ', 'timestamp': datetime(2024, 1, 1, 12, 0, n).isoformat(),
+            'text': f'text {n}', 'username': f'user{n}', 'amount': None, 'comment': None, 'prize': None,
+            'keywords': None, 'checked': False, **fields}
+
+def make_subscription():
+    return Subscription(BroadcastHub(capacity=8), 1, 8)
+
+def test_compact_field_order_matches_monitor_js():
+    fields = re.search(r"^const COMPACT_FIELDS = \[(.*)\];$", monitor_source(), re.M).group(1)
+    assert tuple(re.findall(r"'(\w+)'", fields)) == SSE_COMPACT_FIELDS
+
+@pytest.mark.skipif(shutil.which('node') is None, reason='Node.js is required')
+def test_compact_round_trip_through_monitor_js():
+    messages = [message(0, amount=10, comment='hi'), message(1, type='ルーレット', prize='hug', keywords=['hug']),
+                message(2, timestamp=None)]
+    expanded = expand_in_monitor_js({'type': 'messages', **compact_messages(messages)})
+    for original, restored in zip(messages, expanded):
+        original_at = original.pop('timestamp')
+        restored_at = restored.pop('timestamp')
+        if original_at is None:
+            assert restored_at is None
+        else:
+            restored_at = datetime.fromisoformat(restored_at.replace('Z', '+00:00')).timestamp()
+            assert restored_at == datetime.fromisoformat(original_at).timestamp()
+        # JSONで省かれたNoneは展開後に存在しない
+        assert restored == {key: value for key, value in original.items() if value is not None or key == 'checked'}
+    assert len(expanded) == len(messages)
+
+def test_batches_coalesce_into_one_event_per_kind_with_the_last_ids():
+    entries = [(1, [message(0)]), (2, {'stats': {'messages': 1, 'users': {'a': {'coins': 0, 'count': 1}}}}),
+               (3, [message(1)]), (4, {'stats': {'messages': 2, 'users': {'b': {'coins': 0, 'count': 1}}}})]
+    data, errored = SseEncoder().batch(entries, make_subscription())
+    assert not errored
+    (messages_id, messages_event), (stats_id, stats_event) = parse_events(data.decode('utf-8'))
+    assert (messages_id, stats_id) == (3, 4)
+    assert [m['id'] for m in messages_event['messages']] == ['m0', 'm1']
+    assert stats_event['stats'] == {'messages': 2, 'users': {'a': {'coins': 0, 'count': 1}, 'b': {'coins': 0, 'count': 1}}}
+    # 再送ログの差分は変更しない
+    assert entries[1][1]['stats']['users'] == {'a': {'coins': 0, 'count': 1}}
+
+def test_last_event_in_a_frame_carries_the_highest_id():
+    entries = [(1, {'stats': {'messages': 1}}), (2, [message(0)])]
+    data, _ = SseEncoder().batch(entries, make_subscription())
+    assert [event_id for event_id, _ in parse_events(data.decode('utf-8'))] == [1, 2]
+
+def test_error_ends_the_frame_after_the_batches_before_it():
+    entries = [(1, [message(0)]), (2, {'error': 'boom'}), (3, [message(1)])]
+    data, errored = SseEncoder().batch(entries, make_subscription())
+    assert errored
+    events = parse_events(data.decode('utf-8'))
+    assert [(event_id, payload['type']) for event_id, payload in events] == [(1, 'messages'), (2, 'error')]
+
+@pytest.mark.parametrize('encoding', ['gzip', 'deflate'])
+def test_compressed_frames_decode_incrementally(encoding):
+    encoder = SseEncoder(compact=True, encoding=encoding)
+    decompressor = zlib.decompressobj(31 if encoding == 'gzip' else 15)
+    first = decompressor.decompress(encoder.event({'type': 'connected'}, 0))
+    assert parse_events(first.decode('utf-8')) == [(0, {'type': 'connected'})]
+    data, _ = encoder.batch([(1, [message(0)])], make_subscription())
+    (event_id, payload), = parse_events(decompressor.decompress(data).decode('utf-8'))
+    assert event_id == 1 and payload['r'][0][0] == 'm0'
+    decompressor.decompress(encoder.finish())
+    assert decompressor.eof
+    assert encoder.headers['Content-Encoding'] == encoding